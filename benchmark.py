@@ -0,0 +1,372 @@
+import os
+import sys
+import json
+import time
+import random
+import signal
+import sqlite3
+import argparse
+import tempfile
+import threading
+import subprocess
+import collections
+import urllib.parse
+import http.server
+import resource
+
+# Offline load test for bot.py.
+# Starts a stand-in Bot API server on localhost, seeds a fresh database, runs bot.py against
+# both as a subprocess (TELEGRAM_API_URL) and replays synthetic users through getUpdates.
+# Each virtual user sends one update at a time and waits for the bot's reply before sending
+# the next, so latency is the time from an update being handed out by getUpdates to the
+# reply (sendMessage/sendPhoto/sendDocument/editMessageText) reaching the server.
+# Prints one JSON object with throughput, latency percentiles and the bot's peak RSS.
+# The outbox still applies Telegram's send limits (SEND_GLOBAL_RATE, SEND_CHAT_RATE), which
+# cap throughput; raise them with --env to measure the bot itself.
+#
+#   python benchmark.py --workload join --users 500 --seed-users 100000
+#   python benchmark.py --workload mixed --engine asyncio --latency-ms 50 --rate-limit 0.02
+
+BOT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bot.py')
+BOT_TOKEN = '123456:BENCHMARK'
+REPLY_METHODS = {'sendMessage', 'sendPhoto', 'sendDocument', 'editMessageText'}
+SEND_METHODS = REPLY_METHODS | {'answerCallbackQuery', 'sendChatAction'}
+WORKLOADS = ('join', 'forms', 'status', 'download', 'mixed')
+
+# Update payloads in the Bot API's JSON shape
+def text_update(chat_id, text):
+    return {'message': {'message_id': 1, 'date': int(time.time()), 'text': text,
+                        'chat': {'id': chat_id, 'type': 'private'},
+                        'from': {'id': chat_id, 'is_bot': False, 'first_name': f'User{chat_id}',
+                                 'username': f'user{chat_id}'}}}
+
+def callback_update(chat_id, data):
+    return {'callback_query': {'id': str(random.getrandbits(48)), 'chat_instance': str(chat_id), 'data': data,
+                               'from': {'id': chat_id, 'is_bot': False, 'first_name': f'User{chat_id}'},
+                               'message': {'message_id': 1, 'date': int(time.time()), 'text': 'menu',
+                                           'chat': {'id': chat_id, 'type': 'private'}}}}
+
+# The updates one virtual user sends, in order. New users get ids above the seeded range.
+def user_script(workload, index, seed_users, iterations):
+    if workload == 'mixed':
+        workload = WORKLOADS[index % (len(WORKLOADS) - 1)]
+    if workload in ('join', 'forms'):
+        chat_id = seed_users + index + 1
+    else:
+        chat_id = index % max(seed_users, 1) + 1
+    steps = []
+    for _ in range(iterations):
+        if workload == 'join':
+            steps.append(text_update(chat_id, f'/start {random.randint(1, max(seed_users, 1))}'))
+        elif workload == 'forms':
+            steps += [callback_update(chat_id, 'Wallet'), text_update(chat_id, '0x' + '%040x' % random.getrandbits(160)),
+                      callback_update(chat_id, 'Email'), text_update(chat_id, f'user{chat_id}@example.com')]
+        elif workload == 'status':
+            steps.append(callback_update(chat_id, 'status'))
+        elif workload == 'download':
+            steps += [text_update(chat_id, '/download_csv'), callback_update(chat_id, 'download_referrals_csv')]
+    return chat_id, steps
+
+# Clients dropping a long poll at shutdown are expected, not worth a traceback
+class QuietHTTPServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+# Stand-in for api.telegram.org: long-polled getUpdates fed by the virtual users, canned
+# results for the send methods, optional added latency and 429 responses
+class FakeBotAPI:
+    def __init__(self, latency=0.0, jitter=0.0, rate_limit=0.0, retry_after=1):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.calls = collections.Counter()
+        self.rate_limited = 0
+        self.latencies = []
+        self.polling = threading.Event()  # set by the bot's first getUpdates
+        self.finished = threading.Event()  # set when every virtual user is done
+        self._cond = threading.Condition()
+        self._pending = collections.deque()  # updates not yet confirmed by a getUpdates offset
+        self._next_update_id = 1
+        self._message_id = 0
+        self._users = {}  # chat_id -> [remaining steps, update_id in flight, handed out at]
+        self._closing = False
+        self.server = QuietHTTPServer(('127.0.0.1', 0), self._request_handler())
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}'
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name='fake-api', daemon=True).start()
+
+    def close(self):
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+        self.server.shutdown()
+
+    def add_user(self, chat_id, steps):
+        with self._cond:
+            self._users[chat_id] = [collections.deque(steps), None, None]
+            self._queue_next(chat_id)
+
+    # Called with the lock held
+    def _queue_next(self, chat_id):
+        user = self._users[chat_id]
+        if not user[0]:
+            user[1] = None
+            del self._users[chat_id]
+            if not self._users:
+                self.finished.set()
+            return
+        update = dict(user[0].popleft(), update_id=self._next_update_id)
+        self._next_update_id += 1
+        user[1], user[2] = update['update_id'], None
+        self._pending.append(update)
+        self._cond.notify_all()
+
+    def _get_updates(self, params):
+        offset = int(params.get('offset') or 0)
+        limit = int(params.get('limit') or 100)
+        deadline = time.monotonic() + float(params.get('timeout') or 0)
+        self.polling.set()
+        with self._cond:
+            while self._pending and self._pending[0]['update_id'] < offset:
+                self._pending.popleft()
+            while not self._pending and not self._closing:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            updates = list(self._pending)[:limit]
+            now = time.monotonic()
+            for update in updates:
+                chat_id = self._chat_of(update)
+                user = self._users.get(chat_id)
+                if user is not None and user[1] == update['update_id'] and user[2] is None:
+                    user[2] = now
+        return updates
+
+    def _replied(self, chat_id):
+        now = time.monotonic()
+        with self._cond:
+            user = self._users.get(chat_id)
+            if user is None or user[2] is None:
+                return
+            self.latencies.append(now - user[2])
+            self._queue_next(chat_id)
+
+    @staticmethod
+    def _chat_of(update):
+        if 'message' in update:
+            return update['message']['chat']['id']
+        return update['callback_query']['message']['chat']['id']
+
+    def _result(self, method, params):
+        if method == 'getMe':
+            return {'id': 123456, 'is_bot': True, 'first_name': 'Benchmark', 'username': 'benchmark_bot'}
+        if method in REPLY_METHODS:
+            with self._cond:
+                self._message_id += 1
+                message_id = self._message_id
+            message = {'message_id': message_id, 'date': int(time.time()),
+                       'chat': {'id': int(params.get('chat_id') or 0), 'type': 'private'}}
+            if method == 'sendPhoto':
+                message['photo'] = [{'file_id': 'photo-file-id', 'file_unique_id': 'photo', 'width': 1, 'height': 1}]
+            elif method == 'sendDocument':
+                message['document'] = {'file_id': f'document-{message_id}', 'file_unique_id': f'document-{message_id}'}
+            else:
+                message['text'] = params.get('text', '')
+            return message
+        return True
+
+    def handle(self, method, params):
+        self.calls[method] += 1
+        if method == 'getUpdates':
+            return 200, {'ok': True, 'result': self._get_updates(params)}
+        if method in SEND_METHODS or method == 'getMe':
+            delay = self.latency + random.uniform(0, self.jitter)
+            if delay:
+                time.sleep(delay)
+        if method in SEND_METHODS and self.rate_limit and random.random() < self.rate_limit:
+            with self._cond:
+                self.rate_limited += 1
+            return 429, {'ok': False, 'error_code': 429,
+                         'description': f'Too Many Requests: retry after {self.retry_after}',
+                         'parameters': {'retry_after': self.retry_after}}
+        result = self._result(method, params)
+        if method in REPLY_METHODS and params.get('chat_id'):
+            self._replied(int(params['chat_id']))
+        return 200, {'ok': True, 'result': result}
+
+    def _request_handler(self):
+        api = self
+
+        class FakeBotAPIHandler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                url = urllib.parse.urlparse(self.path)
+                method = url.path.rsplit('/', 1)[-1]
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+                # telebot sends parameters in the query string (files as multipart);
+                # python-telegram-bot sends them in the body
+                params = dict(urllib.parse.parse_qsl(url.query))
+                content_type = self.headers.get('Content-Type', '')
+                if body and content_type.startswith('application/json'):
+                    params.update(json.loads(body))
+                elif body and content_type.startswith('application/x-www-form-urlencoded'):
+                    params.update(urllib.parse.parse_qsl(body.decode()))
+                status, payload = api.handle(method, params)
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_POST
+
+            def log_message(self, format, *args):
+                pass
+
+        return FakeBotAPIHandler
+
+# Create the schema by importing bot.py, then add `users` referral members: each one's upline
+# is an earlier user, so the referral tree is as deep as a real campaign's
+def seed_database(env, db_path, users):
+    subprocess.run([sys.executable, '-c', 'import bot'], cwd=os.path.dirname(BOT_PATH), env=env, check=True)
+    uplines = [None] + [random.randint(1, chat_id - 1) for chat_id in range(2, users + 1)]
+    counts = collections.Counter(upline for upline in uplines if upline is not None)
+    conn = sqlite3.connect(db_path)
+    with conn:
+        conn.executemany('''INSERT INTO users (chat_id, referral_link, count, upline_id, username, firstname, telegram_listed)
+                         VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                         ((chat_id, f'https://t.me/benchmark_bot?start={chat_id}', counts[chat_id], upline,
+                           f'user{chat_id}', f'User{chat_id}', int(upline is not None))
+                          for chat_id, upline in enumerate(uplines, 1)))
+    # The rows went in behind the bot's back: build their referral graph as the migration would
+    subprocess.run([sys.executable, '-c', 'import bot; bot.backfill_referral_graph()'],
+                   cwd=os.path.dirname(BOT_PATH), env=env, check=True)
+    paths, = conn.execute("SELECT COUNT(*) FROM referral_paths").fetchone()
+    conn.close()
+    if users > 1 and not paths:
+        raise SystemExit('seeding left referral_paths empty')
+
+def peak_rss_kb(pid):
+    try:
+        with open(f'/proc/{pid}/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+def run(args):
+    workdir = tempfile.mkdtemp(prefix='frd_benchmark_')
+    db_path = os.path.join(workdir, 'benchmark.db')
+    api = FakeBotAPI(args.latency_ms / 1000, args.jitter_ms / 1000, args.rate_limit, args.retry_after)
+    api.start()
+    env = dict(os.environ, BOT_TOKEN=BOT_TOKEN, DB_PATH=db_path, TELEGRAM_API_URL=api.url,
+               EXPORT_CACHE_DIR=os.path.join(workdir, 'exports'), METRICS_PORT='0', LOG_LEVEL='WARNING')
+    env.update(variable.split('=', 1) for variable in args.env)
+
+    seed_started = time.monotonic()
+    seed_database(env, db_path, args.seed_users)
+    seed_seconds = time.monotonic() - seed_started
+
+    process = subprocess.Popen([sys.executable, BOT_PATH, 'run', '--engine', args.engine, '--mode', 'polling'],
+                               cwd=os.path.dirname(BOT_PATH), env=env,
+                               stderr=None if args.verbose else subprocess.DEVNULL)
+    try:
+        if not api.polling.wait(args.startup_timeout):
+            raise SystemExit('bot.py did not start polling')
+        started = time.monotonic()
+        updates = 0
+        for index in range(args.users):
+            chat_id, steps = user_script(args.workload, index, args.seed_users, args.iterations)
+            updates += len(steps)
+            api.add_user(chat_id, steps)
+        api.finished.wait(args.timeout)
+        elapsed = time.monotonic() - started
+        rss = peak_rss_kb(process.pid)
+    finally:
+        process.send_signal(signal.SIGINT)
+        try:
+            process.wait(30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+        api.close()
+    if rss is None:
+        # ru_maxrss is in kilobytes on Linux, bytes on macOS
+        rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        if sys.platform == 'darwin':
+            rss //= 1024
+
+    latencies = sorted(api.latencies)
+    completed = len(latencies)
+    return {
+        'workload': args.workload,
+        'engine': args.engine,
+        'users': args.users,
+        'iterations': args.iterations,
+        'seed_users': args.seed_users,
+        'seed_seconds': round(seed_seconds, 3),
+        'api_latency_ms': args.latency_ms,
+        'rate_limit': args.rate_limit,
+        'updates': updates,
+        'completed': completed,
+        'timed_out': updates - completed,
+        'duration_s': round(elapsed, 3),
+        'throughput_per_s': round(completed / elapsed, 2) if elapsed else None,
+        'latency_ms': {name: round(value * 1000, 2) if value is not None else None
+                       for name, value in (('p50', percentile(latencies, 0.5)),
+                                           ('p90', percentile(latencies, 0.9)),
+                                           ('p99', percentile(latencies, 0.99)),
+                                           ('max', latencies[-1] if latencies else None))},
+        'rate_limited_responses': api.rate_limited,
+        'api_calls': dict(api.calls),
+        'peak_rss_kb': rss,
+        'exit_code': process.returncode,
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Offline load test for bot.py against a fake Bot API server')
+    parser.add_argument('--workload', choices=WORKLOADS, default='mixed',
+                        help='join: /start with an upline; forms: wallet and email flows; status: status taps; '
+                             'download: /download_csv of the referrals export; mixed: users split over all four')
+    parser.add_argument('--users', type=int, default=200, help='concurrent virtual users')
+    parser.add_argument('--iterations', type=int, default=1, help='times each user repeats its workload')
+    parser.add_argument('--seed-users', type=int, default=10000, help='referral members in the seeded database')
+    parser.add_argument('--engine', choices=['telebot', 'asyncio'], default='telebot')
+    parser.add_argument('--latency-ms', type=float, default=0, help='added to every send and getMe call')
+    parser.add_argument('--jitter-ms', type=float, default=0, help='random extra latency, up to this much')
+    parser.add_argument('--rate-limit', type=float, default=0, help='fraction of sends answered with 429')
+    parser.add_argument('--retry-after', type=int, default=1, help='retry_after in injected 429 responses')
+    parser.add_argument('--timeout', type=float, default=300, help='give up on unfinished users after this long')
+    parser.add_argument('--startup-timeout', type=float, default=120)
+    parser.add_argument('--env', action='append', default=[], metavar='NAME=VALUE',
+                        help='extra environment for bot.py, e.g. --env UPDATE_WORKERS=64')
+    parser.add_argument('--output', help='also write the JSON result to this file')
+    parser.add_argument('--verbose', action='store_true', help="show bot.py's log output")
+    args = parser.parse_args(argv)
+
+    result = run(args)
+    text = json.dumps(result, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(text + '\n')
+    return 0 if result['timed_out'] == 0 else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
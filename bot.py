@@ -9,323 +9,2064 @@ import tempfile
 import re
 import html
 import csv
+import io
+import gzip
 import requests
 import signal
 import time
+import threading
+import queue
+import concurrent.futures
+import collections
+import functools
+import heapq
+import sys
+import ast
+import argparse
+import json
+import hmac
+import http.server
+import logging
+import logging.handlers
+import atexit
+import asyncio
+import contextvars
+import inspect
+import bisect
+import random
+import itertools
+import urllib.request
 
 BOT_TOKEN = os.getenv('BOT_TOKEN')
+# Bot API server to talk to instead of https://api.telegram.org (a local Bot API server, or
+# the fake one benchmark.py starts)
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL', '').rstrip('/')
+DB_PATH = os.getenv('DB_PATH', 'referrals.db')
+DB_CACHE_SIZE_KB = int(os.getenv('DB_CACHE_SIZE_KB', '16384'))
+DB_MMAP_SIZE = int(os.getenv('DB_MMAP_SIZE', str(256 * 1024 * 1024)))
+DB_STATEMENT_CACHE_SIZE = int(os.getenv('DB_STATEMENT_CACHE_SIZE', '256'))
+DB_BUSY_TIMEOUT = float(os.getenv('DB_BUSY_TIMEOUT', '30'))
+DB_WRITE_BATCH_SIZE = int(os.getenv('DB_WRITE_BATCH_SIZE', '256'))
+DB_WRITE_BATCH_WINDOW = float(os.getenv('DB_WRITE_BATCH_WINDOW', '0.005'))
+EXPORT_CHUNK_SIZE = int(os.getenv('EXPORT_CHUNK_SIZE', '5000'))
+EXPORT_GZIP = os.getenv('EXPORT_GZIP', '0') == '1'
+EXPORT_CACHE_DIR = os.getenv('EXPORT_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'frd_exports'))
+ALL_REFERRALS_PAGE_SIZE = int(os.getenv('ALL_REFERRALS_PAGE_SIZE', '40'))
+REFERRAL_MAX_DEPTH = int(os.getenv('REFERRAL_MAX_DEPTH', '3'))
+IMPORT_BATCH_SIZE = int(os.getenv('IMPORT_BATCH_SIZE', '50000'))
+MIGRATION_BATCH_SIZE = int(os.getenv('MIGRATION_BATCH_SIZE', '5000'))
+LEADERBOARD_SIZE = int(os.getenv('LEADERBOARD_SIZE', '10'))
+STATE_TTL = float(os.getenv('STATE_TTL', '1800'))
+STATE_MAX_ENTRIES = int(os.getenv('STATE_MAX_ENTRIES', '100000'))
+STATE_PERSIST = os.getenv('STATE_PERSIST', '1') == '1'
+# Update engine: 'telebot' (threaded long polling) or 'asyncio' (python-telegram-bot)
+BOT_ENGINE = os.getenv('BOT_ENGINE', 'telebot')
+# Updates the asyncio engine handles at once. Hot handlers run on the event loop, so this is
+# the real in-flight cap for them; other handlers also share UPDATE_WORKERS threads.
+ASYNC_MAX_UPDATES = int(os.getenv('ASYNC_MAX_UPDATES', '1000'))
+ASYNC_HTTP_POOL_SIZE = int(os.getenv('ASYNC_HTTP_POOL_SIZE', '100'))
+# Update intake for the telebot engine: 'polling' or 'webhook' (the default when WEBHOOK_URL is set)
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+BOT_MODE = os.getenv('BOT_MODE', 'webhook' if WEBHOOK_URL else 'polling')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8080'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+WEBHOOK_MAX_BODY = int(os.getenv('WEBHOOK_MAX_BODY', str(1024 * 1024)))
+UPDATE_WORKERS = int(os.getenv('UPDATE_WORKERS', '32'))
+UPDATE_QUEUE_SIZE = int(os.getenv('UPDATE_QUEUE_SIZE', '1000'))
+UPDATE_LEDGER_WINDOW = int(os.getenv('UPDATE_LEDGER_WINDOW', '100000'))
+UPDATE_LEDGER_KEEP = int(os.getenv('UPDATE_LEDGER_KEEP', '1000000'))
+UPDATE_LEDGER_PRUNE_EVERY = int(os.getenv('UPDATE_LEDGER_PRUNE_EVERY', '10000'))
+BOT_IDENTITY_REFRESH = float(os.getenv('BOT_IDENTITY_REFRESH', '3600'))
+SEND_WORKERS = int(os.getenv('SEND_WORKERS', '8'))
+SEND_GLOBAL_RATE = float(os.getenv('SEND_GLOBAL_RATE', '30'))
+SEND_CHAT_RATE = float(os.getenv('SEND_CHAT_RATE', '1'))
+SEND_CHAT_BURST = float(os.getenv('SEND_CHAT_BURST', '3'))
+SEND_BULK_QUEUE_SIZE = int(os.getenv('SEND_BULK_QUEUE_SIZE', '1000'))
+SEND_ACTION_WINDOW = float(os.getenv('SEND_ACTION_WINDOW', '0.05'))
+SEND_MAX_RETRIES = int(os.getenv('SEND_MAX_RETRIES', '5'))
+SEND_DRAIN_TIMEOUT = float(os.getenv('SEND_DRAIN_TIMEOUT', '10'))
+# Polling supervisor: getUpdates long-poll seconds, and the retry backoff after a failed poll
+POLL_TIMEOUT = int(os.getenv('POLL_TIMEOUT', '5'))
+POLL_BACKOFF_INITIAL = float(os.getenv('POLL_BACKOFF_INITIAL', '1'))
+POLL_BACKOFF_MAX = float(os.getenv('POLL_BACKOFF_MAX', '60'))
+# Seconds without a getUpdates attempt before the liveness check fails
+HEALTH_STALL_SECONDS = float(os.getenv('HEALTH_STALL_SECONDS', '120'))
+# Time allowed on SIGTERM/SIGINT to finish queued updates and sends and commit pending writes
+SHUTDOWN_DEADLINE = float(os.getenv('SHUTDOWN_DEADLINE', '30'))
+BROADCAST_BATCH_SIZE = int(os.getenv('BROADCAST_BATCH_SIZE', '500'))
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json')
+# Local Prometheus endpoint (METRICS_PORT=0 disables it)
+METRICS_LISTEN = os.getenv('METRICS_LISTEN', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9464'))
+METRICS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# Statements slower than SLOW_QUERY_SECONDS are logged, SLOW_QUERY_SAMPLE of them (0-1)
+SLOW_QUERY_SECONDS = float(os.getenv('SLOW_QUERY_SECONDS', '0.1'))
+SLOW_QUERY_SAMPLE = float(os.getenv('SLOW_QUERY_SAMPLE', '1.0'))
+# Telegram user IDs allowed to run admin commands (/clear_data, /broadcast), comma separated
+ADMIN_IDS = {int(admin_id) for admin_id in os.getenv('ADMIN_IDS', '730149343').split(',') if admin_id.strip()}
 
 address_pattern = re.compile(r'^[a-zA-Z0-9]{30,}$')
 email_pattern = re.compile(r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$')
 
+# Logging: handlers only put records on a queue, a listener thread formats and writes them,
+# so a slow stderr never holds up a handler. LOG_FORMAT=json writes one JSON object per line
+# with any extra={'fields': {...}} merged in; 'text' is for reading in a terminal.
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {'ts': round(record.created, 3), 'level': record.levelname, 'thread': record.threadName,
+                 'msg': record.getMessage()}
+        entry.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+def setup_logging(level=LOG_LEVEL, log_format=LOG_FORMAT):
+    handler = logging.StreamHandler(sys.stderr)
+    if log_format == 'json':
+        handler.setFormatter(JsonLogFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(threadName)s %(message)s'))
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    log.addHandler(logging.handlers.QueueHandler(log_queue))
+    log.setLevel(level)
+    log.propagate = False
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+log = logging.getLogger('fifarewardbot')
+log_listener = setup_logging()
+
+# In-process metrics in the Prometheus text format: counters, latency histograms and gauges
+# read from a callback at scrape time. Labels are tuples of (name, value) pairs.
+class Metrics:
+    def __init__(self, buckets=METRICS_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._help = {}
+        self._counters = {}
+        self._histograms = {}  # (name, labels) -> [count per bucket..., +Inf count, sum]
+        self._gauges = {}
+
+    def describe(self, name, kind, help_text):
+        self._help[name] = (kind, help_text)
+
+    def inc(self, name, labels=(), value=1):
+        with self._lock:
+            self._counters[name, labels] = self._counters.get((name, labels), 0) + value
+
+    def observe(self, name, labels, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            histogram = self._histograms.get((name, labels))
+            if histogram is None:
+                histogram = self._histograms[name, labels] = [0] * (len(self.buckets) + 2)
+            histogram[index] += 1
+            histogram[-1] += value
+
+    def gauge(self, name, help_text, read, labels=()):
+        self.describe(name, 'gauge', help_text)
+        self._gauges[name, labels] = read
+
+    def render(self):
+        with self._lock:
+            samples = collections.defaultdict(list)
+            for (name, labels), value in self._counters.items():
+                samples[name].append((name, labels, value))
+            for (name, labels), histogram in self._histograms.items():
+                total = 0
+                for bound, count in zip(self.buckets + (float('inf'),), histogram):
+                    total += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    samples[name].append((name + '_bucket', labels + (('le', le),), total))
+                samples[name].append((name + '_sum', labels, histogram[-1]))
+                samples[name].append((name + '_count', labels, total))
+        for (name, labels), read in list(self._gauges.items()):
+            try:
+                samples[name].append((name, labels, read()))
+            except Exception as e:
+                log.warning(f"Reading gauge {name} failed: {e}")
+        lines = []
+        for name in sorted(samples):
+            if name in self._help:
+                kind, help_text = self._help[name]
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+            for sample, labels, value in samples[name]:
+                lines.append(f"{sample}{_metric_labels(labels)} {value}")
+        return '\n'.join(lines) + '\n'
+
+def _metric_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + '}'
+
+metrics = Metrics()
+metrics.describe('bot_handler_seconds', 'histogram', 'Time spent in a registered handler')
+metrics.describe('bot_handler_errors_total', 'counter', 'Handler calls that raised')
+metrics.describe('bot_db_statement_seconds', 'histogram', 'SQLite statement execution time by statement kind and table')
+metrics.describe('bot_db_errors_total', 'counter', 'SQLite statements that raised')
+metrics.describe('bot_api_request_seconds', 'histogram', 'Bot API request time by method')
+metrics.describe('bot_api_errors_total', 'counter', 'Failed Bot API requests by method and error code')
+metrics.describe('bot_poll_failures_total', 'counter', 'getUpdates calls that failed and were retried')
+
+# Statement kind and main table for a SQL string, cached per distinct statement.
+# Schema and transaction statements are labelled by kind only.
+_sql_labels = {}
+_SQL_TABLE = re.compile(r'\b(?:FROM|INTO|UPDATE)\s+(\w+)', re.IGNORECASE)
+
+def sql_labels(sql):
+    labels = _sql_labels.get(sql)
+    if labels is None:
+        text = re.sub(r'/\*.*?\*/', '', sql).strip()
+        kind = text.split(None, 1)[0].upper() if text else ''
+        match = _SQL_TABLE.search(text) if kind in ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH') else None
+        labels = (('statement', kind), ('table', match.group(1) if match else ''))
+        if len(_sql_labels) < 10000:
+            _sql_labels[sql] = labels
+    return labels
+
+# Time every statement and log a sample of the slow ones (SLOW_QUERY_SECONDS, 0 disables)
+def _timed_statement(run, sql, params):
+    start = time.perf_counter()
+    try:
+        return run(sql, params)
+    except sqlite3.Error:
+        metrics.inc('bot_db_errors_total', sql_labels(sql))
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        metrics.observe('bot_db_statement_seconds', sql_labels(sql), elapsed)
+        if SLOW_QUERY_SECONDS and elapsed >= SLOW_QUERY_SECONDS and random.random() < SLOW_QUERY_SAMPLE:
+            log.warning("slow query", extra={'fields': {'sql': ' '.join(sql.split()), 'seconds': round(elapsed, 4)}})
+
+class InstrumentedCursor(sqlite3.Cursor):
+    def execute(self, sql, params=()):
+        return _timed_statement(super().execute, sql, params)
+
+    def executemany(self, sql, params):
+        return _timed_statement(super().executemany, sql, params)
+
+class InstrumentedConnection(sqlite3.Connection):
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+# Every Bot API call (both engines, polling included) goes through apihelper._make_request
+_make_api_request = telebot.apihelper._make_request
+
+def _timed_api_request(token, method_name, method='get', params=None, files=None):
+    start = time.perf_counter()
+    try:
+        return _make_api_request(token, method_name, method, params, files)
+    except telebot.apihelper.ApiTelegramException as e:
+        metrics.inc('bot_api_errors_total', (('method', method_name), ('code', str(e.error_code))))
+        raise
+    except Exception:
+        metrics.inc('bot_api_errors_total', (('method', method_name), ('code', 'network')))
+        raise
+    finally:
+        metrics.observe('bot_api_request_seconds', (('method', method_name),), time.perf_counter() - start)
+
+telebot.apihelper._make_request = _timed_api_request
+
 # State management
-user_states = {}
+# Conversation state per chat (which form the user is currently filling in).
+# Entries expire after their TTL, the least recently used ones are evicted past max_entries,
+# and with persist=True every change is written behind to the conversation_states table
+# through db_writer, so in-progress flows survive a restart. Safe to use from any thread.
+class StateStore:
+    def __init__(self, ttl=STATE_TTL, max_entries=STATE_MAX_ENTRIES, persist=STATE_PERSIST):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.persist = persist
+        self._entries = collections.OrderedDict()  # chat_id -> (state, expires_at), least recently used first
+        self._lock = threading.Lock()
+
+    def get(self, chat_id, default=None):
+        with self._lock:
+            entry = self._entries.get(chat_id)
+            if entry is None:
+                return default
+            state, expires_at = entry
+            if expires_at <= time.time():
+                del self._entries[chat_id]
+                self._forget(chat_id)
+                return default
+            self._entries.move_to_end(chat_id)
+            return state
+
+    def set(self, chat_id, state, ttl=None):
+        expires_at = time.time() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._entries[chat_id] = (state, expires_at)
+            self._entries.move_to_end(chat_id)
+            self._evict()
+        if self.persist:
+            db_writer.execute("INSERT INTO conversation_states (chat_id, state, expires_at) VALUES (?, ?, ?) "
+                              "ON CONFLICT(chat_id) DO UPDATE SET state = excluded.state, expires_at = excluded.expires_at",
+                              (chat_id, state, expires_at))
+
+    def __setitem__(self, chat_id, state):
+        self.set(chat_id, state)
+
+    def pop(self, chat_id, default=None):
+        with self._lock:
+            entry = self._entries.pop(chat_id, None)
+        if entry is None:
+            return default
+        self._forget(chat_id)
+        return entry[0] if entry[1] > time.time() else default
+
+    def __len__(self):
+        return len(self._entries)
+
+    # Reload unexpired states saved by a previous run
+    def load(self):
+        if not self.persist:
+            return
+        now = time.time()
+        # Startup-only scans of a table that holds at most max_entries rows
+        db_writer.execute("/* full scan */ DELETE FROM conversation_states WHERE expires_at <= ?", (now,))
+        conn, c = get_connection()
+        c.execute("/* full scan */ SELECT chat_id, state, expires_at FROM conversation_states WHERE expires_at > ? ORDER BY expires_at", (now,))
+        with self._lock:
+            for chat_id, state, expires_at in c.fetchall():
+                self._entries[chat_id] = (state, expires_at)
+            self._evict()
+
+    # Drop expired entries from the front and the least recently used ones beyond max_entries.
+    # Called with the lock held.
+    def _evict(self):
+        now = time.time()
+        while self._entries:
+            chat_id, (state, expires_at) = next(iter(self._entries.items()))
+            if expires_at > now and len(self._entries) <= self.max_entries:
+                break
+            del self._entries[chat_id]
+            self._forget(chat_id)
+
+    def _forget(self, chat_id):
+        if self.persist:
+            db_writer.execute("DELETE FROM conversation_states WHERE chat_id = ?", (chat_id,))
+
+user_states = StateStore()
 STATE_WAITING_FOR_EMAIL = 'waiting_for_email'
 STATE_WAITING_FOR_WALLET = 'waiting_for_wallet'
 STATE_WAITING_FOR_TWITTERUSERNAME = 'waiting_for_twitterusername'
 
-bot = telebot.TeleBot(BOT_TOKEN, parse_mode=None)
-
+# TeleBot that hands every polled update to update_workers instead of running telebot's
+# handler dispatch. With threaded=False the polling thread only fetches updates, and it
+# waits whenever the workers fall behind.
+class PooledTeleBot(telebot.TeleBot):
+    def process_new_updates(self, updates):
+        for update in updates:
+            if update.update_id > self.last_update_id:
+                self.last_update_id = update.update_id
+            update_workers.submit(update)
+
+if TELEGRAM_API_URL:
+    telebot.apihelper.API_URL = TELEGRAM_API_URL + '/bot{0}/{1}'
+    telebot.apihelper.FILE_URL = TELEGRAM_API_URL + '/file/bot{0}/{1}'
+bot = PooledTeleBot(BOT_TOKEN, parse_mode=None, threaded=False)
+
+# The bot's own user (getMe), fetched once and refreshed in the background every
+# refresh_interval seconds so a renamed bot is picked up without a restart.
+# Only the very first lookup waits on the network.
+class BotIdentity:
+    def __init__(self, refresh_interval=BOT_IDENTITY_REFRESH):
+        self.refresh_interval = refresh_interval
+        self._user = None
+        self._fetched_at = 0
+        self._refreshing = False
+        self._lock = threading.Lock()
+
+    def user(self):
+        with self._lock:
+            user = self._user
+            stale = time.monotonic() - self._fetched_at > self.refresh_interval
+            refresh = user is not None and stale and not self._refreshing
+            if refresh:
+                self._refreshing = True
+        if user is None:
+            return self.refresh()
+        if refresh:
+            threading.Thread(target=self._refresh_quietly, name='bot-identity', daemon=True).start()
+        return user
+
+    def username(self):
+        return self.user().username
+
+    def refresh(self):
+        user = bot.get_me()
+        with self._lock:
+            self._user = user
+            self._fetched_at = time.monotonic()
+        return user
+
+    def _refresh_quietly(self):
+        try:
+            self.refresh()
+        except Exception as e:
+            log.warning(f"Refreshing bot identity failed: {e}")
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+bot_identity = BotIdentity()
+
+LANE_INTERACTIVE = 0
+LANE_BULK = 1
+
+# Token bucket: `rate` tokens per second, holding at most `capacity`
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Seconds until a token is available (0 if one is available now)
+    def delay(self, now):
+        self._refill(now)
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def full(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+class _OutboundJob:
+    def __init__(self, method, args, kwargs, lane):
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.lane = lane
+        self.attempts = 0
+        self.future = concurrent.futures.Future()
+
+    @property
+    def is_action(self):
+        return self.method == 'send_chat_action'
+
+# Pending jobs of one chat, one deque per lane. At most one job per chat is in flight,
+# so replies to a chat are delivered in the order they were queued within a lane.
+class _ChatQueue:
+    def __init__(self, key, bucket):
+        self.key = key
+        self.bucket = bucket
+        self.lanes = (collections.deque(), collections.deque())
+        self.busy = False
+        self.queued = False
+        self.ticket = 0
+        self.paused_until = 0
+
+    def pending(self):
+        return len(self.lanes[LANE_INTERACTIVE]) + len(self.lanes[LANE_BULK])
+
+    def head(self):
+        return self.lanes[LANE_INTERACTIVE][0] if self.lanes[LANE_INTERACTIVE] else self.lanes[LANE_BULK][0]
+
+    def pop(self):
+        return self.lanes[LANE_INTERACTIVE].popleft() if self.lanes[LANE_INTERACTIVE] else self.lanes[LANE_BULK].popleft()
+
+# Outbound send scheduler. Handlers queue Bot API calls here and return at once; a dispatcher
+# thread hands them to SEND_WORKERS sender threads while keeping under Telegram's limits:
+# a global token bucket (SEND_GLOBAL_RATE/s) and one per chat (SEND_CHAT_RATE/s, bursts of
+# SEND_CHAT_BURST). Interactive replies always go ahead of bulk traffic (broadcasts).
+# A 429 puts the job back at the front of its chat and pauses that chat for retry_after
+# (and the whole bulk lane, if the job was bulk); network errors are retried with backoff.
+# A typing action is only worth sending when nothing else is about to be: it is held for
+# SEND_ACTION_WINDOW and dropped if a message for the same chat is queued meanwhile.
+# Every call returns a Future for the Bot API result; cancelling it withdraws a call that has
+# not been sent yet.
+class Outbox:
+    def __init__(self, workers=SEND_WORKERS, global_rate=SEND_GLOBAL_RATE, chat_rate=SEND_CHAT_RATE,
+                 chat_burst=SEND_CHAT_BURST, bulk_queue_size=SEND_BULK_QUEUE_SIZE):
+        self.workers = workers
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.bulk_queue_size = bulk_queue_size
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self._chats = {}
+        self._ready = (collections.deque(), collections.deque())  # (ticket, chat) per lane
+        self._timers = []  # heap of (ready_at, seq, ticket, chat)
+        self._seq = 0
+        self._bulk_pending = 0
+        self._bulk_paused_until = 0
+        self._in_flight = 0
+        self._stopping = False
+        self._last_prune = time.monotonic()
+        self._cond = threading.Condition()
+        self._executor = concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix='sender')
+        self._thread = threading.Thread(target=self._run, name='outbox', daemon=True)
+        self._thread.start()
+
+    # Queue bot.<method>(*args, **kwargs). chat_id selects the per-chat queue and rate limit;
+    # None sends without one (callback query answers). Bulk calls block while
+    # bulk_queue_size bulk jobs are already waiting.
+    def submit(self, method, chat_id, *args, lane=LANE_INTERACTIVE, **kwargs):
+        job = _OutboundJob(method, args, kwargs, lane)
+        with self._cond:
+            if lane == LANE_BULK:
+                while self._bulk_pending >= self.bulk_queue_size and not self._stopping:
+                    self._cond.wait()
+                self._bulk_pending += 1
+            if chat_id is None:
+                chat = _ChatQueue(None, None)
+            else:
+                chat = self._chats.get(chat_id)
+                if chat is None:
+                    chat = self._chats[chat_id] = _ChatQueue(chat_id, TokenBucket(self.chat_rate, self.chat_burst))
+            if job.is_action and chat.pending():
+                # Something is already on its way to this chat
+                self._finish_locked(job)
+                job.future.set_result(True)
+                return job.future
+            chat.lanes[lane].append(job)
+            if not job.is_action:
+                self._drop_actions(chat)
+            if not chat.busy:
+                self._schedule(chat, time.monotonic())
+            self._cond.notify_all()
+        return job.future
+
+    def send_message(self, chat_id, text, lane=LANE_INTERACTIVE, **kwargs):
+        return self.submit('send_message', chat_id, chat_id, text, lane=lane, **kwargs)
+
+    def send_photo(self, chat_id, photo, lane=LANE_INTERACTIVE, **kwargs):
+        return self.submit('send_photo', chat_id, chat_id, photo, lane=lane, **kwargs)
+
+    def send_document(self, chat_id, document, lane=LANE_INTERACTIVE, **kwargs):
+        return self.submit('send_document', chat_id, chat_id, document, lane=lane, **kwargs)
+
+    def send_chat_action(self, chat_id, action):
+        return self.submit('send_chat_action', chat_id, chat_id, action)
+
+    def edit_message_text(self, text, chat_id, message_id, **kwargs):
+        return self.submit('edit_message_text', chat_id, text, chat_id, message_id, **kwargs)
+
+    def reply_to(self, message, text, **kwargs):
+        return self.submit('reply_to', message.chat.id, message, text, **kwargs)
+
+    def answer_callback_query(self, callback_query_id, *args, **kwargs):
+        return self.submit('answer_callback_query', None, callback_query_id, *args, **kwargs)
+
+    def alive(self):
+        return self._thread.is_alive()
+
+    # Chats with sends waiting to go out (ready or held back by a rate limit)
+    def depth(self):
+        with self._cond:
+            return len(self._ready[0]) + len(self._ready[1]) + len(self._timers)
+
+    # Send everything still queued (up to timeout seconds) and stop the sender threads
+    def stop(self, timeout=SEND_DRAIN_TIMEOUT):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
+        self._executor.shutdown(wait=False)
+
+    # Pending typing actions are superseded by a message. Called with the lock held.
+    def _drop_actions(self, chat):
+        lane = chat.lanes[LANE_INTERACTIVE]
+        if not any(job.is_action for job in lane):
+            return
+        kept = [job for job in lane if not job.is_action]
+        for job in lane:
+            if job.is_action:
+                job.future.set_result(True)
+        lane.clear()
+        lane.extend(kept)
+
+    # Put a chat with pending jobs on the ready lanes or the timer heap. Called with the lock held.
+    def _schedule(self, chat, now):
+        if not chat.pending():
+            chat.queued = False
+            return
+        head = chat.head()
+        ready_at = chat.paused_until
+        if head.is_action:
+            ready_at = max(ready_at, now + SEND_ACTION_WINDOW)
+        elif chat.bucket is not None:
+            ready_at = max(ready_at, now + chat.bucket.delay(now))
+        chat.ticket += 1
+        chat.queued = True
+        if ready_at <= now:
+            self._ready[head.lane].append((chat.ticket, chat))
+        else:
+            self._seq += 1
+            heapq.heappush(self._timers, (ready_at, self._seq, chat.ticket, chat))
+
+    # Next chat whose head job may be sent now, highest priority lane first. Called with the lock held.
+    def _next_ready(self, now):
+        for lane in (LANE_INTERACTIVE, LANE_BULK):
+            if lane == LANE_BULK and now < self._bulk_paused_until:
+                continue
+            ready = self._ready[lane]
+            while ready:
+                ticket, chat = ready[0]
+                if chat.queued and chat.ticket == ticket and not chat.busy:
+                    return lane
+                ready.popleft()
+        return None
 
-# Function to create a new SQLite connection and cursor
+    def _finish_locked(self, job):
+        if job.lane == LANE_BULK:
+            self._bulk_pending -= 1
+            self._cond.notify_all()
+
+    def _run(self):
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                while self._timers and self._timers[0][0] <= now:
+                    ready_at, seq, ticket, chat = heapq.heappop(self._timers)
+                    if chat.queued and chat.ticket == ticket and not chat.busy:
+                        self._ready[chat.head().lane].append((ticket, chat))
+                timeout = self._timers[0][0] - now if self._timers else None
+                lane = self._next_ready(now) if self._in_flight < self.workers else None
+                if lane is not None:
+                    wait = self.global_bucket.delay(now)
+                    if wait == 0:
+                        ticket, chat = self._ready[lane].popleft()
+                        job = chat.pop()
+                        chat.queued = False
+                        # A retried job's future is already running
+                        if job.attempts == 0 and not job.future.set_running_or_notify_cancel():
+                            # Withdrawn by the caller (a stopped broadcast) before it was sent
+                            self._finish_locked(job)
+                            self._schedule(chat, now)
+                            continue
+                        chat.busy = True
+                        self.global_bucket.take(now)
+                        if chat.bucket is not None and not job.is_action:
+                            chat.bucket.take(now)
+                        self._in_flight += 1
+                        self._executor.submit(self._send, chat, job)
+                        continue
+                    timeout = wait if timeout is None else min(timeout, wait)
+                elif self._ready[LANE_BULK] and now < self._bulk_paused_until and self._in_flight < self.workers:
+                    wait = self._bulk_paused_until - now
+                    timeout = wait if timeout is None else min(timeout, wait)
+                if self._stopping and not self._timers and not self._ready[0] and not self._ready[1] and not self._in_flight:
+                    return
+                if now - self._last_prune > 60:
+                    self._prune(now)
+                self._cond.wait(timeout if timeout is None else max(timeout, 0.001))
+
+    # Forget idle chats whose rate limit has fully recovered. Called with the lock held.
+    def _prune(self, now):
+        self._last_prune = now
+        for key in [key for key, chat in self._chats.items()
+                    if not chat.busy and not chat.pending() and chat.bucket.full(now)]:
+            del self._chats[key]
+
+    def _send(self, chat, job):
+        retry_after = None
+        result = error = None
+        try:
+            result = getattr(bot, job.method)(*job.args, **job.kwargs)
+        except telebot.apihelper.ApiTelegramException as e:
+            if e.error_code == 429:
+                retry_after = (e.result_json.get('parameters') or {}).get('retry_after', 1)
+            error = e
+        except requests.exceptions.RequestException as e:
+            retry_after = min(2 ** job.attempts, 30)
+            error = e
+        except Exception as e:
+            error = e
+        job.attempts += 1
+        retry = retry_after is not None and job.attempts <= SEND_MAX_RETRIES
+        with self._cond:
+            now = time.monotonic()
+            self._in_flight -= 1
+            chat.busy = False
+            if retry:
+                for value in list(job.args) + list(job.kwargs.values()):
+                    if hasattr(value, 'seek'):
+                        value.seek(0)
+                chat.lanes[job.lane].appendleft(job)
+                chat.paused_until = now + retry_after
+                if job.lane == LANE_BULK:
+                    self._bulk_paused_until = max(self._bulk_paused_until, now + retry_after)
+            else:
+                self._finish_locked(job)
+            self._schedule(chat, now)
+            self._cond.notify_all()
+        if retry:
+            return
+        if error is None:
+            job.future.set_result(result)
+        else:
+            if job.lane == LANE_INTERACTIVE:
+                log.warning(f"Sending {job.method} to {chat.key} failed: {error}")
+            job.future.set_exception(error)
+
+outbox = Outbox()
+metrics.gauge('bot_outbox_chats_waiting', 'Chats with outbound calls waiting to be sent', outbox.depth)
+metrics.gauge('bot_outbox_in_flight', 'Outbound calls being sent', lambda: outbox._in_flight)
+
+LOGO_URL = 'https://www.fifareward.io/fifarewardlogo.png'
+# Bad Request descriptions meaning a file_id itself was refused
+FILE_ID_ERRORS = re.compile(r'wrong (remote )?file identifier|file_id|file reference', re.IGNORECASE)
+
+# Telegram file_ids for media we send by URL, persisted in media_files. The first send of a
+# source goes out by URL (Telegram fetches it) and the file_id from the response is kept;
+# later sends reuse it, so Telegram neither downloads the file again nor depends on the web
+# host being up. A file_id Telegram refuses is forgotten and the send retried by URL.
+class MediaCache:
+    def __init__(self):
+        self._file_ids = {}
+        self._lock = threading.Lock()
+
+    def load(self):
+        conn, c = get_connection()
+        c.execute("SELECT source, file_id FROM media_files")
+        with self._lock:
+            self._file_ids.update(c.fetchall())
+
+    def file_id(self, source):
+        with self._lock:
+            return self._file_ids.get(source)
+
+    def remember(self, source, file_id):
+        with self._lock:
+            if self._file_ids.get(source) == file_id:
+                return
+            self._file_ids[source] = file_id
+        db_writer.execute('''INSERT INTO media_files (source, file_id, updated_at) VALUES (?, ?, ?)
+                          ON CONFLICT(source) DO UPDATE SET file_id = excluded.file_id, updated_at = excluded.updated_at''',
+                          (source, file_id, time.time()))
+
+    def forget(self, source):
+        with self._lock:
+            if self._file_ids.pop(source, None) is None:
+                return
+        db_writer.execute("DELETE FROM media_files WHERE source = ?", (source,))
+
+    # outbox.send_photo for a photo URL; the returned Future resolves to the final result
+    def send_photo(self, chat_id, source, **kwargs):
+        result = concurrent.futures.Future()
+        self._send_photo(result, chat_id, source, self.file_id(source), kwargs)
+        return result
+
+    def _send_photo(self, result, chat_id, source, file_id, kwargs):
+        def done(future):
+            try:
+                message = future.result()
+            except Exception as e:
+                # Only a refused file_id is retried by URL. Other 400s (e.g. a caption that
+                # doesn't parse) would fail the same way and say nothing about the cached id.
+                rejected = (isinstance(e, telebot.apihelper.ApiTelegramException) and e.error_code == 400
+                            and FILE_ID_ERRORS.search(e.description or ''))
+                if file_id is not None and rejected:
+                    self.forget(source)
+                    self._send_photo(result, chat_id, source, None, kwargs)
+                else:
+                    result.set_exception(e)
+                return
+            if message.photo:
+                self.remember(source, message.photo[-1].file_id)
+            result.set_result(message)
+        outbox.send_photo(chat_id, file_id or source, **kwargs).add_done_callback(done)
+
+media_cache = MediaCache()
+
+# Update router: each update is dispatched with a dict lookup instead of running every
+# handler's filter in turn, so dispatch cost does not grow with the number of handlers.
+# Callbacks are routed by exact callback_data, then by the prefix before the first '_'
+# (download_<kind>_csv, allrefs_<dir>_<id>). Text messages go to the handler for the chat's
+# conversation state first (a pending form takes the next message), then to the /command
+# handler, then to the default handler.
+class Router:
+    def __init__(self):
+        self.callbacks = {}
+        self.callback_prefixes = {}
+        self.commands = {}
+        self.states = {}
+        self.default_message_handler = None
+
+    def callback(self, *data):
+        def register(handler):
+            for value in data:
+                self.callbacks[value] = handler
+            return handler
+        return register
+
+    def callback_prefix(self, prefix):
+        def register(handler):
+            self.callback_prefixes[prefix] = handler
+            return handler
+        return register
+
+    def command(self, *names):
+        def register(handler):
+            for name in names:
+                self.commands[name] = handler
+            return handler
+        return register
+
+    def state(self, state):
+        def register(handler):
+            self.states[state] = handler
+            return handler
+        return register
+
+    def default_message(self, handler):
+        self.default_message_handler = handler
+        return handler
+
+    # Handler for a text message, or None
+    def message_handler(self, message):
+        state = user_states.get(message.chat.id)
+        if state is not None and state in self.states:
+            return self.states[state]
+        text = message.text or ''
+        if text.startswith('/'):
+            command = text.split(maxsplit=1)[0][1:].split('@', 1)[0]
+            if command in self.commands:
+                return self.commands[command]
+        return self.default_message_handler
+
+    # Handler for a callback query, or None
+    def callback_handler(self, call):
+        data = call.data or ''
+        handler = self.callbacks.get(data)
+        if handler is None:
+            prefix, separator, rest = data.partition('_')
+            if separator:
+                handler = self.callback_prefixes.get(prefix)
+        return handler
+
+    # (handler, argument) for a telebot Update; only text messages and callback queries are
+    # handled, anything else gives (None, None)
+    def resolve(self, update):
+        if update.message is not None and update.message.text is not None:
+            return self.message_handler(update.message), update.message
+        if update.callback_query is not None:
+            return self.callback_handler(update.callback_query), update.callback_query
+        return None, None
+
+    # Dispatch a telebot Update on the calling thread
+    def dispatch_update(self, update):
+        handler, arg = self.resolve(update)
+        if handler is not None:
+            self.run(handler, arg)
+
+    def run(self, handler, arg):
+        labels = (('handler', handler.__name__),)
+        start = time.perf_counter()
+        try:
+            steps = handler(arg)
+            if inspect.isgenerator(steps):
+                run_steps(steps)
+        except Exception:
+            metrics.inc('bot_handler_errors_total', labels)
+            raise
+        finally:
+            metrics.observe('bot_handler_seconds', labels, time.perf_counter() - start)
+
+    # run() as a task on the asyncio engine's event loop, for handlers marked @nonblocking
+    async def run_async(self, handler, arg):
+        labels = (('handler', handler.__name__),)
+        start = time.perf_counter()
+        try:
+            steps = handler(arg)
+            if inspect.isgenerator(steps):
+                await run_steps_async(steps)
+        except Exception:
+            metrics.inc('bot_handler_errors_total', labels)
+            raise
+        finally:
+            metrics.observe('bot_handler_seconds', labels, time.perf_counter() - start)
+
+# A handler that has to wait for a write is a generator: `result = yield future` hands the
+# Future to whatever runs the handler and resumes with its result (or raises its exception).
+# On a worker thread that is future.result(). On the asyncio engine the handler runs on the
+# event loop and other updates are handled while it waits.
+def run_steps(steps):
+    send, value = steps.send, None
+    while True:
+        try:
+            future = send(value)
+        except StopIteration:
+            return
+        try:
+            send, value = steps.send, future.result()
+        except Exception as e:
+            send, value = steps.throw, e
+
+async def run_steps_async(steps):
+    send, value = steps.send, None
+    while True:
+        try:
+            future = send(value)
+        except StopIteration:
+            return
+        try:
+            send, value = steps.send, await asyncio.wrap_future(future)
+        except Exception as e:
+            send, value = steps.throw, e
+
+# Mark a handler as safe to run on the asyncio engine's event loop: it only makes quick
+# indexed reads, queues sends on the outbox, and waits for writes by yielding their Futures.
+# Other handlers run on a thread there, so one that blocks can't stall the loop.
+def nonblocking(handler):
+    handler.nonblocking = True
+    return handler
+
+router = Router()
+
+# Update workers: every update is handled on one of `workers` threads, picked by its chat id,
+# so the updates of one chat are handled strictly in arrival order (a Wallet tap and the
+# address typed right after it can no longer race over user_states) while different chats
+# run in parallel. Each worker has a bounded queue; submit() blocks when the chat's worker is
+# queue_size updates behind, which slows intake down instead of piling up memory.
+class UpdateWorkers:
+    def __init__(self, workers=UPDATE_WORKERS, queue_size=UPDATE_QUEUE_SIZE):
+        self.queues = [queue.Queue(queue_size) for i in range(workers)]
+        self._threads = [threading.Thread(target=self._work, args=(q,), name=f'update-worker-{i}', daemon=True)
+                         for i, q in enumerate(self.queues)]
+        for thread in self._threads:
+            thread.start()
+
+    @staticmethod
+    def chat_id(update):
+        if update.message is not None:
+            return update.message.chat.id
+        if update.callback_query is not None:
+            call = update.callback_query
+            return call.message.chat.id if call.message is not None else call.from_user.id
+        return update.update_id
+
+    # Queue a telebot Update for its chat's worker. Returns a Future that resolves once the
+    # update has been handled, or None if block=False and the worker's queue is full.
+    def submit(self, update, block=True, timeout=None):
+        future = concurrent.futures.Future()
+        try:
+            self.queues[self.chat_id(update) % len(self.queues)].put((update, future), block, timeout)
+        except queue.Full:
+            return None
+        return future
+
+    def depth(self):
+        return sum(q.qsize() for q in self.queues)
+
+    def alive(self):
+        return all(thread.is_alive() for thread in self._threads)
+
+    # Let the workers finish what is queued (for up to timeout seconds in all), then stop them
+    def stop(self, timeout=SEND_DRAIN_TIMEOUT):
+        deadline = time.monotonic() + timeout
+        for q in self.queues:
+            try:
+                q.put(None, timeout=max(deadline - time.monotonic(), 0))
+            except queue.Full:
+                pass  # out of time; the daemon worker goes down with the process
+        for thread in self._threads:
+            thread.join(max(deadline - time.monotonic(), 0))
+
+    def _work(self, updates):
+        while True:
+            item = updates.get()
+            if item is None:
+                return
+            update, future = item
+            if not update_ledger.begin(update.update_id):
+                future.set_result(None)
+                continue
+            try:
+                router.dispatch_update(update)
+                future.set_result(None)
+            except Exception as e:
+                log.exception(f"Error handling update {update.update_id}: {e}")
+                future.set_exception(e)
+            finally:
+                update_ledger.done(update.update_id)
+
+update_workers = UpdateWorkers()
+metrics.gauge('bot_update_queue_depth', 'Updates waiting for a worker', update_workers.depth)
+
+# Processed-update ledger. Telegram delivers updates at least once: a crash before the polling
+# offset moves on, or a webhook retry, hands the same update_id over again. Workers check the
+# in-memory window of the last `window` update ids before dispatching and skip repeats; every
+# handled update is then recorded in processed_updates (written behind through db_writer).
+# Writes that must happen exactly once also claim the update id inside their own writer
+# transaction with claim_update(), so they are skipped even when the window has forgotten
+# the id, e.g. after a restart. The window is reloaded from processed_updates at startup.
+class UpdateLedger:
+    def __init__(self, window=UPDATE_LEDGER_WINDOW):
+        self.window = window
+        self._ids = set()
+        self._order = collections.deque()
+        self._lock = threading.Lock()
+        # Per thread, and per task on the asyncio engine
+        self._current = contextvars.ContextVar('update_id', default=None)
+
+    def load(self):
+        conn, c = get_connection()
+        c.execute("SELECT update_id FROM processed_updates ORDER BY update_id DESC LIMIT ?", (self.window,))
+        with self._lock:
+            for (update_id,) in reversed(c.fetchall()):
+                self._remember(update_id)
+
+    # Called before dispatching an update: False if it has already been handled
+    def begin(self, update_id):
+        with self._lock:
+            if update_id in self._ids:
+                return False
+            self._remember(update_id)
+        self._current.set(update_id)
+        return True
+
+    def done(self, update_id):
+        self._current.set(None)
+        db_writer.submit(_record_update, update_id)
+
+    # Id of the update being handled by the calling worker thread (or asyncio task), if any
+    def current(self):
+        return self._current.get()
+
+    # Called with the lock held
+    def _remember(self, update_id):
+        self._ids.add(update_id)
+        self._order.append(update_id)
+        while len(self._order) > self.window:
+            self._ids.discard(self._order.popleft())
+
+# Called inside a write intent: record update_id as processed. Returns False if it already
+# was, in which case the intent must skip its side effects. update_id None (not handling an
+# update) always proceeds.
+def claim_update(c, update_id):
+    if update_id is None:
+        return True
+    c.execute("INSERT INTO processed_updates (update_id, processed_at) VALUES (?, ?) ON CONFLICT(update_id) DO NOTHING",
+              (update_id, time.time()))
+    return c.rowcount == 1
+
+_ledger_records = 0
+
+def _record_update(c, update_id):
+    global _ledger_records
+    claim_update(c, update_id)
+    _ledger_records += 1
+    if _ledger_records % UPDATE_LEDGER_PRUNE_EVERY == 0:
+        # Telegram never redelivers anything this old
+        c.execute("DELETE FROM processed_updates WHERE update_id < ?", (update_id - UPDATE_LEDGER_KEEP,))
+
+update_ledger = UpdateLedger()
+
+
+# Long-lived SQLite connections, one per worker thread
+_db_local = threading.local()
+_db_connections = []
+_db_connections_lock = threading.Lock()
+
+# Function to open a tuned SQLite connection (WAL, relaxed fsync, big page cache, mmap reads)
+def open_connection():
+    conn = sqlite3.connect(DB_PATH, timeout=DB_BUSY_TIMEOUT, check_same_thread=False,
+                           cached_statements=DB_STATEMENT_CACHE_SIZE, factory=InstrumentedConnection)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute(f'PRAGMA cache_size=-{DB_CACHE_SIZE_KB}')
+    conn.execute(f'PRAGMA mmap_size={DB_MMAP_SIZE}')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    with _db_connections_lock:
+        _db_connections.append(conn)
+    return conn
+
+# Function to get the calling thread's SQLite connection and a fresh cursor
+# The connection is reused for the lifetime of the thread, so callers must not close it
 def get_connection():
-    conn = sqlite3.connect('referrals.db')
+    conn = getattr(_db_local, 'conn', None)
+    if conn is None:
+        conn = open_connection()
+        _db_local.conn = conn
+    elif conn.in_transaction:
+        # A previous handler on this thread failed between execute() and commit();
+        # don't let its half-done write hold the database lock
+        conn.rollback()
     return conn, conn.cursor()
 
-# Create tables if not exists
-def create_tables():
-    conn, c = get_connection()
-    c.execute('''CREATE TABLE IF NOT EXISTS referrals
-             (chat_id INTEGER PRIMARY KEY, referral_link TEXT, count INTEGER, upline_id INTEGER, username TEXT)''')
-    # Ensure the upline_id column exists (SQLite does not support ALTER TABLE to add a column if it exists, so we need to check manually)
-    c.execute("PRAGMA table_info(referrals)")
-    columns = [column[1] for column in c.fetchall()]
-    if 'upline_id' not in columns:
-        c.execute("ALTER TABLE referrals ADD COLUMN upline_id INTEGER")
-    if 'username' not in columns:
-        c.execute("ALTER TABLE referrals ADD COLUMN username INTEGER")
-    c.execute('''CREATE TABLE IF NOT EXISTS bot_replies
-                 (message_id INTEGER PRIMARY KEY, reply_text TEXT)''')
-    c.execute('''CREATE TABLE IF NOT EXISTS bep20_addresses
-                 (chat_id INTEGER PRIMARY KEY, bep20_address TEXT)''')
-    c.execute('''CREATE TABLE IF NOT EXISTS email_address
-                 (chat_id INTEGER PRIMARY KEY, email_address TEXT)''')
-    c.execute('''CREATE TABLE IF NOT EXISTS twitterusernames
-              (chat_id INTEGER PRIMARY KEY, twitter_username TEXT)''')
-    c.execute('''CREATE TABLE IF NOT EXISTS telegramusernames
-              (chat_id INTEGER PRIMARY KEY, telegram_username, firstname TEXT)''')
-    c.execute("PRAGMA table_info(telegramusernames)")
-    columns = [column[1] for column in c.fetchall()]
-    if 'firstname' not in columns:
-        c.execute("ALTER TABLE telegramusernames ADD COLUMN firstname INTEGER")
-        
-    conn.commit()
+# Close a connection opened with open_connection() and forget it
+def release_connection(conn):
+    with _db_connections_lock:
+        if conn in _db_connections:
+            _db_connections.remove(conn)
     conn.close()
 
-# Clear the database
-def clear_database():
+# Close every pooled connection (called on shutdown)
+def close_connections():
+    with _db_connections_lock:
+        connections = list(_db_connections)
+        _db_connections.clear()
+    for conn in connections:
+        try:
+            if conn.in_transaction:
+                conn.commit()
+            conn.close()
+        except sqlite3.Error as e:
+            log.error(f"Error closing database connection: {e}")
+    _db_local.conn = None
+
+# Write intent that runs a single statement and reports how many rows it touched
+def _execute_write(c, sql, params):
+    c.execute(sql, params)
+    return c.rowcount
+
+# Single writer thread for every INSERT/UPDATE/DELETE.
+# Callers queue write intents and get a Future back; the writer drains the queue and
+# commits whole batches (up to batch_size intents or batch_window seconds) in one
+# transaction, so there is only ever one SQLite writer and one fsync per batch.
+# Each intent runs inside its own savepoint, so a failing intent only fails its own Future.
+class DatabaseWriter:
+    def __init__(self, batch_size=DB_WRITE_BATCH_SIZE, batch_window=DB_WRITE_BATCH_WINDOW):
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.queue = queue.Queue()
+        # Number of committed batches
+        self.commit_seq = 0
+        self._intent_callbacks = []
+        self._thread = threading.Thread(target=self._run, name='db-writer', daemon=True)
+        self._thread.start()
+
+    # Queue fn(cursor, *args) to run inside the writer's transaction
+    def submit(self, fn, *args):
+        future = concurrent.futures.Future()
+        self.queue.put((fn, args, future))
+        return future
+
+    # Queue a single statement; the Future resolves to its rowcount once committed
+    def execute(self, sql, params=()):
+        return self.submit(_execute_write, sql, params)
+
+    # Called from inside a write intent: run callback(commit_seq) on the writer thread once
+    # the intent's batch has committed. Dropped if the intent fails.
+    def after_commit(self, callback):
+        self._intent_callbacks.append(callback)
+
+    # Block until everything queued so far has been committed
+    def flush(self, timeout=None):
+        self.submit(lambda c: None).result(timeout)
+
+    # Commit whatever is still queued and stop the writer thread
+    def stop(self, timeout=None):
+        self.queue.put(None)
+        self._thread.join(timeout)
+
+    def alive(self):
+        return self._thread.is_alive()
+
+    def _run(self):
+        conn = open_connection()
+        conn.isolation_level = None  # transactions are managed explicitly below
+        stopping = False
+        while not stopping:
+            item = self.queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.batch_window
+            while len(batch) < self.batch_size:
+                try:
+                    item = self.queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._commit_batch(conn, batch)
+        release_connection(conn)
+
+    def _commit_batch(self, conn, batch):
+        c = conn.cursor()
+        outcomes = []
+        callbacks = []
+        try:
+            c.execute('BEGIN IMMEDIATE')
+            for fn, args, future in batch:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                self._intent_callbacks = []
+                c.execute('SAVEPOINT write_intent')
+                try:
+                    result = fn(c, *args)
+                except Exception as e:
+                    c.execute('ROLLBACK TO write_intent')
+                    c.execute('RELEASE write_intent')
+                    outcomes.append((future, e, False))
+                else:
+                    c.execute('RELEASE write_intent')
+                    outcomes.append((future, result, True))
+                    callbacks.extend(self._intent_callbacks)
+            c.execute('COMMIT')
+            self.commit_seq += 1
+            seq = self.commit_seq
+        except Exception as e:
+            log.error(f"Database write batch failed: {e}")
+            if conn.in_transaction:
+                conn.rollback()
+            # Fail every intent of the batch, including those not reached yet (e.g. BEGIN was
+            # refused): callers block on their Futures
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for callback in callbacks:
+            try:
+                callback(seq)
+            except Exception as e:
+                log.exception(f"After-commit callback failed: {e}")
+        for future, value, ok in outcomes:
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+
+db_writer = DatabaseWriter()
+metrics.gauge('bot_db_write_queue_depth', 'Write intents waiting for the writer thread', db_writer.queue.qsize)
+
+# Per-attribute tables from before the users table, migrated by migrate_users() and then kept
+# as compatibility views. For each: legacy column -> users column expression ({row} is the
+# row prefix), users columns where an existing value wins, what a delete clears, which legacy
+# rows have to show up in the view and which users rows the view shows.
+LEGACY_USER_TABLES = {
+    'referrals': {
+        'columns': {'referral_link': "IFNULL({row}referral_link, '')", 'count': '{row}count',
+                    'upline_id': '{row}upline_id', 'username': '{row}username'},
+        'keep': (),
+        'clear': "referral_link = NULL, count = NULL, upline_id = NULL",
+        'legacy_member': "true",
+        'member': "referral_link IS NOT NULL",
+        'view': '''CREATE VIEW IF NOT EXISTS referrals AS
+                   SELECT chat_id, referral_link, count, upline_id, username FROM users
+                   WHERE referral_link IS NOT NULL''',
+    },
+    'bep20_addresses': {
+        'columns': {'bep20_address': '{row}bep20_address'},
+        'keep': (),
+        'clear': "bep20_address = NULL",
+        'legacy_member': "bep20_address IS NOT NULL",
+        'member': "bep20_address IS NOT NULL",
+        'view': '''CREATE VIEW IF NOT EXISTS bep20_addresses AS
+                   SELECT chat_id, bep20_address FROM users WHERE bep20_address IS NOT NULL''',
+    },
+    'email_address': {
+        'columns': {'email_address': '{row}email_address'},
+        'keep': (),
+        'clear': "email_address = NULL",
+        'legacy_member': "email_address IS NOT NULL",
+        'member': "email_address IS NOT NULL",
+        'view': '''CREATE VIEW IF NOT EXISTS email_address AS
+                   SELECT chat_id, email_address FROM users WHERE email_address IS NOT NULL''',
+    },
+    'twitterusernames': {
+        'columns': {'twitter_username': '{row}twitter_username'},
+        'keep': (),
+        'clear': "twitter_username = NULL",
+        'legacy_member': "twitter_username IS NOT NULL",
+        'member': "twitter_username IS NOT NULL",
+        'view': '''CREATE VIEW IF NOT EXISTS twitterusernames AS
+                   SELECT chat_id, twitter_username FROM users WHERE twitter_username IS NOT NULL''',
+    },
+    'telegramusernames': {
+        'columns': {'username': '{row}telegram_username', 'firstname': '{row}firstname', 'telegram_listed': '1'},
+        'keep': ('username',),
+        'clear': "telegram_listed = 0",
+        'legacy_member': "true",
+        'member': "telegram_listed = 1",
+        'view': '''CREATE VIEW IF NOT EXISTS telegramusernames AS
+                   SELECT chat_id, username AS telegram_username, firstname FROM users WHERE telegram_listed = 1''',
+    },
+}
+
+# Columns that older versions added with ALTER TABLE and may be missing from a legacy table
+LEGACY_ADDED_COLUMNS = {
+    'referrals': {'upline_id': 'INTEGER', 'username': 'TEXT'},
+    'telegramusernames': {'firstname': 'TEXT'},
+}
+
+# Schema migrations, keyed on PRAGMA user_version (the last version applied). Each entry is
+# (version, fn, online). A regular migration is fn(cursor) and runs in one writer transaction
+# together with the version bump, so it is applied completely or not at all. An online
+# migration is fn() and drives its own batched writer transactions, so a big backfill never
+# holds the write lock for long; it has to be safe to run again after an interrupted start,
+# and the version is bumped once it finishes. Append new migrations; never edit a released one.
+def _schema_tables(c):
+    # One row per user. A user is in the referral program once referral_link is set;
+    # telegram_listed marks users who joined through an upline's link.
+    c.execute('''CREATE TABLE IF NOT EXISTS users
+              (chat_id INTEGER PRIMARY KEY, referral_link TEXT, count INTEGER, upline_id INTEGER,
+               username TEXT, firstname TEXT, telegram_listed INTEGER NOT NULL DEFAULT 0,
+               bep20_address TEXT, email_address TEXT, twitter_username TEXT)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS bot_replies
+                 (message_id INTEGER PRIMARY KEY, reply_text TEXT)''')
+    # Referral graph: closure table of (ancestor, descendant, depth) up to REFERRAL_MAX_DEPTH,
+    # plus per-ancestor totals for each depth
+    c.execute('''CREATE TABLE IF NOT EXISTS referral_paths
+              (ancestor_id INTEGER NOT NULL, descendant_id INTEGER NOT NULL, depth INTEGER NOT NULL,
+               PRIMARY KEY (ancestor_id, depth, descendant_id)) WITHOUT ROWID''')
+    c.execute('''CREATE TABLE IF NOT EXISTS referral_level_counts
+              (ancestor_id INTEGER NOT NULL, depth INTEGER NOT NULL, total INTEGER NOT NULL,
+               PRIMARY KEY (ancestor_id, depth)) WITHOUT ROWID''')
+    c.execute('''CREATE TABLE IF NOT EXISTS conversation_states
+              (chat_id INTEGER PRIMARY KEY, state TEXT NOT NULL, expires_at REAL NOT NULL)''')
+    # Leaderboard: number of users per referral count, kept current by triggers on users
+    c.execute('''CREATE TABLE IF NOT EXISTS referral_count_histogram
+              (count INTEGER PRIMARY KEY, users INTEGER NOT NULL)''')
+    # Broadcasts: last_chat_id is the resume checkpoint (every recipient up to it has been handled)
+    c.execute('''CREATE TABLE IF NOT EXISTS broadcasts
+              (id INTEGER PRIMARY KEY, text TEXT NOT NULL, admin_chat_id INTEGER, status TEXT NOT NULL,
+               last_chat_id INTEGER NOT NULL, sent INTEGER NOT NULL, failed INTEGER NOT NULL,
+               started_at REAL, finished_at REAL)''')
+    # Telegram file_ids of media sent by URL (see MediaCache)
+    c.execute('''CREATE TABLE IF NOT EXISTS media_files
+              (source TEXT PRIMARY KEY, file_id TEXT NOT NULL, updated_at REAL)''')
+    # Update ids already handled (see UpdateLedger)
+    c.execute('''CREATE TABLE IF NOT EXISTS processed_updates
+              (update_id INTEGER PRIMARY KEY, processed_at REAL NOT NULL)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS undeliverable_chats
+              (chat_id INTEGER PRIMARY KEY, error_code INTEGER, description TEXT, failed_at REAL)''')
+    create_indexes(c)
+
+# Per-attribute tables of older versions into users (online, see migrate_users)
+def _schema_users():
     conn, c = get_connection()
-    c.execute('DELETE FROM email_address')
-    print(f"Deleted {c.rowcount} records from email_address")
-    c.execute('DELETE FROM referrals')
-    print(f"Deleted {c.rowcount} records from referrals")
-    c.execute('DELETE FROM bep20_addresses')
-    print(f"Deleted {c.rowcount} records from bep20_addresses")
-    c.execute('DELETE FROM telegramusernames')
-    print(f"Deleted {c.rowcount} records from telegramusernames")
-    c.execute('DELETE FROM twitterusernames')
-    print(f"Deleted {c.rowcount} records from twitterusernames")
-    conn.commit()
-    conn.close()
-
-# Function to generate a CSV file from bep20_addresses table
-def generate_bep20_csv():
-    # Create a temporary file to store the CSV data
-    temp_file = tempfile.NamedTemporaryFile(mode='w', delete=False, newline='', suffix='.csv')
-    temp_file_path = temp_file.name
-
-    # Retrieve data from bep20_addresses table
+    legacy = legacy_user_tables(c)
+    if legacy:
+        migrate_users(legacy)
+
+def _schema_views(c):
+    for spec in LEGACY_USER_TABLES.values():
+        c.execute(spec['view'])
+    create_rank_triggers(c)
+    c.execute("SELECT 1 FROM referral_count_histogram LIMIT 1")
+    if c.fetchone() is None:
+        rebuild_count_histogram(c)
+
+# Referral graph for data from before it existed (online, see backfill_referral_graph)
+def _schema_referral_graph():
     conn, c = get_connection()
-    c.execute("SELECT chat_id, bep20_address FROM bep20_addresses")
-    data = c.fetchall()
-    conn.close()
-
-    # Write data to the CSV file
-    with open(temp_file_path, 'w', newline='') as file:
-        writer = csv.writer(file)
-        writer.writerow(['Chat ID', 'BEP20 Address'])
-        writer.writerows(data)
-
-    return temp_file_path
-
-# Function to generate a CSV file from email_address table
-def generate_email_csv():
-    # Create a temporary file to store the CSV data
-    temp_file = tempfile.NamedTemporaryFile(mode='w', delete=False, newline='', suffix='.csv')
-    temp_file_path = temp_file.name
-
-    # Retrieve data from email_address table
+    c.execute("SELECT 1 FROM referral_paths LIMIT 1")
+    has_paths = c.fetchone() is not None
+    c.execute("SELECT 1 FROM users WHERE upline_id IS NOT NULL AND referral_link IS NOT NULL LIMIT 1")
+    if c.fetchone() is not None and not has_paths:
+        backfill_referral_graph()
+
+# Change counters for the cached CSV exports (see ExportSnapshot), one per exported view
+def _schema_export_versions(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS export_versions
+              (name TEXT PRIMARY KEY, version INTEGER NOT NULL) WITHOUT ROWID''')
+    c.executemany("INSERT OR IGNORE INTO export_versions (name, version) VALUES (?, 0)",
+                  [(name,) for name in EXPORT_VERSION_COLUMNS])
+    create_export_triggers(c)
+
+# Recipients of a running broadcast whose send has finished, so a resume skips them even when
+# they lie past the broadcast's checkpoint
+def _schema_broadcast_deliveries(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS broadcast_deliveries
+              (broadcast_id INTEGER NOT NULL, chat_id INTEGER NOT NULL, sent INTEGER NOT NULL,
+               PRIMARY KEY (broadcast_id, chat_id)) WITHOUT ROWID''')
+
+MIGRATIONS = [
+    (1, _schema_tables, False),
+    (2, _schema_users, True),
+    (3, _schema_views, False),
+    (4, _schema_referral_graph, True),
+    (5, _schema_export_versions, False),
+    (6, _schema_broadcast_deliveries, False),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+# Bring the database up to SCHEMA_VERSION. When it is already there (every start but the first
+# after an upgrade) this is two reads, the version and the deferred-index check: no DDL and
+# no write lock.
+def migrate():
     conn, c = get_connection()
-    c.execute("SELECT chat_id, email_address FROM email_address")
-    data = c.fetchall()
-    conn.close()
-
-    # Write data to the CSV file
-    with open(temp_file_path, 'w', newline='') as file:
-        writer = csv.writer(file)
-        writer.writerow(['Chat ID', 'Email Address'])
-        writer.writerows(data)
-
-    return temp_file_path
-
-# Function to generate a CSV file from referrals table
-def generate_referrals_csv():
-    # Create a temporary file to store the CSV data
-    temp_file = tempfile.NamedTemporaryFile(mode='w', delete=False, newline='', suffix='.csv')
-    temp_file_path = temp_file.name
-
-    # Retrieve data from referrals table
+    c.execute('PRAGMA user_version')
+    version = c.fetchone()[0]
+    if version == SCHEMA_VERSION:
+        restore_deferred_indexes()
+        return
+    if version > SCHEMA_VERSION:
+        raise RuntimeError(f"Database schema version {version} is newer than this bot's ({SCHEMA_VERSION})")
+    for target, fn, online in MIGRATIONS:
+        if target <= version:
+            continue
+        started = time.monotonic()
+        if online:
+            fn()
+        # Another instance starting at the same time may have got there first
+        applied = db_writer.submit(_apply_migration, target, None if online else fn).result()
+        if applied:
+            log.info(f"Applied schema migration {target} ({fn.__name__})",
+                     extra={'fields': {'seconds': round(time.monotonic() - started, 3)}})
+    restore_deferred_indexes()
+
+# Recreate the users indexes and rank triggers if a bulk import was killed before it put them back
+def restore_deferred_indexes():
     conn, c = get_connection()
-    c.execute("SELECT chat_id, referral_link, count, upline_id, username FROM referrals")
-    data = c.fetchall()
-    conn.close()
-
-    # Write data to the CSV file
-    with open(temp_file_path, 'w', newline='') as file:
-        writer = csv.writer(file)
-        writer.writerow(['Chat ID', 'Referral Link', 'Count', 'Upline ID', 'Username'])
-        writer.writerows(data)
-
-    return temp_file_path
-
-# Function to generate a CSV file from twitterusername table
-def generate_twitterusernames_csv():
-    try:
-        temp_file = tempfile.NamedTemporaryFile(mode='w', delete=False, newline='', suffix='.csv')
-        temp_file_path = temp_file.name
-        temp_file.close()
-
-        conn, c = get_connection()
-        c.execute("SELECT chat_id, twitter_username FROM twitterusernames")
-        data = c.fetchall()
-        conn.close()
-
-        with open(temp_file_path, 'w', newline='') as file:
-            writer = csv.writer(file)
-            writer.writerow(['Chat ID', 'Twitter Username'])
-            writer.writerows(data)
-
-        with open(temp_file_path, 'r') as file:
-            content = file.read()
-            print("Generated CSV content (Twitter Username):\n", content)
-
-        return temp_file_path
+    names = USERS_DEFERRED_INDEXES + USERS_DEFERRED_TRIGGERS
+    c.execute(f"SELECT COUNT(*) FROM sqlite_master WHERE name IN ({', '.join('?' * len(names))})", names)
+    if c.fetchone()[0] < len(names):
+        log.warning("Users indexes or rank triggers are missing (interrupted import?), rebuilding them")
+        db_writer.submit(_restore_users_indexes).result()
+
+def _apply_migration(c, target, fn):
+    c.execute('PRAGMA user_version')
+    if c.fetchone()[0] >= target:
+        return False
+    if fn is not None:
+        fn(c)
+    c.execute(f'PRAGMA user_version = {target}')
+    return True
+
+# Secondary indexes. Keep in sync with the queries: run `python bot.py explain-queries` after changing SQL
+def create_indexes(c):
+    # My Referrals / view_referrals / view_all_referrals: covering index, answered without touching the table
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_users_upline ON users (upline_id, chat_id, username)
+              WHERE referral_link IS NOT NULL''')
+    # Ancestors of a user, used when a new referral is linked into the graph
+    c.execute("CREATE INDEX IF NOT EXISTS idx_referral_paths_descendant ON referral_paths (descendant_id, depth, ancestor_id)")
+    # Leaderboard top N, in rank order
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_users_count ON users (count DESC, chat_id)
+              WHERE referral_link IS NOT NULL''')
+    # Broadcasts to resume at startup
+    c.execute("CREATE INDEX IF NOT EXISTS idx_broadcasts_status ON broadcasts (status)")
+
+# Exported view -> (which users rows it shows, users columns it shows), {row} being OLD. or NEW.
+EXPORT_VERSION_COLUMNS = {
+    'referrals': ("{row}referral_link IS NOT NULL", ['referral_link', 'count', 'upline_id', 'username']),
+    'bep20_addresses': ("{row}bep20_address IS NOT NULL", ['bep20_address']),
+    'email_address': ("{row}email_address IS NOT NULL", ['email_address']),
+    'twitterusernames': ("{row}twitter_username IS NOT NULL", ['twitter_username']),
+    'telegramusernames': ("{row}telegram_listed = 1", ['username', 'firstname']),
+}
+
+# Bump export_versions for every view a change to users shows up in. Every process (a second
+# bot instance, the import command) writes through these, so a cached export is current
+# exactly when its version matches.
+def create_export_triggers(c):
+    bumps = {'insert': [], 'update': [], 'delete': []}
+    for name, (member, columns) in EXPORT_VERSION_COLUMNS.items():
+        old, new = member.format(row='OLD.'), member.format(row='NEW.')
+        changed = ' OR '.join([f"({old}) IS NOT ({new})"] + [f"OLD.{column} IS NOT NEW.{column}" for column in columns])
+        bump = f"UPDATE export_versions SET version = version + 1 WHERE name = '{name}' AND "
+        bumps['insert'].append(bump + f"{new};")
+        bumps['update'].append(bump + f"(({old}) OR ({new})) AND ({changed});")
+        bumps['delete'].append(bump + f"{old};")
+    for event, statements in bumps.items():
+        c.execute(f"CREATE TRIGGER IF NOT EXISTS trg_users_exports_{event} AFTER {event.upper()} ON users "
+                  f"BEGIN {' '.join(statements)} END")
+
+# Current version of an exported view
+def export_version(c, name):
+    c.execute("SELECT version FROM export_versions WHERE name = ?", (name,))
+    return c.fetchone()[0]
+
+# Keep referral_count_histogram in step with every change to referral members of users
+def create_rank_triggers(c):
+    c.execute('''CREATE TRIGGER IF NOT EXISTS trg_users_rank_insert AFTER INSERT ON users
+              WHEN NEW.referral_link IS NOT NULL
+              BEGIN
+                  INSERT INTO referral_count_histogram (count, users) VALUES (IFNULL(NEW.count, 0), 1)
+                  ON CONFLICT (count) DO UPDATE SET users = users + 1;
+              END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS trg_users_rank_update AFTER UPDATE OF count, referral_link ON users
+              WHEN (OLD.referral_link IS NOT NULL) != (NEW.referral_link IS NOT NULL)
+                   OR (NEW.referral_link IS NOT NULL AND IFNULL(OLD.count, 0) != IFNULL(NEW.count, 0))
+              BEGIN
+                  UPDATE referral_count_histogram SET users = users - 1
+                  WHERE OLD.referral_link IS NOT NULL AND count = IFNULL(OLD.count, 0);
+                  DELETE FROM referral_count_histogram WHERE count = IFNULL(OLD.count, 0) AND users <= 0;
+                  INSERT INTO referral_count_histogram (count, users)
+                  SELECT IFNULL(NEW.count, 0), 1 WHERE NEW.referral_link IS NOT NULL
+                  ON CONFLICT (count) DO UPDATE SET users = users + 1;
+              END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS trg_users_rank_delete AFTER DELETE ON users
+              WHEN OLD.referral_link IS NOT NULL
+              BEGIN
+                  UPDATE referral_count_histogram SET users = users - 1 WHERE count = IFNULL(OLD.count, 0);
+                  DELETE FROM referral_count_histogram WHERE count = IFNULL(OLD.count, 0) AND users <= 0;
+              END''')
+
+def rebuild_count_histogram(c):
+    c.execute("DELETE FROM referral_count_histogram")
+    c.execute('''/* full scan */ INSERT INTO referral_count_histogram (count, users)
+              SELECT IFNULL(count, 0), COUNT(*) FROM users WHERE referral_link IS NOT NULL GROUP BY IFNULL(count, 0)''')
+
+# Indexes and triggers on users that a bulk import drops while it loads (see import_users).
+# migrate() puts back any that an interrupted import left dropped.
+USERS_DEFERRED_INDEXES = ('idx_users_upline', 'idx_users_count')
+USERS_DEFERRED_TRIGGERS = ('trg_users_rank_insert', 'trg_users_rank_update', 'trg_users_rank_delete')
+
+def _defer_users_indexes(c):
+    for name in USERS_DEFERRED_INDEXES:
+        c.execute(f"DROP INDEX IF EXISTS {name}")
+    for name in USERS_DEFERRED_TRIGGERS:
+        c.execute(f"DROP TRIGGER IF EXISTS {name}")
+
+def _restore_users_indexes(c):
+    create_indexes(c)
+    create_rank_triggers(c)
+    rebuild_count_histogram(c)
+
+# Legacy per-attribute tables still present as real tables (not yet migrated)
+def legacy_user_tables(c):
+    c.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+    tables = {row[0] for row in c.fetchall()}
+    return [name for name in LEGACY_USER_TABLES if name in tables]
+
+# Online migration from the per-attribute tables into users:
+#  1. sync triggers on the legacy tables mirror every write an older bot process still makes;
+#  2. rows are copied in chat_id order, batch_size rows per writer transaction, so the
+#     database is never locked for long and a restart just redoes idempotent upserts;
+#  3. one transaction checks the row counts, renames the legacy tables to legacy_<name> and
+#     puts the compatibility views in their place.
+def migrate_users(tables, batch_size=MIGRATION_BATCH_SIZE):
+    db_writer.submit(_prepare_users_migration, tables).result()
+    for table in tables:
+        after, copied = float('-inf'), 0
+        while True:
+            after, rows = db_writer.submit(_copy_users_batch, table, after, batch_size).result()
+            if after is None:
+                break
+            copied += rows
+            log.info(f"Migrating {table} into users", extra={'fields': {'copied': copied}})
+    db_writer.submit(_swap_in_users, tables).result()
+    log.info(f"Migrated {', '.join(tables)} into users; old tables kept as legacy_<name>")
+
+# users column -> expression for a legacy row; {row} is '' in a SELECT, 'NEW.' in a trigger
+def _legacy_user_columns(table, row):
+    return {column: expr.format(row=row) for column, expr in LEGACY_USER_TABLES[table]['columns'].items()}
+
+def _users_upsert_set(table):
+    spec = LEGACY_USER_TABLES[table]
+    return ', '.join(f"{column} = IFNULL(users.{column}, excluded.{column})" if column in spec['keep']
+                     else f"{column} = excluded.{column}" for column in spec['columns'])
+
+def _prepare_users_migration(c, tables):
+    for table in tables:
+        c.execute(f"PRAGMA table_info({table})")
+        columns = {column[1] for column in c.fetchall()}
+        for column, column_type in LEGACY_ADDED_COLUMNS.get(table, {}).items():
+            if column not in columns:
+                c.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+        values = _legacy_user_columns(table, 'NEW.')
+        upsert = (f"INSERT INTO users (chat_id, {', '.join(values)}) VALUES (NEW.chat_id, {', '.join(values.values())}) "
+                  f"ON CONFLICT (chat_id) DO UPDATE SET {_users_upsert_set(table)};")
+        c.execute(f"CREATE TRIGGER IF NOT EXISTS trg_{table}_sync_insert AFTER INSERT ON {table} BEGIN {upsert} END")
+        c.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_{table}_sync_update AFTER UPDATE ON {table}
+                  BEGIN UPDATE users SET {LEGACY_USER_TABLES[table]['clear']} WHERE chat_id = OLD.chat_id; {upsert} END''')
+        c.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_{table}_sync_delete AFTER DELETE ON {table}
+                  BEGIN UPDATE users SET {LEGACY_USER_TABLES[table]['clear']} WHERE chat_id = OLD.chat_id; END''')
+
+# Copy the next batch of legacy rows after chat_id `after`; returns (last chat_id copied or None, rows)
+def _copy_users_batch(c, table, after, batch_size):
+    c.execute(f"SELECT MAX(chat_id), COUNT(*) FROM (SELECT chat_id FROM {table} WHERE chat_id > ? ORDER BY chat_id LIMIT ?)",
+              (after, batch_size))
+    last, rows = c.fetchone()
+    if last is None:
+        return None, 0
+    values = _legacy_user_columns(table, '')
+    c.execute(f"INSERT INTO users (chat_id, {', '.join(values)}) "
+              f"SELECT chat_id, {', '.join(values.values())} FROM {table} WHERE chat_id > ? AND chat_id <= ? "
+              f"ON CONFLICT (chat_id) DO UPDATE SET {_users_upsert_set(table)}", (after, last))
+    return last, rows
+
+def _swap_in_users(c, tables):
+    for table in tables:
+        spec = LEGACY_USER_TABLES[table]
+        c.execute(f"/* full scan */ SELECT COUNT(*) FROM {table} WHERE {spec['legacy_member']}")
+        expected = c.fetchone()[0]
+        c.execute(f"/* full scan */ SELECT COUNT(*) FROM users WHERE {spec['member']}")
+        found = c.fetchone()[0]
+        if found < expected:
+            raise RuntimeError(f"users has {found} rows for {table}, expected {expected}; not swapping")
+    c.execute("DROP TRIGGER IF EXISTS trg_referrals_rank_insert")
+    c.execute("DROP TRIGGER IF EXISTS trg_referrals_rank_update")
+    c.execute("DROP TRIGGER IF EXISTS trg_referrals_rank_delete")
+    c.execute("DROP INDEX IF EXISTS idx_referrals_upline")
+    c.execute("DROP INDEX IF EXISTS idx_referrals_count")
+    for table in tables:
+        for event in ('insert', 'update', 'delete'):
+            c.execute(f"DROP TRIGGER IF EXISTS trg_{table}_sync_{event}")
+        c.execute(f"ALTER TABLE {table} RENAME TO legacy_{table}")
+    for spec in LEGACY_USER_TABLES.values():
+        c.execute(spec['view'])
+    create_rank_triggers(c)
+    rebuild_count_histogram(c)
+
+# Leaderboard position for a referral count: 1 + users with strictly more referrals (ties share a rank).
+# Reads one histogram row per distinct higher count, independent of the number of users.
+def referral_rank(count):
+    conn, c = get_connection()
+    c.execute("SELECT IFNULL(SUM(users), 0) + 1 FROM referral_count_histogram WHERE count > ?", (count or 0,))
+    return c.fetchone()[0]
 
-    except Exception as e:
-        print(f"An error occurred while generating the CSV file: {e}")
-        if os.path.exists(temp_file_path):
-            os.remove(temp_file_path)
+# Top users by referral count as (rank, chat_id, username, count)
+def leaderboard(limit=LEADERBOARD_SIZE):
+    conn, c = get_connection()
+    c.execute("SELECT chat_id, username, count FROM referrals ORDER BY count DESC, chat_id LIMIT ?", (limit,))
+    rows = c.fetchall()
+    ranked = []
+    for position, (chat_id, username, count) in enumerate(rows, 1):
+        # Same count as the previous row means same rank
+        rank = ranked[-1][0] if ranked and ranked[-1][3] == count else position
+        ranked.append((rank, chat_id, username, count))
+    return ranked
+
+# Backfill the referral graph from users.upline_id, batch_size users per writer transaction:
+# first each user's paths to its ancestors, then each ancestor's per-depth totals. Both steps
+# are idempotent, so an interrupted backfill is simply run again. Rows don't record whether
+# the upline had joined yet when they were credited, so every link to a registered user counts here.
+def backfill_referral_graph(batch_size=MIGRATION_BATCH_SIZE):
+    for step in (_backfill_referral_paths, _backfill_referral_level_counts):
+        after, batches = float('-inf'), 0
+        while True:
+            after = db_writer.submit(step, after, batch_size).result()
+            if after is None:
+                break
+            batches += 1
+            log.info(f"Backfilling referral graph ({step.__name__})", extra={'fields': {'batches': batches}})
+
+# Last chat_id of the next batch_size users after `after`, or None when there are none left
+def _users_batch_end(c, after, batch_size):
+    c.execute("SELECT MAX(chat_id) FROM (SELECT chat_id FROM users WHERE chat_id > ? ORDER BY chat_id LIMIT ?)",
+              (after, batch_size))
+    return c.fetchone()[0]
+
+def _backfill_referral_paths(c, after, batch_size):
+    last = _users_batch_end(c, after, batch_size)
+    if last is None:
+        return None
+    c.execute('''INSERT INTO referral_paths (ancestor_id, descendant_id, depth)
+              WITH RECURSIVE paths (ancestor_id, descendant_id, depth) AS (
+                  SELECT r.upline_id, r.chat_id, 1
+                  FROM referrals r JOIN referrals u ON u.chat_id = r.upline_id
+                  WHERE r.chat_id > ? AND r.chat_id <= ? AND r.upline_id != r.chat_id
+                  UNION ALL
+                  SELECT r.upline_id, p.descendant_id, p.depth + 1
+                  FROM paths p JOIN referrals r ON r.chat_id = p.ancestor_id JOIN referrals u ON u.chat_id = r.upline_id
+                  WHERE p.depth < ? AND r.upline_id != r.chat_id
+              )
+              SELECT ancestor_id, descendant_id, MIN(depth) FROM paths
+              WHERE ancestor_id != descendant_id
+              GROUP BY ancestor_id, descendant_id
+              ON CONFLICT DO NOTHING''', (after, last, REFERRAL_MAX_DEPTH))
+    return last
+
+def _backfill_referral_level_counts(c, after, batch_size):
+    last = _users_batch_end(c, after, batch_size)
+    if last is None:
         return None
+    c.execute('''INSERT INTO referral_level_counts (ancestor_id, depth, total)
+              SELECT ancestor_id, depth, COUNT(*) FROM referral_paths WHERE ancestor_id > ? AND ancestor_id <= ?
+              GROUP BY ancestor_id, depth
+              ON CONFLICT (ancestor_id, depth) DO UPDATE SET total = excluded.total''', (after, last))
+    return last
 
-# Function to generate a CSV file from telegramusername table
-def generate_telegramusernames_csv():
+# Clear the database
+def _clear_tables(c):
+    c.execute('DELETE FROM users')
+    log.info(f"Deleted {c.rowcount} records from users")
+    c.execute('DELETE FROM referral_paths')
+    c.execute('DELETE FROM referral_level_counts')
+
+def clear_database():
+    db_writer.submit(_clear_tables).result()
+
+# CSV exports offered by /download_csv, keyed by the name used in the download_<name>_csv callbacks
+EXPORTS = {
+    'bep20': {
+        'query': "SELECT chat_id, bep20_address FROM bep20_addresses",
+        'table': 'bep20_addresses',
+        'header': ['Chat ID', 'BEP20 Address'],
+        'file_name': 'bep20_addresses.csv',
+    },
+    'email': {
+        'query': "SELECT chat_id, email_address FROM email_address",
+        'table': 'email_address',
+        'header': ['Chat ID', 'Email Address'],
+        'file_name': 'email_addresses.csv',
+    },
+    'referrals': {
+        'query': "SELECT chat_id, referral_link, count, upline_id, username FROM referrals",
+        'table': 'referrals',
+        'header': ['Chat ID', 'Referral Link', 'Count', 'Upline ID', 'Username'],
+        'file_name': 'referrals.csv',
+    },
+    'twitterusernames': {
+        'query': "SELECT chat_id, twitter_username FROM twitterusernames",
+        'table': 'twitterusernames',
+        'header': ['Chat ID', 'Twitter Username'],
+        'file_name': 'twitterusernames.csv',
+    },
+    'telegramusernames': {
+        'query': "SELECT chat_id, telegram_username, firstname FROM telegramusernames",
+        'table': 'telegramusernames',
+        'header': ['Chat ID', 'Telegram Username', 'Telegram Firstname'],
+        'file_name': 'telegramusernames.csv',
+    },
+    'referraltree': {
+        'query': "SELECT upline_id, chat_id, username FROM referrals ORDER BY upline_id, chat_id",
+        'table': 'referrals',
+        'header': ['Upline ID', 'Chat ID', 'Username'],
+        'file_name': 'referral_tree.csv',
+    },
+}
+
+# File name an export is delivered under
+def export_file_name(kind, compress=EXPORT_GZIP):
+    file_name = EXPORTS[kind]['file_name']
+    return file_name + '.gz' if compress else file_name
+
+# Encode rows as CSV bytes; gzip output is written as one gzip member per chunk,
+# which gzip readers treat as a single stream
+def _encode_csv_rows(rows, compress):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    data = buffer.getvalue().encode('utf-8')
+    return gzip.compress(data) if compress else data
+
+# Stream an export table into a binary file, EXPORT_CHUNK_SIZE rows at a time.
+# Reads from one consistent snapshot and returns the export version it reflects.
+def write_export(kind, file, compress=EXPORT_GZIP):
+    spec = EXPORTS[kind]
+    file.write(_encode_csv_rows([spec['header']], compress))
+    conn, c = get_connection()
+    c.execute('BEGIN')
     try:
-        temp_file = tempfile.NamedTemporaryFile(mode='w', delete=False, newline='', suffix='.csv')
-        temp_file_path = temp_file.name
-        temp_file.close()
+        # The read snapshot is taken by the first read, so the rows are exactly those of `version`
+        version = export_version(c, spec['table'])
+        c.execute(spec['query'])
+        rows = c.fetchmany(EXPORT_CHUNK_SIZE)
+        while rows:
+            file.write(_encode_csv_rows(rows, compress))
+            rows = c.fetchmany(EXPORT_CHUNK_SIZE)
+    finally:
+        conn.commit()
+    return version
+
+# Read-only view of the first `size` bytes of a snapshot file: rows appended to the file after
+# it was opened are not part of the version being read
+class _SnapshotReader:
+    def __init__(self, file, size):
+        self.file = file
+        self.size = size
+        self.name = file.name
+
+    def read(self, n=-1):
+        remaining = max(self.size - self.file.tell(), 0)
+        return self.file.read(remaining if n is None or n < 0 else min(n, remaining))
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_END:
+            offset, whence = self.size + offset, os.SEEK_SET
+        return self.file.seek(offset, whence)
+
+    def tell(self):
+        return self.file.tell()
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+# Cached copy of one export kept in EXPORT_CACHE_DIR as <file name>.<version>, the
+# export_versions value it reflects. A download serves the file for the current version and
+# rebuilds it when there is none, so a change made by any process is picked up. An insert made
+# here is appended to the file instead, which moves it from the version before the insert to
+# the one after; anything else (updates, deletes, other processes' writes) leaves the file
+# behind and the next download rebuilds it.
+class ExportSnapshot:
+    def __init__(self, kind, compress=EXPORT_GZIP):
+        self.kind = kind
+        self.compress = compress
+        self.name = EXPORTS[kind]['table']
+        self.base = os.path.join(EXPORT_CACHE_DIR, export_file_name(kind, compress))
+        self.lock = threading.Lock()        # guards the fields below and appends to the file
+        self.build_lock = threading.Lock()  # one rebuild at a time
+        self.building = False
+        self.pending = []
+
+    def _path(self, version):
+        return f"{self.base}.{version}"
+
+    # Called on the writer thread once an insert that took the export from version `before`
+    # to `after` by adding `rows` has committed
+    def append(self, rows, before, after):
+        with self.lock:
+            if self.building:
+                self.pending.append((before, after, rows))
+            else:
+                self._append(rows, before, after)
 
+    # Open the snapshot of the current version for reading, building it first if there is none
+    def open(self):
         conn, c = get_connection()
-        c.execute("SELECT chat_id, telegram_username, firstname FROM telegramusernames")
-        data = c.fetchall()
-        conn.close()
-
-        with open(temp_file_path, 'w', newline='') as file:
-            writer = csv.writer(file)
-            writer.writerow(['Chat ID', 'Telegram Username', 'Telegram Firstname'])
-            writer.writerows(data)
-
-        with open(temp_file_path, 'r') as file:
-            content = file.read()
-            print("Generated CSV content (Telegram Username):\n", content)
-
-        return temp_file_path
-
-    except Exception as e:
-        print(f"An error occurred while generating the CSV file: {e}")
-        if os.path.exists(temp_file_path):
-            os.remove(temp_file_path)
-        return None
-
-# Retry decorator to handle database locking
-def retry_on_lock(func):
-    def wrapper(*args, **kwargs):
-        retries = 5
-        delay = 1
-        for i in range(retries):
+        try:
+            return self._open(export_version(c, self.name))
+        except FileNotFoundError:
+            pass
+        with self.build_lock:
             try:
-                return func(*args, **kwargs)
-            except sqlite3.OperationalError as e:
-                if 'database is locked' in str(e):
-                    time.sleep(delay)
-                else:
-                    raise
-        raise Exception('Maximum retry attempts reached')
-    return wrapper
-
-@retry_on_lock
+                # Another thread may have built it meanwhile
+                return self._open(export_version(c, self.name))
+            except FileNotFoundError:
+                return self._rebuild()
+
+    # The file of `version` as it is now. The file is later appended to and renamed in place,
+    # and an open descriptor sees those appends, so the reader stops at the current size;
+    # taking the lock means no append is half written.
+    def _open(self, version):
+        with self.lock:
+            file = open(self._path(version), 'rb')
+            return _SnapshotReader(file, os.fstat(file.fileno()).st_size)
+
+    def _rebuild(self):
+        with self.lock:
+            self.building = True
+            self.pending = []
+        os.makedirs(EXPORT_CACHE_DIR, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=EXPORT_CACHE_DIR, prefix=os.path.basename(self.base) + '.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                version = write_export(self.kind, file, self.compress)
+            with self.lock:
+                os.replace(temp_path, self._path(version))
+                for before, after, rows in sorted(self.pending, key=lambda item: item[0]):
+                    if before >= version and self._append(rows, before, after):
+                        version = after
+                self._remove_older(version)
+                file = open(self._path(version), 'rb')
+                return _SnapshotReader(file, os.fstat(file.fileno()).st_size)
+        finally:
+            with self.lock:
+                self.building = False
+                self.pending = []
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    # Append to the file of version `before` and rename it to `after`; False if there is no such file
+    def _append(self, rows, before, after):
+        try:
+            fd = os.open(self._path(before), os.O_WRONLY | os.O_APPEND)
+        except FileNotFoundError:
+            return False
+        try:
+            # A single write() on an O_APPEND descriptor, so a reader never sees half a chunk
+            os.write(fd, _encode_csv_rows(rows, self.compress))
+        finally:
+            os.close(fd)
+        os.replace(self._path(before), self._path(after))
+        return True
+
+    def _remove_older(self, version):
+        prefix = os.path.basename(self.base) + '.'
+        for entry in os.listdir(EXPORT_CACHE_DIR):
+            suffix = entry[len(prefix):]
+            if entry.startswith(prefix) and suffix.isdigit() and int(suffix) < version:
+                try:
+                    os.remove(os.path.join(EXPORT_CACHE_DIR, entry))
+                except FileNotFoundError:
+                    pass
+
+export_snapshots = {kind: ExportSnapshot(kind) for kind in EXPORTS}
+
+# Write intent for an insert whose new row should be appended to a cached export
+def _insert_export_row(c, sql, params, kind, row):
+    before = export_version(c, EXPORTS[kind]['table'])
+    c.execute(sql, params)
+    if c.rowcount:
+        after = export_version(c, EXPORTS[kind]['table'])
+        db_writer.after_commit(lambda seq: export_snapshots[kind].append([row], before, after))
+    return c.rowcount
+
+# Queue a BEP20 address insert; the Future resolves to 1 if saved, 0 if the user already has one
 def insert_bep20_address(chat_id, address):
-    conn, c = get_connection()
-    c.execute("INSERT INTO bep20_addresses (chat_id, bep20_address) VALUES (?, ?)", (chat_id, address))
-    conn.commit()
-    conn.close()
+    return db_writer.submit(_insert_export_row,
+                            "INSERT INTO users (chat_id, bep20_address) VALUES (?, ?) ON CONFLICT(chat_id) DO UPDATE "
+                            "SET bep20_address = excluded.bep20_address WHERE users.bep20_address IS NULL",
+                            (chat_id, address), 'bep20', (chat_id, address))
 
-@retry_on_lock
+# Queue an email insert; the Future resolves to 1 if saved, 0 if the user already has one
 def insert_email_address(chat_id, email):
-    conn, c = get_connection()
-    c.execute("INSERT INTO email_address (chat_id, email_address) VALUES (?, ?)", (chat_id, email))
-    conn.commit()
-    conn.close()
+    return db_writer.submit(_insert_export_row,
+                            "INSERT INTO users (chat_id, email_address) VALUES (?, ?) ON CONFLICT(chat_id) DO UPDATE "
+                            "SET email_address = excluded.email_address WHERE users.email_address IS NULL",
+                            (chat_id, email), 'email', (chat_id, email))
+
+# Queue a Twitter username insert; the Future resolves to 1 if saved, 0 if the user already has one
+def insert_twitter_username(chat_id, twitter_username):
+    return db_writer.submit(_insert_export_row,
+                            "INSERT INTO users (chat_id, twitter_username) VALUES (?, ?) ON CONFLICT(chat_id) DO UPDATE "
+                            "SET twitter_username = excluded.twitter_username WHERE users.twitter_username IS NULL",
+                            (chat_id, twitter_username), 'twitterusernames', (chat_id, twitter_username))
+
+# Reply templates
+# Static texts and keyboards are built once at import. Keyboards are kept as their serialized
+# reply_markup JSON, which telebot passes through as is, so a tap on one of these buttons
+# does not build or serialize any markup.
+def render_keyboard(*rows):
+    keyboard = telebot.types.InlineKeyboardMarkup()
+    for row in rows:
+        keyboard.add(*(telebot.types.InlineKeyboardButton(text, callback_data=data) for text, data in row))
+    return keyboard.to_json()
+
+BACK_TO_TASKS_KEYBOARD = render_keyboard([("Back To Tasks", 'BackToTasks')])
+REFERRALS_MENU_KEYBOARD = render_keyboard([("My Referrals", 'MyReferrals'), ("Back To Tasks", 'BackToTasks')])
+ABOUT_KEYBOARD = render_keyboard([('About Fifareward', 'details')])
+CHECK_STATUS_KEYBOARD = render_keyboard([('Check My Status', 'status')])
+DETAILS_KEYBOARD = render_keyboard([('Join Airdrop Campaign', 'joinairdrop')])
+TASKS_KEYBOARD = render_keyboard([("Have Completed Tasks", 'Done')])
+SUBMISSION_KEYBOARD = render_keyboard(
+    [("Submit Email Address", 'Email'), ("Submit Wallet Address", 'Wallet')],
+    [("Submit Twitter Username", 'TwitterUsername')],
+    [("Have Submitted All Details", 'Continue')],
+)
+CSV_OPTIONS_KEYBOARD = render_keyboard(
+    [("Download BEP20 Addresses CSV", "download_bep20_csv")],
+    [("Download Email Addresses CSV", "download_email_csv")],
+    [("Download Referrals CSV", "download_referrals_csv")],
+    [("Download Twitter Usernames", "download_twitterusernames_csv")],
+    [("Download Telegram Usernames", "download_telegramusernames_csv")],
+)
+
+DETAILS_TEXT = str("Fifareward is a layer 2 blockchain on BSC network, it is the first decentralized AI revolutionary betting Dapp on the blockchain. \n\n" +
+"Utilities include: \n\n" +
+"1) Soccer Betting\n" +
+"2) Staking Protocol\n" +
+"3) Farming Protocol\n" + 
+"4) AI Powered Games\n" +
+"5) NFT Minting Engine And Market Place \n\n" +
+"==>) More in our road map \n\n" 
+)
+
+JOIN_AIRDROP_TEXT = f"To join the Fifareward airdrop waiting list, you must do the following tasks. \n\n" + \
+"Join our;\n\n" + \
+f"1) <a href=\"https://t.me/FifarewardLabs\">Telegram</a> \n" + \
+f"2) <a href=\"https://discord.gg/aQ7bjShzHy\">Discord</a> \n" + \
+f"3) <a href=\"https://twitter.com/@FRD_Labs\">Twitter</a> \n" + \
+f"4) Like and retweet our tweets \n" + \
+f"5) Connect to our dapp using <a href=\"https://link.trustwallet.com/open_url?&url=https://www.fifareward.io\"> trust wallet </a> or <a href=\"https://metamask.app.link/dapp/www.fifareward.io\"> metmask</a>, in your wallet, enter https://www.fifareward.io in the browser address bar and connect to fifareward dapp. \n\n"
+
+TASKS_TEXT = f"To join the Fifareward airdrop waiting list, you must do the following tasks. \n\n" + \
+"Join our;\n\n" + \
+f"1) <a href=\"https://twitter.com/@FRD_Labs\">Twitter</a> \n" + \
+f"2) <a href=\"https://discord.com/invite/DC5Ta8bb\">Discord</a> \n" + \
+f"3) <a href=\"https://t.me/FifarewardLabs\">Telegram</a> \n" + \
+f"4) Connect to our dapp using <a href=\"https://link.trustwallet.com/open_url?&url=https://www.fifareward.io\"> trust wallet </a> or <a href=\"https://metamask.app.link/dapp/www.fifareward.io\"> metmask</a>, in your wallet, enter https://www.fifareward.io in the browser address bar and connect to fifareward dapp. \n\n" + \
+"5) Like and retweet our tweets \n\n"
+
+SUBMISSION_TEXT = str("Congratulations!, we will verify that you have completed all the tasks, please submit your wallet address, verified twitter username and email address for the waiting list. \n\n")
+
+NOT_REFERRED_TEXT = "You must join using someone's referral link to participate in Fifareward airdrop."
 
 # Handler to request wallet address
-@bot.callback_query_handler(func=lambda call: call.data == 'Wallet')
+@router.callback('Wallet')
+@nonblocking
 def request_wallet_address(call):
     chat_id = call.message.chat.id
     user_states[chat_id] = STATE_WAITING_FOR_WALLET
-    msg = bot.send_message(chat_id, "Please send your BEP20 wallet address:")
+    outbox.send_message(chat_id, "Please send your BEP20 wallet address:")
 
 # Process wallet address
-@bot.message_handler(func=lambda message: user_states.get(message.chat.id) == STATE_WAITING_FOR_WALLET)
+@router.state(STATE_WAITING_FOR_WALLET)
+@nonblocking
 def process_wallet_address(message):
     chat_id = message.chat.id
     address = message.text
     if address_pattern.match(address):
         conn, c = get_connection()
-        c.execute("SELECT bep20_address FROM bep20_addresses WHERE chat_id = ?", (chat_id,))
+        c.execute("SELECT bep20_address FROM users WHERE chat_id = ? AND bep20_address IS NOT NULL", (chat_id,))
         waddress = c.fetchone()
-        conn.close()
-        if waddress is not None:
-            bot.send_message(chat_id, "BEP20 address already exists.")
+        saved = waddress is None and (yield insert_bep20_address(chat_id, address))
+        if not saved:
+            outbox.send_message(chat_id, "BEP20 address already exists.")
         else:
-            insert_bep20_address(chat_id, address)
-            generate_bep20_csv()
-            bot.send_message(chat_id, "Your BEP20 address has been saved successfully.")
+            outbox.send_message(chat_id, "Your BEP20 address has been saved successfully.")
     else:
-        bot.send_message(chat_id, "Invalid address format. Please send a valid BEP20 wallet address.")
+        outbox.send_message(chat_id, "Invalid address format. Please send a valid BEP20 wallet address.")
     user_states.pop(chat_id, None)
 
 # Handler to request email address
-@bot.callback_query_handler(func=lambda call: call.data == 'Email')
+@router.callback('Email')
+@nonblocking
 def request_email_address(call):
     chat_id = call.message.chat.id
     user_states[chat_id] = STATE_WAITING_FOR_EMAIL
-    msg = bot.send_message(chat_id, "Please send your email address:")
+    outbox.send_message(chat_id, "Please send your email address:")
 
 # Process email address
-@bot.message_handler(func=lambda message: user_states.get(message.chat.id) == STATE_WAITING_FOR_EMAIL)
+@router.state(STATE_WAITING_FOR_EMAIL)
+@nonblocking
 def process_email_address(message):
     chat_id = message.chat.id
     email = message.text
     if email_pattern.match(email):
         conn, c = get_connection()
-        c.execute("SELECT email_address FROM email_address WHERE chat_id = ?", (chat_id,))
+        c.execute("SELECT email_address FROM users WHERE chat_id = ? AND email_address IS NOT NULL", (chat_id,))
         emailaddress = c.fetchone()
-        conn.close()
-        if emailaddress is not None:
-            bot.send_message(chat_id, "Email address already added.")
+        saved = emailaddress is None and (yield insert_email_address(chat_id, email))
+        if not saved:
+            outbox.send_message(chat_id, "Email address already added.")
         else:
-            insert_email_address(chat_id, email)
-            generate_email_csv()
-            bot.send_message(chat_id, "Your email address has been saved successfully.")
+            outbox.send_message(chat_id, "Your email address has been saved successfully.")
     else:
-        bot.send_message(chat_id, "Invalid email format. Please send a valid email address.")
+        outbox.send_message(chat_id, "Invalid email format. Please send a valid email address.")
     user_states.pop(chat_id, None)
 
 # Handler to request twitter username
-@bot.callback_query_handler(func=lambda call: call.data == 'TwitterUsername')
+@router.callback('TwitterUsername')
+@nonblocking
 def request_twitter_username(call):
     chat_id = call.message.chat.id
     user_states[chat_id] = STATE_WAITING_FOR_TWITTERUSERNAME
-    msg = bot.send_message(chat_id, "Please send your verified Twitter username e.g @username:")
+    outbox.send_message(chat_id, "Please send your verified Twitter username e.g @username:")
 
 # Process twitter username
-@bot.message_handler(func=lambda message: user_states.get(message.chat.id) == STATE_WAITING_FOR_TWITTERUSERNAME)
+@router.state(STATE_WAITING_FOR_TWITTERUSERNAME)
+@nonblocking
 def process_twitter_username(message):
     chat_id = message.chat.id
     twitter_username = message.text
     conn, c = get_connection()
-    c.execute("SELECT chat_id FROM twitterusernames WHERE chat_id = ?", (chat_id,))
-    uinfo = c.fetchone()
-    if uinfo is not None: 
-        c.execute("SELECT twitter_username FROM twitterusernames WHERE chat_id = ?", (chat_id,))
-        twt_uname = c.fetchone()
-        if twt_uname is not None:
-            bot.send_message(chat_id, "Twitter username already added.")
-            user_states.pop(chat_id, None)
-        else:
-            c.execute("INSERT INTO twitterusernames (chat_id, twitter_username) VALUES (?, ?)", (chat_id, twitter_username))
-            conn.commit()
-            conn.close()
-            bot.send_message(chat_id, "Your verified Twitter username has been saved successfully.")
-            user_states.pop(chat_id, None)
+    c.execute("SELECT twitter_username FROM users WHERE chat_id = ? AND twitter_username IS NOT NULL", (chat_id,))
+    twt_uname = c.fetchone()
+    saved = twt_uname is None and (yield insert_twitter_username(chat_id, twitter_username))
+    if not saved:
+        outbox.send_message(chat_id, "Twitter username already added.")
     else:
-        c.execute("INSERT INTO twitterusernames (chat_id, twitter_username) VALUES (?, ?)", (chat_id, twitter_username))
-        conn.commit()
-        conn.close()
-        bot.send_message(chat_id, "Your verified Twitter username has been saved successfully.")
-        user_states.pop(chat_id, None)
+        outbox.send_message(chat_id, "Your verified Twitter username has been saved successfully.")
+    user_states.pop(chat_id, None)
         
 # Handler to request email address
-@bot.callback_query_handler(func=lambda call: call.data == 'MyReferrals')
-def request_email_address(call):
+@router.callback('MyReferrals')
+def show_my_referrals(call):
     chat_id = call.message.chat.id
-    keyboard = telebot.types.InlineKeyboardMarkup()
-    keyboard.add(
-        telebot.types.InlineKeyboardButton("Back To Tasks", callback_data='BackToTasks')
-    )
+    keyboard = BACK_TO_TASKS_KEYBOARD
     conn, c = get_connection()
-    c.execute("SELECT chat_id, username FROM referrals WHERE upline_id=?", (chat_id,))
+    c.execute("SELECT chat_id, username FROM users WHERE upline_id=? AND referral_link IS NOT NULL", (chat_id,))
     downlines = c.fetchall()
-    conn.close()
 
     if downlines:
         table = PrettyTable()
@@ -340,226 +2081,395 @@ def request_email_address(call):
     else:
         text = "You don't have any referrals yet."
 
-    bot.send_message(chat_id, text, reply_markup=keyboard, parse_mode="Markdown")
+    outbox.send_message(chat_id, text, reply_markup=keyboard, parse_mode="Markdown")
         
-@bot.message_handler(commands=['download_csv'])
+@router.command('download_csv')
 def send_csv_options(message):
     chat_id = message.chat.id
-    markup = telebot.types.InlineKeyboardMarkup()
-    markup.add(telebot.types.InlineKeyboardButton("Download BEP20 Addresses CSV", callback_data="download_bep20_csv"))
-    markup.add(telebot.types.InlineKeyboardButton("Download Email Addresses CSV", callback_data="download_email_csv"))
-    markup.add(telebot.types.InlineKeyboardButton("Download Referrals CSV", callback_data="download_referrals_csv"))
-    markup.add(telebot.types.InlineKeyboardButton("Download Twitter Usernames", callback_data="download_twitterusernames_csv"))
-    markup.add(telebot.types.InlineKeyboardButton("Download Telegram Usernames", callback_data="download_telegramusernames_csv"))
-    bot.send_message(chat_id, "Please select the CSV file you want to download:", reply_markup=markup)
-
-@bot.callback_query_handler(func=lambda call: call.data.startswith('download_'))
+    outbox.send_message(chat_id, "Please select the CSV file you want to download:", reply_markup=CSV_OPTIONS_KEYBOARD)
+
+@router.callback_prefix('download')
 def handle_download_csv(call):
     chat_id = call.message.chat.id
     file_type = call.data.split('_')[1]
-    
-    if file_type == "bep20":
-        file_path = generate_bep20_csv()
-        file_name = "bep20_addresses.csv"
-    elif file_type == "email":
-        file_path = generate_email_csv()
-        file_name = "email_addresses.csv"
-    elif file_type == "referrals":
-        file_path = generate_referrals_csv()
-        file_name = "referrals.csv"
-    elif file_type == "twitterusernames":
-        file_path = generate_twitterusernames_csv()
-        file_name = "twitterusernames.csv"
-    elif file_type == "telegramusernames":
-        file_path = generate_telegramusernames_csv()
-        file_name = "telegramusernames.csv"
-    else:
-        bot.send_message(chat_id, "Invalid file type.")
+
+    if file_type not in EXPORTS:
+        outbox.send_message(chat_id, "Invalid file type.")
         return
+
+    file_name = export_file_name(file_type)
+    file = export_snapshots[file_type].open()
+    future = outbox.send_document(chat_id, file, caption=f"{file_name}", visible_file_name=file_name)
+    future.add_done_callback(lambda f: file.close())
     
-    with open(file_path, 'rb') as file:
-        bot.send_document(chat_id, file, caption=f"{file_name}")
-    
-    os.remove(file_path)  # Clean up the temporary file
-    
-@bot.message_handler(commands=['clear_data'])
+@router.command('clear_data')
 def clear_data(message):
-    print(f"User ID: {message.from_user.id}")  # Debug statement to log the user ID
-    if message.from_user.id == 730149343:  # Replace with the actual Telegram account ID
+    log.debug("clear_data requested", extra={'fields': {'user_id': message.from_user.id}})
+    if message.from_user.id in ADMIN_IDS:
         clear_database()
-        bot.reply_to(message, "All data has been cleared.")
+        outbox.reply_to(message, "All data has been cleared.")
+    else:
+        outbox.reply_to(message, "You do not have permission to use this command.")
+
+# Broadcast
+# /broadcast <text> sends a message to every registered user through the outbox's bulk lane,
+# so interactive replies are never held up behind it. Recipients are read in chat_id order,
+# BROADCAST_BATCH_SIZE at a time, and the broadcasts row records the highest chat_id below
+# which every send has finished: after a restart the broadcast resumes from there. Sends that
+# finish past that point are recorded in broadcast_deliveries and skipped on resume. Only a
+# send that was in flight when the process died, or whose record had not been committed yet,
+# may be repeated. Chats that blocked the bot or no longer exist are recorded in
+# undeliverable_chats and skipped by later broadcasts.
+# Throughput is bounded by SEND_GLOBAL_RATE.
+_broadcast_stops = {}  # broadcast id -> threading.Event, for broadcasts running in this process
+_broadcast_threads = {}
+_broadcast_lock = threading.Lock()
+
+# Next recipients of a broadcast after `after` in chat_id order, as (chat_id, undeliverable,
+# delivered) rows, delivered being None if the broadcast has no finished send to the chat yet,
+# else whether that send succeeded. A range read on the users primary key, so a batch stops
+# after limit recipients.
+def fetch_broadcast_recipients(broadcast_id, after, limit=BROADCAST_BATCH_SIZE):
+    conn, c = get_connection()
+    c.execute('''SELECT chat_id, EXISTS (SELECT 1 FROM undeliverable_chats WHERE undeliverable_chats.chat_id = recipients.chat_id),
+                  (SELECT sent FROM broadcast_deliveries
+                   WHERE broadcast_deliveries.broadcast_id = ? AND broadcast_deliveries.chat_id = recipients.chat_id)
+              FROM users AS recipients
+              WHERE chat_id > ? AND (referral_link IS NOT NULL OR telegram_listed = 1)
+              ORDER BY chat_id LIMIT ?''', (broadcast_id, after, limit))
+    return c.fetchall()
+
+# A send failure that will not go away by retrying: blocked by the user, deactivated, chat gone
+def is_undeliverable(error):
+    if not isinstance(error, telebot.apihelper.ApiTelegramException):
+        return False
+    return error.error_code == 403 or (error.error_code == 400 and 'chat not found' in error.description.lower())
+
+def start_broadcast(text, admin_chat_id):
+    with _broadcast_lock:
+        if _broadcast_stops:
+            return None
+        broadcast_id = db_writer.submit(_insert_broadcast, text, admin_chat_id).result()
+        _start_broadcast_thread(broadcast_id)
+    return broadcast_id
+
+def _insert_broadcast(c, text, admin_chat_id):
+    c.execute("DELETE FROM broadcast_deliveries WHERE broadcast_id IN (SELECT id FROM broadcasts WHERE status IN ('done', 'cancelled'))")
+    c.execute('''INSERT INTO broadcasts (text, admin_chat_id, status, last_chat_id, sent, failed, started_at)
+              VALUES (?, ?, 'running', ?, 0, 0, ?) RETURNING id''', (text, admin_chat_id, -2 ** 63, time.time()))
+    return c.fetchone()[0]
+
+# Called with _broadcast_lock held
+def _start_broadcast_thread(broadcast_id):
+    _broadcast_stops[broadcast_id] = threading.Event()
+    thread = _broadcast_threads[broadcast_id] = threading.Thread(target=run_broadcast, args=(broadcast_id,),
+                                                                 name=f'broadcast-{broadcast_id}', daemon=True)
+    thread.start()
+
+# Pick up broadcasts that were still running when the bot last stopped
+def resume_broadcasts():
+    conn, c = get_connection()
+    c.execute("SELECT id FROM broadcasts WHERE status = 'running'")
+    with _broadcast_lock:
+        for (broadcast_id,) in c.fetchall():
+            log.info(f"Resuming broadcast {broadcast_id}")
+            _start_broadcast_thread(broadcast_id)
+
+# Stop running broadcasts and wait for them to save their checkpoints
+def stop_broadcasts(timeout=SEND_DRAIN_TIMEOUT):
+    deadline = time.monotonic() + timeout
+    with _broadcast_lock:
+        for stop in _broadcast_stops.values():
+            stop.set()
+        threads = list(_broadcast_threads.values())
+    for thread in threads:
+        thread.join(max(deadline - time.monotonic(), 0))
+
+def cancel_broadcast(broadcast_id):
+    with _broadcast_lock:
+        stop = _broadcast_stops.get(broadcast_id)
+    if stop is None:
+        return False
+    db_writer.execute("UPDATE broadcasts SET status = 'cancelled', finished_at = ? WHERE id = ?", (time.time(), broadcast_id))
+    stop.set()
+    return True
+
+def run_broadcast(broadcast_id):
+    stop = _broadcast_stops[broadcast_id]
+    try:
+        conn, c = get_connection()
+        c.execute("SELECT text, admin_chat_id, last_chat_id, sent, failed FROM broadcasts WHERE id = ?", (broadcast_id,))
+        text, admin_chat_id, after, sent, failed = c.fetchone()
+        checkpoint = after
+        pending = collections.deque()  # (chat_id, future) in chat_id order
+
+        # Account for finished sends at the front of `pending`; with wait=True, for all of them
+        def settle(wait=False):
+            nonlocal checkpoint, sent, failed
+            while pending and (wait or pending[0][1].done()) and not pending[0][1].cancelled():
+                chat_id, future = pending.popleft()
+                try:
+                    future.result()
+                    sent += 1
+                except Exception as e:
+                    failed += 1
+                    if is_undeliverable(e):
+                        db_writer.execute('''INSERT INTO undeliverable_chats (chat_id, error_code, description, failed_at)
+                                          VALUES (?, ?, ?, ?)
+                                          ON CONFLICT(chat_id) DO UPDATE SET error_code = excluded.error_code,
+                                          description = excluded.description, failed_at = excluded.failed_at''',
+                                          (chat_id, e.error_code, e.description, time.time()))
+                checkpoint = chat_id
+
+        # Record a finished send at once, wherever it is in `pending`
+        def record_delivery(chat_id, future):
+            if not future.cancelled():
+                db_writer.execute("INSERT INTO broadcast_deliveries (broadcast_id, chat_id, sent) VALUES (?, ?, ?) "
+                                  "ON CONFLICT DO NOTHING", (broadcast_id, chat_id, int(future.exception() is None)))
+
+        def save_checkpoint():
+            db_writer.execute("UPDATE broadcasts SET last_chat_id = ?, sent = ?, failed = ? WHERE id = ?",
+                              (checkpoint, sent, failed, broadcast_id))
+
+        while not stop.is_set():
+            recipients = fetch_broadcast_recipients(broadcast_id, after)
+            if not recipients:
+                break
+            for chat_id, undeliverable, delivered in recipients:
+                if stop.is_set():
+                    break
+                after = chat_id
+                if undeliverable and delivered is None:
+                    continue
+                if delivered is None:
+                    future = outbox.send_message(chat_id, text, lane=LANE_BULK)
+                    future.add_done_callback(functools.partial(record_delivery, chat_id))
+                else:
+                    # Finished before a restart, past the checkpoint saved then: not sent again,
+                    # only counted once the checkpoint moves past it
+                    future = concurrent.futures.Future()
+                    if delivered:
+                        future.set_result(None)
+                    else:
+                        future.set_exception(RuntimeError('send failed before the broadcast was resumed'))
+                pending.append((chat_id, future))
+                settle()
+            save_checkpoint()
+
+        if stop.is_set():
+            # Shutting down or cancelled: withdraw the sends still queued, wait for the ones in
+            # flight and checkpoint before the first withdrawn one, so a resume sends it again
+            for chat_id, future in pending:
+                future.cancel()
+            settle(wait=True)
+            save_checkpoint()
+            return
+        settle(wait=True)
+        save_checkpoint()
+        db_writer.execute("UPDATE broadcasts SET status = 'done', finished_at = ? WHERE id = ?", (time.time(), broadcast_id))
+        outbox.send_message(admin_chat_id, f"Broadcast {broadcast_id} finished: {sent} sent, {failed} failed.")
+    except Exception as e:
+        log.exception(f"Broadcast {broadcast_id} failed: {e}")
+    finally:
+        with _broadcast_lock:
+            _broadcast_stops.pop(broadcast_id, None)
+            _broadcast_threads.pop(broadcast_id, None)
+
+@router.command('broadcast')
+def broadcast(message):
+    if message.from_user.id not in ADMIN_IDS:
+        outbox.reply_to(message, "You do not have permission to use this command.")
+        return
+    parts = message.text.split(maxsplit=1)
+    if len(parts) < 2:
+        outbox.reply_to(message, "Usage: /broadcast <message>")
+        return
+    broadcast_id = start_broadcast(parts[1], message.chat.id)
+    if broadcast_id is None:
+        outbox.reply_to(message, "A broadcast is already running. Check /broadcast_status.")
     else:
-        bot.reply_to(message, "You do not have permission to use this command.")
+        outbox.reply_to(message, f"Broadcast {broadcast_id} started.")
 
-@bot.message_handler(commands=['start', 'hello', 'help'])
+@router.command('broadcast_status')
+def broadcast_status(message):
+    if message.from_user.id not in ADMIN_IDS:
+        outbox.reply_to(message, "You do not have permission to use this command.")
+        return
+    conn, c = get_connection()
+    c.execute("SELECT id, status, sent, failed FROM broadcasts ORDER BY id DESC LIMIT 1")
+    row = c.fetchone()
+    if row is None:
+        outbox.reply_to(message, "No broadcasts yet.")
+    else:
+        outbox.reply_to(message, f"Broadcast {row[0]}: {row[1]}, {row[2]} sent, {row[3]} failed.")
+
+@router.command('broadcast_cancel')
+def broadcast_cancel(message):
+    if message.from_user.id not in ADMIN_IDS:
+        outbox.reply_to(message, "You do not have permission to use this command.")
+        return
+    with _broadcast_lock:
+        running = list(_broadcast_stops)
+    if running and cancel_broadcast(running[0]):
+        outbox.reply_to(message, f"Broadcast {running[0]} cancelled.")
+    else:
+        outbox.reply_to(message, "No broadcast is running.")
+
+# Register a referred user, or refresh a returning one, in a single writer transaction.
+# Returns (is_new, count). Runs on the writer thread, so two /start messages for the
+# same chat are serialized: the second one always takes the "welcome back" path.
+# A redelivered update (same update_id) changes nothing and is answered as a returning user.
+def register_referral(c, chat_id, upline_id, username, firstname, referral_link, update_id=None):
+    if not claim_update(c, update_id):
+        c.execute("SELECT count FROM users WHERE chat_id = ? AND referral_link IS NOT NULL", (chat_id,))
+        row = c.fetchone()
+        return False, row[0] if row is not None else 0
+    # Returning user: refresh the link. The upline stays the one that was credited on joining.
+    c.execute("UPDATE users SET referral_link = ? WHERE chat_id = ? AND referral_link IS NOT NULL RETURNING count",
+              (referral_link, chat_id))
+    row = c.fetchone()
+    if row is not None:
+        return False, row[0]
+
+    c.execute("SELECT chat_id FROM users WHERE chat_id=? AND referral_link IS NOT NULL", (upline_id,))
+    upline = c.fetchone()
+    upline_exists = upline is not None
+    # The user may already have a row from the wallet/email/Twitter forms
+    c.execute("SELECT telegram_listed FROM users WHERE chat_id = ?", (chat_id,))
+    row = c.fetchone()
+    listed = row is not None and row[0]
+    before = {name: export_version(c, name) for name in ('referrals', 'telegramusernames')}
+    c.execute('''INSERT INTO users (chat_id, referral_link, count, upline_id, username, firstname, telegram_listed)
+              VALUES (?, ?, 0, ?, ?, ?, ?)
+              ON CONFLICT (chat_id) DO UPDATE SET referral_link = excluded.referral_link, count = 0,
+                  upline_id = excluded.upline_id, username = excluded.username,
+                  firstname = IFNULL(users.firstname, excluded.firstname),
+                  telegram_listed = MAX(users.telegram_listed, excluded.telegram_listed)
+              RETURNING count''', (chat_id, referral_link, upline_id, username, firstname, int(upline_exists)))
+    count = c.fetchone()[0]
+    after = {name: export_version(c, name) for name in before}
+    # New rows are appended to the cached exports once committed. A referral also changes the
+    # upline's count, so referrals is rebuilt then instead.
+    if not upline_exists:
+        row = (chat_id, referral_link, count, upline_id, username)
+        db_writer.after_commit(lambda seq: export_snapshots['referrals'].append([row], before['referrals'], after['referrals']))
+    elif not listed:
+        row = (chat_id, username, firstname)
+        db_writer.after_commit(lambda seq: export_snapshots['telegramusernames'].append(
+            [row], before['telegramusernames'], after['telegramusernames']))
+    if upline_exists:
+        c.execute("UPDATE users SET count = count + 1 WHERE chat_id=?", (upline_id,))
+        add_referral_paths(c, chat_id, upline[0])
+    return True, count
+
+# Link a new user into the referral graph: one path row per ancestor up to REFERRAL_MAX_DEPTH
+# and a +1 on each ancestor's total for that depth. Only runs when a user first joins, like
+# the direct count, so a later "welcome back" with another link does not move them.
+def add_referral_paths(c, chat_id, upline_id):
+    c.execute('''INSERT INTO referral_paths (ancestor_id, descendant_id, depth)
+              SELECT ?, ?, 1
+              UNION ALL
+              SELECT ancestor_id, ?, depth + 1 FROM referral_paths WHERE descendant_id = ? AND depth < ?''',
+              (upline_id, chat_id, chat_id, upline_id, REFERRAL_MAX_DEPTH))
+    c.execute('''INSERT INTO referral_level_counts (ancestor_id, depth, total)
+              SELECT ancestor_id, depth, 1 FROM referral_paths WHERE descendant_id = ?
+              ON CONFLICT (ancestor_id, depth) DO UPDATE SET total = total + 1''', (chat_id,))
+
+# Downline size per level for a user, as a list of (depth, total) for depths 1..max_depth
+def downline_levels(chat_id, max_depth=REFERRAL_MAX_DEPTH):
+    conn, c = get_connection()
+    c.execute("SELECT depth, total FROM referral_level_counts WHERE ancestor_id = ? AND depth <= ? ORDER BY depth",
+              (chat_id, max_depth))
+    totals = dict(c.fetchall())
+    return [(depth, totals.get(depth, 0)) for depth in range(1, max_depth + 1)]
+
+# Total referrals of a user down to max_depth levels (the whole tracked subtree by default)
+def downline_total(chat_id, max_depth=REFERRAL_MAX_DEPTH):
+    return sum(total for depth, total in downline_levels(chat_id, max_depth))
+
+@router.command('start', 'hello', 'help')
+@nonblocking
 def start_command(message):
     firstname = str(message.from_user.first_name)
-    keyboard = telebot.types.InlineKeyboardMarkup()
     message_text = message.text
     username = message.from_user.username  # Get the username
     message_array = message_text.split()
     chat_id = message.chat.id
-    conn, c = get_connection()
     if len(message_array) > 1:
         upline_id = message_array[1]
-        print("uplin id",upline_id)
-        c.execute("SELECT * FROM referrals WHERE chat_id=?", (upline_id,))
-        upline_data = c.fetchone()
-        print("upl data",upline_data)
-        if upline_data:
-            referral_link = f"https://t.me/{bot.get_me().username}?start={chat_id}"
-            # Check if the chat_id already exists
-            c.execute("SELECT * FROM referrals WHERE chat_id=?", (chat_id,))
-            data = c.fetchone()
-            if not data:
-                c.execute("SELECT chat_id FROM telegramusernames WHERE chat_id = ?", (chat_id,))
-                uinfo = c.fetchone()
-                if uinfo is not None: 
-                    c.execute("SELECT telegram_username FROM telegramusernames WHERE chat_id = ?", (chat_id,))
-                    twt_uname = c.fetchone()
-                    if twt_uname is None:
-                        c.execute("INSERT INTO telegramusernames (chat_id, telegram_username, firstname) VALUES (?, ?, ?)", (chat_id, username, firstname))
-                        conn.commit()
-                else:
-                    c.execute("INSERT INTO telegramusernames (chat_id, telegram_username, firstname) VALUES (?, ?, ?)", (chat_id, username, firstname))
-                    conn.commit()
-                    
-                c.execute("INSERT INTO referrals (chat_id, referral_link, count, upline_id, username) VALUES (?, ?, ?, ?, ?)",
-                          (chat_id, referral_link, 0, upline_id, username))
-                conn.commit()
-                c.execute("UPDATE referrals SET count = count + 1 WHERE chat_id=?", (upline_id,))
-                conn.commit()
-                
-                c.execute("SELECT * FROM referrals WHERE chat_id=?", (chat_id,))
-                userdata = c.fetchone()
-                if userdata is not None:
-                    count = userdata[2]  # Assuming the count column is at index 2 in the tuple
-                    # Use the count value as needed
-                else:
-                    count = 0
-                    
-                keyboard.add(
-                    telebot.types.InlineKeyboardButton('About Fifareward', callback_data='details')
-                )
-                text = str("Hello! " + firstname + "\n\n" +
-                        "Welcome!, I'm FRD Airdrop Bot, follow the instructions below to join FRD waiting list.\n\n" +
-                        f"Here is your referral link: {referral_link}.\n\n" +
-                        f"Your have *{count}* referrals. \n\n" +
-                        f"Keep sharing to earn a top spot in the aidrop waiting list"
-                        )
-                bot.send_photo(
-                    message.chat.id,
-                    'https://www.fifareward.io/fifarewardlogo.png',
-                    caption=text,
-                    reply_markup=keyboard,
-                    parse_mode="Markdown"
-                )
-                    
-            else:
-                # If the chat_id exists, update the existing record
-                c.execute("UPDATE referrals SET referral_link = ?, upline_id = ? WHERE chat_id = ?",
-                          (referral_link, upline_id, chat_id))
-                conn.commit()
-                keyboard.add(
-                    telebot.types.InlineKeyboardButton('Check My Status', callback_data='status')
-                )
-
-                text = str("Hello! " + firstname + "\n\n" +
-                        "Welcome back\n"
-                        )
-                bot.send_photo(
-                    message.chat.id,
-                    'https://www.fifareward.io/fifarewardlogo.png',
-                    caption=text,
-                    reply_markup=keyboard,
-                    parse_mode="Markdown"
-                )
-
+        log.debug("start with upline", extra={'fields': {'chat_id': chat_id, 'upline_id': upline_id}})
+        referral_link = f"https://t.me/{bot_identity.username()}?start={chat_id}"
+        is_new, count = yield db_writer.submit(register_referral, chat_id, upline_id, username, firstname,
+                                               referral_link, update_ledger.current())
+        if is_new:
+            keyboard = ABOUT_KEYBOARD
+            text = str("Hello! " + firstname + "\n\n" +
+                    "Welcome!, I'm FRD Airdrop Bot, follow the instructions below to join FRD waiting list.\n\n" +
+                    f"Here is your referral link: {referral_link}.\n\n" +
+                    f"Your have *{count}* referrals. \n\n" +
+                    f"Keep sharing to earn a top spot in the aidrop waiting list"
+                    )
+            media_cache.send_photo(
+                message.chat.id,
+                LOGO_URL,
+                caption=text,
+                reply_markup=keyboard,
+                parse_mode="Markdown"
+            )
         else:
-            referral_link = f"https://t.me/{bot.get_me().username}?start={chat_id}"
-            # Check if the chat_id already exists
-            c.execute("SELECT * FROM referrals WHERE chat_id=?", (chat_id,))
-            data = c.fetchone()
-            
-            if not data:
-                c.execute("INSERT INTO referrals (chat_id, referral_link, count, upline_id, username) VALUES (?, ?, ?, ?, ?)",
-                          (chat_id, referral_link, 0, upline_id, username))
-                conn.commit()
-                c.execute("UPDATE referrals SET count = count + 1 WHERE chat_id=?", (upline_id,))
-                conn.commit()
-                c.execute("SELECT * FROM referrals WHERE chat_id=?", (chat_id,))
-                userdata = c.fetchone()
-                
-                if userdata is not None:
-                    count = userdata[2]  # Assuming the count column is at index 2 in the tuple
-                    # Use the count value as needed
-                else:
-                    count = 0
-                    
-                keyboard.add(
-                    telebot.types.InlineKeyboardButton('About Fifareward', callback_data='details')
-                )
-                text = str("Hello! " + firstname + "\n\n" +
-                        "Welcome!, I'm FRD Airdrop Bot, follow the instructions below to join FRD waiting list.\n\n" +
-                        f"Here is your referral link: {referral_link}.\n\n" +
-                        f"Your have *{count}* referrals. \n\n" +
-                        f"Keep sharing to earn a top spot in the aidrop waiting list"
-                        )
-                bot.send_photo(
-                    message.chat.id,
-                    'https://www.fifareward.io/fifarewardlogo.png',
-                    caption=text,
-                    reply_markup=keyboard,
-                    parse_mode="Markdown"
-                )
-                
-            else:
-                # If the chat_id exists, update the existing record
-                c.execute("UPDATE referrals SET referral_link = ?, upline_id = ? WHERE chat_id = ?",
-                          (referral_link, upline_id, chat_id))
-                conn.commit()
-                keyboard.add(
-                    telebot.types.InlineKeyboardButton('Check My Status', callback_data='status')
-                )
-
-                text = str("Hello! " + firstname + "\n\n" +
-                        "Welcome back\n"
-                        )
-                bot.send_photo(
-                    message.chat.id,
-                    'https://www.fifareward.io/fifarewardlogo.png',
-                    caption=text,
-                    reply_markup=keyboard,
-                    parse_mode="Markdown"
-                )
+            keyboard = CHECK_STATUS_KEYBOARD
+
+            text = str("Hello! " + firstname + "\n\n" +
+                    "Welcome back\n"
+                    )
+            media_cache.send_photo(
+                message.chat.id,
+                LOGO_URL,
+                caption=text,
+                reply_markup=keyboard,
+                parse_mode="Markdown"
+            )
     else:
-        keyboard.add(
-            telebot.types.InlineKeyboardButton("My Referrals", callback_data='MyReferrals'),
-            telebot.types.InlineKeyboardButton("Back To Tasks", callback_data='BackToTasks')
-        )
-        text = str("Hi! " + message.from_user.first_name + "\n\n" +
-                "You must join using someone's referral link to participate in Fifareward airdrop.")
+        keyboard = REFERRALS_MENU_KEYBOARD
+        text = "Hi! " + message.from_user.first_name + "\n\n" + NOT_REFERRED_TEXT
         
-        bot.send_photo(
+        media_cache.send_photo(
             message.chat.id,
-            'https://www.fifareward.io/fifarewardlogo.png',
+            LOGO_URL,
             caption=text,
             reply_markup=keyboard,
             parse_mode="Markdown"
         )
                 
 
-@bot.message_handler(commands=['view_referrals'])
+@router.command('leaderboard')
+@nonblocking
+def show_leaderboard(message):
+    chat_id = message.chat.id
+    rows = leaderboard()
+    if rows:
+        lines = []
+        for rank, user_id, username, count in rows:
+            name = f"@{html.escape(str(username))}" if username else "Anonymous"
+            lines.append(f"{rank}. {name} - <b>{count or 0}</b>")
+        text = "FRD airdrop leaderboard:\n\n" + "\n".join(lines)
+    else:
+        text = "No referrals yet, be the first on the leaderboard!"
+
+    conn, c = get_connection()
+    c.execute("SELECT count FROM users WHERE chat_id=? AND referral_link IS NOT NULL", (chat_id,))
+    data = c.fetchone()
+    if data is not None:
+        text += f"\n\nYour rank: <b>#{referral_rank(data[0])}</b> with <b>{data[0] or 0}</b> referrals"
+    outbox.send_message(chat_id, text, parse_mode="HTML")
+
+@router.command('view_referrals')
 def view_referrals(message):
     chat_id = message.chat.id
-    keyboard = telebot.types.InlineKeyboardMarkup()
-    keyboard.add(
-        telebot.types.InlineKeyboardButton("Back To Tasks", callback_data='BackToTasks')
-    )
+    keyboard = BACK_TO_TASKS_KEYBOARD
     conn, c = get_connection()
-    c.execute("SELECT chat_id, username FROM referrals WHERE upline_id=?", (chat_id,))
+    c.execute("SELECT chat_id, username FROM users WHERE upline_id=? AND referral_link IS NOT NULL", (chat_id,))
     downlines = c.fetchall()
-    conn.close()
     
     if downlines:
         table = PrettyTable()
@@ -574,253 +2484,203 @@ def view_referrals(message):
     else:
         text = "You don't have any referrals yet."
     
-    bot.send_message(message.chat.id, text, reply_markup=keyboard, parse_mode="HTML")
-
-@bot.message_handler(commands=['view_all_referrals'])
-def view_all_referrals(message):
+    outbox.send_message(message.chat.id, text, reply_markup=keyboard, parse_mode="HTML")
+
+# Fetch one page of referrals in (upline_id, chat_id) order using keyset pagination.
+# `after`/`before` is the chat_id of the row the page continues from, so every page is a
+# bounded range read on idx_users_upline. Rows without an upline sort first; they are
+# read as a separate range so that each query stays an index seek.
+# Returns (rows, more) where `more` says whether rows exist beyond the page in that direction.
+def fetch_referrals_page(after=None, before=None, limit=ALL_REFERRALS_PAGE_SIZE):
     conn, c = get_connection()
-    c.execute("SELECT chat_id, upline_id, username FROM referrals")
-    all_referrals = c.fetchall()
-    conn.close()
-
-    if all_referrals:
-        referrals_map = {}
-        for referral in all_referrals:
-            chat_id, upline_id, username = referral
-            if upline_id not in referrals_map:
-                referrals_map[upline_id] = []
-            referrals_map[upline_id].append((chat_id, username))
-
-        text = "All referrals:\n\n"
-        for upline_id, downlines in referrals_map.items():
-            downlines_text = ", ".join(f"{downline[0]} ({downline[1] if downline[1] else 'N/A'})" for downline in downlines)
-            text += f"Upline {upline_id}:\n"
-            text += f"```\n"
-            text += f"{downlines_text}\n"
-            text += f"```\n\n"
+    cursor_id = after if after is not None else before
+    upline_id = None
+    if cursor_id is not None:
+        c.execute("SELECT upline_id FROM users WHERE chat_id=? AND referral_link IS NOT NULL", (cursor_id,))
+        row = c.fetchone()
+        if row is None:
+            cursor_id = None
+        else:
+            upline_id = row[0]
+
+    # Ranges to read, in page order, until limit + 1 rows are found
+    if before is None:
+        order = "ASC"
+        if cursor_id is None:
+            ranges = [("upline_id IS NULL", []), ("upline_id IS NOT NULL", [])]
+        elif upline_id is None:
+            ranges = [("upline_id IS NULL AND chat_id > ?", [cursor_id]), ("upline_id IS NOT NULL", [])]
+        else:
+            ranges = [("(upline_id, chat_id) > (?, ?)", [upline_id, cursor_id])]
     else:
-        text = "No referrals found."
-
-    bot.send_message(message.chat.id, text, parse_mode="Markdown")
+        order = "DESC"
+        if cursor_id is None:
+            ranges = []
+        elif upline_id is None:
+            ranges = [("upline_id IS NULL AND chat_id < ?", [cursor_id])]
+        else:
+            ranges = [("(upline_id, chat_id) < (?, ?)", [upline_id, cursor_id]), ("upline_id IS NULL", [])]
+
+    rows = []
+    for where, params in ranges:
+        c.execute(f"SELECT chat_id, upline_id, username FROM users WHERE referral_link IS NOT NULL AND {where} "
+                  f"ORDER BY upline_id {order}, chat_id {order} LIMIT ?", params + [limit + 1 - len(rows)])
+        rows += c.fetchall()
+        if len(rows) > limit:
+            break
+    more = len(rows) > limit
+    rows = rows[:limit]
+    if before is not None:
+        rows.reverse()
+    return rows, more
+
+# Render a page of referrals grouped by upline, with prev/next buttons
+def render_referrals_page(after=None, before=None):
+    rows, more = fetch_referrals_page(after=after, before=before)
+    if not rows:
+        return "No referrals found.", None
+
+    text = "All referrals:\n\n"
+    groups = []
+    for chat_id, upline_id, username in rows:
+        if not groups or groups[-1][0] != upline_id:
+            groups.append((upline_id, []))
+        groups[-1][1].append(f"{chat_id} ({html.escape(str(username)) if username else 'N/A'})")
+    for upline_id, downlines in groups:
+        text += f"Upline {html.escape(str(upline_id))}:\n<pre>{', '.join(downlines)}</pre>\n\n"
 
-@bot.callback_query_handler(func=lambda call: True)
-def iq_callback(call):
-    data = call.data
-    user_id = call.from_user.id
     keyboard = telebot.types.InlineKeyboardMarkup()
-    
-    if data == 'details':
-        keyboard.add(
-            telebot.types.InlineKeyboardButton('Join Airdrop Campaign', callback_data='joinairdrop')
-        )
-        text = str("Fifareward is a layer 2 blockchain on BSC network, it is the first decentralized AI revolutionary betting Dapp on the blockchain. \n\n" +
-        "Utilities include: \n\n" +
-        "1) Soccer Betting\n" +
-        "2) Staking Protocol\n" +
-        "3) Farming Protocol\n" + 
-        "4) AI Powered Games\n" +
-        "5) NFT Minting Engine And Market Place \n\n" +
-        "==>) More in our road map \n\n" 
-        )
-        bot.answer_callback_query(call.id)
-        bot.send_chat_action(call.message.chat.id, 'typing')
-        bot.send_message(
-            call.message.chat.id,
-            text,
-            reply_markup=keyboard
-        )
-    
-    if data == 'joinairdrop':
-        keyboard.add(
-            telebot.types.InlineKeyboardButton("Have Completed Tasks", callback_data='Done')
+    has_prev = more if before is not None else after is not None
+    has_next = more if before is None else True
+    buttons = []
+    if has_prev:
+        buttons.append(telebot.types.InlineKeyboardButton("« Prev", callback_data=f"allrefs_prev_{rows[0][0]}"))
+    if has_next:
+        buttons.append(telebot.types.InlineKeyboardButton("Next »", callback_data=f"allrefs_next_{rows[-1][0]}"))
+    if buttons:
+        keyboard.add(*buttons)
+    keyboard.add(telebot.types.InlineKeyboardButton("Download Full Referral Tree", callback_data="download_referraltree_csv"))
+    return text, keyboard
+
+@router.command('view_all_referrals')
+def view_all_referrals(message):
+    text, keyboard = render_referrals_page()
+    outbox.send_message(message.chat.id, text, reply_markup=keyboard, parse_mode="HTML")
+
+@router.callback_prefix('allrefs')
+def page_all_referrals(call):
+    _, direction, cursor_id = call.data.split('_', 2)
+    if direction == 'next':
+        text, keyboard = render_referrals_page(after=int(cursor_id))
+    else:
+        text, keyboard = render_referrals_page(before=int(cursor_id))
+    outbox.answer_callback_query(call.id)
+    outbox.edit_message_text(text, call.message.chat.id, call.message.message_id,
+                          reply_markup=keyboard, parse_mode="HTML")
+
+@router.callback('details')
+@nonblocking
+def show_details(call):
+    outbox.answer_callback_query(call.id)
+    outbox.send_chat_action(call.message.chat.id, 'typing')
+    outbox.send_message(call.message.chat.id, DETAILS_TEXT, reply_markup=DETAILS_KEYBOARD)
+
+@router.callback('joinairdrop')
+@nonblocking
+def show_join_airdrop(call):
+    outbox.answer_callback_query(call.id)
+    outbox.send_chat_action(call.message.chat.id, 'typing')
+    outbox.send_message(call.message.chat.id, JOIN_AIRDROP_TEXT, reply_markup=TASKS_KEYBOARD, parse_mode="HTML")
+
+@router.callback('BackToTasks')
+@nonblocking
+def show_tasks(call):
+    outbox.answer_callback_query(call.id)
+    outbox.send_chat_action(call.message.chat.id, 'typing')
+    outbox.send_message(call.message.chat.id, TASKS_TEXT, reply_markup=TASKS_KEYBOARD, parse_mode="HTML")
+
+@router.callback('Done')
+@nonblocking
+def show_submission_options(call):
+    outbox.send_chat_action(call.message.chat.id, 'typing')
+    outbox.send_message(call.message.chat.id, SUBMISSION_TEXT, reply_markup=SUBMISSION_KEYBOARD, parse_mode="HTML")
+
+@router.callback('status')
+@nonblocking
+def show_status(call):
+    conn, c = get_connection()
+    chat_id = call.message.chat.id
+    c.execute("SELECT chat_id, referral_link, count FROM users WHERE chat_id=? AND referral_link IS NOT NULL", (chat_id,))
+    data = c.fetchone()
+    log.debug("status lookup", extra={'fields': {'chat_id': chat_id, 'found': data is not None}})
+    if data is not None:
+        count = data[2]
+        referral_link = data[1]
+        levels = downline_levels(chat_id)
+        network = ", ".join(f"level {depth}: {total}" for depth, total in levels)
+        keyboard = BACK_TO_TASKS_KEYBOARD
+        text = (
+            f"You have *{count}* referrals. \n\n"
+            f"Your network: *{sum(total for depth, total in levels)}* ({network}). \n\n"
+            f"Your rank: *#{referral_rank(count)}* \n\n"
+            f"Here is your referral link: {referral_link}.\n\n"
+            f"Keep sharing to earn a top spot in FRD waiting list"
         )
-        discord = f"https://discord.gg/aQ7bjShzHy"
-        telegramgroup = f"https://t.me/FifarewardLabs"
-        twitter = f"https://twitter.com/@FRD_Labs"
-        
-        text = f"To join the Fifareward airdrop waiting list, you must do the following tasks. \n\n" + \
-        "Join our;\n\n" + \
-        f"1) <a href=\"{telegramgroup}\">Telegram</a> \n" + \
-        f"2) <a href=\"{discord}\">Discord</a> \n" + \
-        f"3) <a href=\"{twitter}\">Twitter</a> \n" + \
-        f"4) Like and retweet our tweets \n" + \
-        f"5) Connect to our dapp using <a href=\"https://link.trustwallet.com/open_url?&url=https://www.fifareward.io\"> trust wallet </a> or <a href=\"https://metamask.app.link/dapp/www.fifareward.io\"> metmask</a>, in your wallet, enter https://www.fifareward.io in the browser address bar and connect to fifareward dapp. \n\n" + \
-        bot.answer_callback_query(call.id)
-        bot.send_chat_action(call.message.chat.id, 'typing')
-        bot.send_message(
+        outbox.send_chat_action(call.message.chat.id, 'typing')
+        outbox.send_message(
             call.message.chat.id,
             text,
             reply_markup=keyboard,
-            parse_mode="HTML"
-        )
-        
-    if data == 'BackToTasks':
-        keyboard.add(
-            telebot.types.InlineKeyboardButton("Have Completed Tasks", callback_data='Done')
+            parse_mode="Markdown"  # Ensure proper Markdown parsing
         )
-        discord = f"https://discord.com/invite/DC5Ta8bb"
-        telegramgroup = f"https://t.me/FifarewardLabs"
-        twitter = f"https://twitter.com/@FRD_Labs"
-        
-        text = f"To join the Fifareward airdrop waiting list, you must do the following tasks. \n\n" + \
-       "Join our;\n\n" + \
-       f"1) <a href=\"{twitter}\">Twitter</a> \n" + \
-       f"2) <a href=\"{discord}\">Discord</a> \n" + \
-       f"3) <a href=\"{telegramgroup}\">Telegram</a> \n" + \
-       f"4) Connect to our dapp using <a href=\"https://link.trustwallet.com/open_url?&url=https://www.fifareward.io\"> trust wallet </a> or <a href=\"https://metamask.app.link/dapp/www.fifareward.io\"> metmask</a>, in your wallet, enter https://www.fifareward.io in the browser address bar and connect to fifareward dapp. \n\n" + \
-       "5) Like and retweet our tweets \n\n"
-        bot.answer_callback_query(call.id)
-        bot.send_chat_action(call.message.chat.id, 'typing')
-        bot.send_message(
+    else:
+        outbox.send_message(
             call.message.chat.id,
-            text,
-            reply_markup=keyboard,
-            parse_mode="HTML"
-        )
-        
-    if data == 'Done':
-        keyboard.add(
-            telebot.types.InlineKeyboardButton("Submit Email Address", callback_data='Email'),
-            telebot.types.InlineKeyboardButton("Submit Wallet Address", callback_data='Wallet')
-        )
-        keyboard.add(
-            telebot.types.InlineKeyboardButton("Submit Twitter Username", callback_data='TwitterUsername')
+            "No referral data found for your account.",
+            parse_mode="Markdown"
         )
-        keyboard.add(
-            telebot.types.InlineKeyboardButton("Have Submitted All Details", callback_data='Continue')
+
+@router.callback('Continue')
+@nonblocking
+def show_continue_status(call):
+    keyboard = REFERRALS_MENU_KEYBOARD
+    conn, c = get_connection()
+    chat_id = call.message.chat.id
+
+    c.execute("SELECT chat_id, referral_link, count FROM users WHERE chat_id=? AND referral_link IS NOT NULL", (chat_id,))
+    data = c.fetchone()
+    if data is not None:
+        count = data[2]
+        referral_link = data[1]
+        text = (
+            f"You have *{count}* referrals. \n\n"
+            f"Your rank: *#{referral_rank(count)}* \n\n"
+            f"Here is your referral link: {referral_link}.\n\n"
+            f"Keep sharing to earn a top spot in FRD waiting list"
         )
-        text = str("Congratulations!, we will verify that you have completed all the tasks, please submit your wallet address, verified twitter username and email address for the waiting list. \n\n")
-        bot.send_chat_action(call.message.chat.id, 'typing')
-        bot.send_message(
+        outbox.send_chat_action(call.message.chat.id, 'typing')
+        outbox.send_message(
             call.message.chat.id,
             text,
             reply_markup=keyboard,
-            parse_mode="HTML"
-        )
-    
-    if data == 'status':
-        conn, c = get_connection()
-        chat_id = call.message.chat.id
-        print("chat id--",chat_id)
-        c.execute("SELECT * FROM referrals WHERE chat_id =?", (chat_id,))
-        data = c.fetchone()
-        print("data o",data)
-        if data is not None:
-            # c.execute("SELECT * FROM referrals WHERE upline_id=?", (chat_id,))
-            # data_ = c.fetchone()
-            # print("pop",data_)
-            # conn.close()  # Ensure the connection is closed
-            count = data[2]
-            referral_link = data[1]
-            keyboard = telebot.types.InlineKeyboardMarkup()
-            keyboard.add(telebot.types.InlineKeyboardButton("Back To Tasks", callback_data='BackToTasks'))
-            text = (
-                f"You have *{count}* referrals. \n\n"
-                f"Here is your referral link: {referral_link}.\n\n"
-                f"Keep sharing to earn a top spot in FRD waiting list"
-            )
-            bot.send_chat_action(call.message.chat.id, 'typing')
-            bot.send_message(
-                call.message.chat.id,
-                text,
-                reply_markup=keyboard,
-                parse_mode="Markdown"  # Ensure proper Markdown parsing
-            )
-        else:
-            bot.send_message(
-                call.message.chat.id,
-                "No referral data found for your account.",
-                parse_mode="Markdown"
-            )
-        
-    # if data == "Wallet":
-    #     print("uiopa")
-    #     bot.send_message(call.message.chat.id, "Please enter your BEP20 wallet address:")
-    #     user_states[user_id] = STATE_WAITING_FOR_ADDRESS
-    #     address = call.message.text
-    #     if address_pattern.match(address):
-    #         conn, c = get_connection()
-    #         c.execute("INSERT INTO bep20_addresses (chat_id, bep20_address) VALUES (?, ?)", (user_id, address))
-    #         conn.commit()
-    #         conn.close()
-            
-    #         generate_bep20_csv()
-    #         text = f"Hi! {call.message.from_user.first_name}\n\nYour BEP20 address is saved successfully. Please wait for our airdrop community distribution."
-    #     else:
-    #         text = "Please send only your BEP20 address, don't attach any other text or number to it."
-    #     bot.send_message(call.message.chat.id, text, parse_mode="Markdown")
-    #     del user_states[user_id]
-            
-    # if data == "Email":
-    #     print("poiul")
-    #     bot.send_message(call.message.chat.id, "Please enter your email address:")
-    #     user_states[user_id] = STATE_WAITING_FOR_EMAIL
-    #     print("oplyu",user_states[user_id])
-    #     email = call.message.text
-    #     print("joes",email)
-    #     if user_states[user_id]:
-    #         if email_pattern.match(email):
-    #             conn, c = get_connection()
-    #             c.execute("INSERT INTO email_address (chat_id, email_address) VALUES (?, ?)", (user_id, email))
-    #             conn.commit()
-    #             conn.close()
-                
-    #             generate_email_csv()
-    #             text = f"Hi! {call.message.from_user.first_name}\n\nYour email address is saved successfully. Please wait for our airdrop community distribution."
-    #         else:
-    #             text = "Please send a valid email address."
-    #         bot.send_message(call.message.chat.id, text, parse_mode="Markdown")
-    #     del user_states[user_id]
-        
-    if data == "Continue":
-        conn, c = get_connection()
-        chat_id = call.message.chat.id
-        
-        keyboard.add(
-            telebot.types.InlineKeyboardButton("My Referrals", callback_data='MyReferrals'),
-            telebot.types.InlineKeyboardButton("Back To Tasks", callback_data='BackToTasks')
+            parse_mode="Markdown"  # Ensure proper Markdown parsing
         )
-        
-        
-        c.execute("SELECT * FROM referrals WHERE chat_id=?", (chat_id,))
-        data = c.fetchone()
-        if data is not None:
-            # c.execute("SELECT * FROM referrals WHERE upline_id=? AND chat_id != upline_id", (chat_id,))
-            # data_ = c.fetchone()
-            # if data_ is not None:
-            count = data[2]
-            referral_link = data[1]
-            text = (
-                f"You have *{count}* referrals. \n\n"
-                f"Here is your referral link: {referral_link}.\n\n"
-                f"Keep sharing to earn a top spot in FRD waiting list"
-            )
-            bot.send_chat_action(call.message.chat.id, 'typing')
-            bot.send_message(
-                call.message.chat.id,
-                text,
-                reply_markup=keyboard,
-                parse_mode="Markdown"  # Ensure proper Markdown parsing
-            )
-            
-        conn.close()
-        
 
-@bot.message_handler(func=lambda message: True)
+@router.default_message
+@nonblocking
 def echo_all(message):
     conn, c = get_connection()
     chat_id = message.chat.id
     
-    c.execute("SELECT * FROM referrals WHERE chat_id=?", (chat_id,))
+    c.execute("SELECT chat_id, referral_link, count FROM users WHERE chat_id=? AND referral_link IS NOT NULL", (chat_id,))
     data = c.fetchone()
     
     if not data :
-        text = str("Hi! " + message.from_user.first_name + "\n\n" +
-                "You must join using someone's referral link to participate in Fifareward airdrop.")
+        text = "Hi! " + message.from_user.first_name + "\n\n" + NOT_REFERRED_TEXT
         
-        bot.send_photo(
+        media_cache.send_photo(
             message.chat.id,
-            'https://www.fifareward.io/fifarewardlogo.png',
+            LOGO_URL,
             caption=text,
             parse_mode="Markdown"
         )
@@ -832,82 +2692,653 @@ def echo_all(message):
             f"Here is your referral link: {referral_link}.\n\n"
             f"Keep sharing to earn a top spot in FRD waiting list"
         )
-        bot.send_chat_action(message.chat.id, 'typing')
-        bot.send_message(
+        outbox.send_chat_action(message.chat.id, 'typing')
+        outbox.send_message(
             message.chat.id,
             text,
             parse_mode="Markdown"  # Ensure proper Markdown parsing
         )
-        
-    conn.close()
-    
-# Handler for callback queries
-# @bot.callback_query_handler(func=lambda call: call.data in ['Wallet', 'Email'])
-# def handle_wallet_email_callback(call):
-#     print("occured")
-#     user_id = call.from_user.id
-#     if call.data == 'Wallet':
-#         bot.send_message(call.message.chat.id, "Please enter your BEP20 wallet address:")
-#         user_states[user_id] = STATE_WAITING_FOR_ADDRESS
-#     elif call.data == 'Email':
-#         bot.send_message(call.message.chat.id, "Please enter your email address:")
-#         user_states[user_id] = STATE_WAITING_FOR_EMAIL
-#     bot.answer_callback_query(call.id, "Please enter your information.")
-            
-# Handler for text messages to capture user input
-# @bot.message_handler(func=lambda message: message.from_user.id in user_states)
-# def handle_user_input(message):
-#     print("occureed too")
-#     user_id = message.from_user.id
-#     state = user_states.get(user_id)
-
-#     if state == STATE_WAITING_FOR_ADDRESS:
-#         address = message.text
-#         if address_pattern.match(address):
-#             conn, c = get_connection()
-#             c.execute("INSERT INTO bep20_addresses (chat_id, bep20_address) VALUES (?, ?)", (user_id, address))
-#             conn.commit()
-#             conn.close()
-            
-#             generate_bep20_csv()
-#             text = f"Hi! {message.from_user.first_name}\n\nYour BEP20 address is saved successfully. Please wait for our airdrop community distribution."
-#         else:
-#             text = "Please send only your BEP20 address, don't attach any other text or number to it."
-
-#     elif state == STATE_WAITING_FOR_EMAIL:
-#         email = message.text
-#         if email_pattern.match(email):
-#             conn, c = get_connection()
-#             c.execute("INSERT INTO email_address (chat_id, email_address) VALUES (?, ?)", (user_id, email))
-#             conn.commit()
-#             conn.close()
-            
-#             generate_email_csv()
-#             text = f"Hi! {message.from_user.first_name}\n\nYour email address is saved successfully. Please wait for our airdrop community distribution."
-#         else:
-#             text = "Please send a valid email address."
-
-#     bot.send_message(message.chat.id, text, parse_mode="Markdown")
-#     del user_states[user_id]
-
-# Create the table if not exists
-create_tables()
-
-def run_bot():
+
+# Bring the schema up to date (a no-op unless this is the first start after an upgrade)
+migrate()
+user_states.load()
+media_cache.load()
+update_ledger.load()
+
+# Run EXPLAIN QUERY PLAN over every SQL literal in this file and flag full table scans.
+# Statements without a WHERE clause (exports, clear_data) or marked /* full scan */ read
+# whole tables on purpose and are only reported; a scan in a statement that filters means
+# a missing index.
+def explain_queries(path=__file__):
+    with open(path) as file:
+        tree = ast.parse(file.read())
+    # Pieces of f-strings are not complete statements
+    fragments = {id(value) for node in ast.walk(tree) if isinstance(node, ast.JoinedStr) for value in node.values}
+    statements = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Constant) and isinstance(node.value, str) and id(node) not in fragments:
+            sql = ' '.join(node.value.split())
+            if re.match(r'(/\* full scan \*/ )?(SELECT|INSERT|UPDATE|DELETE|WITH)\s', sql):
+                statements.append((node.lineno, sql))
+
+    conn, c = get_connection()
+    # Scans of subqueries and CTEs read rows another step already produced; only tables count
+    tables = {row[0] for row in c.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    flagged = 0
+    for lineno, sql in sorted(statements):
+        try:
+            plan = c.execute('EXPLAIN QUERY PLAN ' + sql, [None] * sql.count('?')).fetchall()
+        except sqlite3.Error as e:
+            print(f"line {lineno}: ERROR {e}\n    {sql}")
+            flagged += 1
+            continue
+        scans = [row[3] for row in plan if row[3].startswith('SCAN ') and row[3].split()[1] in tables]
+        if scans and ' where ' in sql.lower() and not sql.startswith('/* full scan */'):
+            status = 'FLAGGED'
+            flagged += 1
+        elif scans:
+            status = 'full read'
+        else:
+            status = 'ok'
+        print(f"line {lineno}: {status}\n    {sql}")
+        for row in plan:
+            print(f"      {row[3]}")
+    print(f"{len(statements)} statements checked, {flagged} flagged")
+    return 1 if flagged else 0
+
+# Bulk import (`python bot.py import KIND SOURCE`) into users from a CSV file (as written by
+# /download_csv: same columns, header optional, .gz allowed) or a table of another SQLite
+# database such as referral_data.db. Rows are checked like user input and loaded
+# IMPORT_BATCH_SIZE at a time: executemany into a temp table, then one upsert per writer
+# transaction. A conflict is a user who already has a value in the kind's key column:
+# 'skip' keeps the existing row, 'overwrite' replaces it (columns missing from the source are
+# kept, and so are the kind's 'keep' columns), 'report' keeps it and writes the differing
+# values as CSV to stdout.
+IMPORTS = {
+    'bep20': {'table': 'bep20_addresses', 'columns': ['chat_id', 'bep20_address'], 'key': 'bep20_address'},
+    'email': {'table': 'email_address', 'columns': ['chat_id', 'email_address'], 'key': 'email_address'},
+    'twitterusernames': {'table': 'twitterusernames', 'columns': ['chat_id', 'twitter_username'],
+                         'key': 'twitter_username'},
+    # Referral rows feed the indexes and rank triggers on users; those are dropped for the
+    # import and rebuilt once at the end. A member keeps the upline that was credited when
+    # they joined, as with /start: the referral graph is only ever extended.
+    'referrals': {'table': 'referrals', 'columns': ['chat_id', 'referral_link', 'count', 'upline_id', 'username'],
+                  'key': 'referral_link', 'keep': ('upline_id',), 'defer_indexes': True},
+}
+IMPORT_INTEGER_COLUMNS = ('chat_id', 'count', 'upline_id')
+IMPORT_PATTERNS = {'bep20_address': address_pattern, 'email_address': email_pattern}
+IMPORT_REJECTS_LOGGED = 10
+
+def import_users(kind, path, on_conflict='skip', table=None, batch_size=IMPORT_BATCH_SIZE, out=sys.stdout):
+    spec = IMPORTS[kind]
+    checks = [_import_check(spec, column) for column in spec['columns']]
+    uplines = spec['columns'].index('upline_id') if 'upline_id' in spec['columns'] else None
+    rows = read_import_source(path, spec['columns'], table or spec['table'])
+    report = csv.writer(out) if on_conflict == 'report' else None
+    if report:
+        report.writerow(['Chat ID', 'Existing', 'Imported'])
+    totals = collections.Counter()
+    linked = False
+    started = time.monotonic()
+
+    def collect(future, has_uplines):
+        nonlocal linked
+        written, conflicts, kept = future.result()
+        totals['written'] += written
+        totals['conflicts'] += len(conflicts)
+        totals['kept'] += kept
+        if report:
+            report.writerows(conflicts)
+        linked = linked or bool(written and has_uplines)
+        log.info(f"Importing {kind} from {path}", extra={'fields': dict(totals)})
+
+    if spec.get('defer_indexes'):
+        db_writer.submit(_defer_users_indexes).result()
+    try:
+        pending = None
+        for chunk in iter(lambda: list(itertools.islice(rows, batch_size)), []):
+            batch = []
+            for number, values in chunk:
+                try:
+                    batch.append(_import_row(checks, values))
+                except ValueError as e:
+                    totals['rejected'] += 1
+                    if totals['rejected'] <= IMPORT_REJECTS_LOGGED:
+                        log.warning(f"{path}:{number}: {e}, row skipped")
+            totals['read'] += len(chunk)
+            if not batch:
+                continue
+            # This batch was checked while the writer committed the previous one
+            if pending:
+                collect(*pending)
+            has_uplines = uplines is not None and any(row[uplines] is not None for row in batch)
+            pending = (db_writer.submit(_import_batch, kind, batch, on_conflict), has_uplines)
+        if pending:
+            collect(*pending)
+    finally:
+        if spec.get('defer_indexes'):
+            db_writer.submit(_restore_users_indexes).result()
+    if linked:
+        backfill_referral_graph()
+    if totals['kept']:
+        log.warning(f"Kept the existing {', '.join(spec['keep'])} of {totals['kept']} users")
+    log.info(f"Imported {kind} from {path}",
+             extra={'fields': dict(totals, seconds=round(time.monotonic() - started, 3))})
+    return 1 if totals['rejected'] else 0
+
+# (line or row number, values) from a CSV file or from `table` of a SQLite database
+def read_import_source(path, columns, table):
+    with open(path, 'rb') as file:
+        is_sqlite = file.read(16) == b'SQLite format 3\x00'
+    if is_sqlite:
+        return _read_import_table(path, columns, table)
+    return _read_import_csv(path)
+
+def _read_import_csv(path):
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', newline='', encoding='utf-8-sig') as file:
+        reader = csv.reader(file)
+        for values in reader:
+            # The exports start with a header row, which has no chat id in the first column
+            if reader.line_num == 1 and values and not values[0].strip().lstrip('-').isdigit():
+                continue
+            if values:
+                yield reader.line_num, values
+
+# Columns the table doesn't have are read as NULL
+def _read_import_table(path, columns, table):
+    conn = sqlite3.connect(f"file:{urllib.request.pathname2url(os.path.abspath(path))}?mode=ro", uri=True)
+    present = {column[1] for column in conn.execute(f'PRAGMA table_info("{table}")')}
+    if not present:
+        conn.close()
+        raise ValueError(f"{path} has no table {table}")
+    select = ', '.join(f'"{column}"' if column in present else 'NULL' for column in columns)
+    return _read_import_rows(conn, f'SELECT {select} FROM "{table}"')
+
+def _read_import_rows(conn, sql):
+    try:
+        yield from enumerate(conn.execute(sql), 1)
+    finally:
+        conn.close()
+
+# Check and convert one source row; raises ValueError saying what is wrong with it
+def _import_row(checks, values):
+    if len(values) < len(checks):
+        values = list(values) + [None] * (len(checks) - len(values))
+    return [check(value) for check, value in zip(checks, values)]
+
+# Check for one column: blank text is None, integer columns are converted and text columns
+# matched against IMPORT_PATTERNS. chat_id and the key column can't be missing.
+def _import_check(spec, column):
+    required = column in ('chat_id', spec['key'])
+    pattern = IMPORT_PATTERNS.get(column)
+    integer = column in IMPORT_INTEGER_COLUMNS
+
+    def check(value):
+        if isinstance(value, str):
+            value = value.strip() or None
+        if value is None:
+            if required:
+                raise ValueError(f"no {column}")
+            return None
+        if integer:
+            try:
+                return int(value)
+            except ValueError:
+                raise ValueError(f"{column} {value!r} is not an integer") from None
+        value = str(value)
+        if pattern and not pattern.match(value):
+            raise ValueError(f"{column} {value!r} is not valid")
+        return value
+    return check
+
+# Write intent: stage rows in a temp table and upsert them into users in one statement.
+# Returns (rows inserted or changed, conflicts to report as (chat_id, existing, imported),
+# rows whose 'keep' columns differed and were left as they were).
+def _import_batch(c, kind, rows, on_conflict):
+    spec = IMPORTS[kind]
+    columns = ', '.join(spec['columns'])
+    key = spec['key']
+    c.execute(f"CREATE TEMP TABLE IF NOT EXISTS import_{kind} ({columns})")
+    c.execute(f"DELETE FROM temp.import_{kind}")
+    c.executemany(f"INSERT INTO temp.import_{kind} VALUES ({', '.join('?' * len(spec['columns']))})", rows)
+    conflicts = []
+    if on_conflict == 'report':
+        c.execute(f"SELECT s.chat_id, u.{key}, s.{key} FROM temp.import_{kind} s JOIN users u ON u.chat_id = s.chat_id "
+                  f"WHERE u.{key} IS NOT NULL AND u.{key} != s.{key}")
+        conflicts = c.fetchall()
+    kept = 0
+    if on_conflict == 'overwrite' and spec.get('keep'):
+        differs = ' OR '.join(f"(s.{column} IS NOT NULL AND s.{column} IS NOT u.{column})" for column in spec['keep'])
+        c.execute(f"SELECT COUNT(*) FROM temp.import_{kind} s JOIN users u ON u.chat_id = s.chat_id "
+                  f"WHERE u.{key} IS NOT NULL AND ({differs})")
+        kept = c.fetchone()[0]
+    updates = ', '.join(f"{column} = IIF(users.{key} IS NULL, IFNULL(excluded.{column}, users.{column}), users.{column})"
+                        if column in spec.get('keep', ()) else f"{column} = IFNULL(excluded.{column}, users.{column})"
+                        for column in spec['columns'][1:])
+    keep = '' if on_conflict == 'overwrite' else f" WHERE users.{key} IS NULL"
+    c.execute(f"INSERT INTO users ({columns}) SELECT {columns} FROM temp.import_{kind} WHERE true "
+              f"ON CONFLICT (chat_id) DO UPDATE SET {updates}{keep}")
+    written = c.rowcount
+    c.execute(f"DELETE FROM temp.import_{kind}")
+    return written, conflicts, kept
+
+# Webhook intake (BOT_MODE=webhook): an embedded HTTP endpoint for Telegram's webhook, to sit
+# behind a TLS-terminating proxy or load balancer. Each POST to WEBHOOK_PATH carries one update
+# (or a JSON list of them); a request without the X-Telegram-Bot-Api-Secret-Token header
+# matching WEBHOOK_SECRET is refused (403), and a malformed one gets 400. Updates are handed to
+# update_workers and acknowledged at once. When the chat's worker queue is full the endpoint
+# answers 503, and Telegram redelivers later.
+class WebhookServer:
+    def __init__(self, listen=WEBHOOK_LISTEN, port=WEBHOOK_PORT, path=WEBHOOK_PATH, secret=WEBHOOK_SECRET):
+        # Anyone who can reach the endpoint could otherwise post updates as any user, admins included
+        if not secret:
+            raise ValueError("WEBHOOK_SECRET must be set to receive updates by webhook")
+        self.path = path
+        self.secret = secret
+        self.server = http.server.ThreadingHTTPServer((listen, port), self._request_handler())
+        self.server.daemon_threads = True
+
+    def _request_handler(self):
+        webhook = self
+
+        class WebhookRequestHandler(http.server.BaseHTTPRequestHandler):
+            def do_POST(self):
+                if self.path != webhook.path:
+                    return self._reply(404)
+                token = self.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+                if not hmac.compare_digest(token.encode(), webhook.secret.encode()):
+                    return self._reply(403)
+                try:
+                    length = int(self.headers.get('Content-Length') or 0)
+                except ValueError:
+                    return self._reply(400)
+                if length < 0:
+                    return self._reply(400)
+                if length > WEBHOOK_MAX_BODY:
+                    return self._reply(413)
+                try:
+                    payload = json.loads(self.rfile.read(length))
+                    payload = payload if isinstance(payload, list) else [payload]
+                    if not all(isinstance(update, dict) for update in payload):
+                        return self._reply(400)
+                    updates = [telebot.types.Update.de_json(update) for update in payload]
+                except (ValueError, KeyError, TypeError):
+                    return self._reply(400)
+                for update in updates:
+                    if update_workers.submit(update, block=False) is None:
+                        return self._reply(503)
+                self._reply(200)
+
+            def _reply(self, status):
+                self.send_response(status)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        return WebhookRequestHandler
+
+    # Serve until stop() is called
+    def serve(self):
+        self.server.serve_forever()
+
+    def stop(self):
+        self.server.shutdown()
+
+# Local status endpoint on METRICS_LISTEN:METRICS_PORT, served from a background thread:
+# GET /metrics for `metrics`, /healthz and /readyz for `health` (200, or 503 listing the problems).
+class MetricsServer:
+    def __init__(self, listen=METRICS_LISTEN, port=METRICS_PORT):
+        self.server = http.server.ThreadingHTTPServer((listen, port), self._request_handler())
+        self.server.daemon_threads = True
+        self._thread = threading.Thread(target=self.server.serve_forever, name='metrics', daemon=True)
+
+    def _request_handler(self):
+        class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                path = self.path.split('?', 1)[0]
+                status, content_type = 200, 'text/plain; charset=utf-8'
+                if path == '/metrics':
+                    body = metrics.render()
+                    content_type = 'text/plain; version=0.0.4; charset=utf-8'
+                elif path in ('/healthz', '/readyz'):
+                    problems = health.liveness() if path == '/healthz' else health.readiness()
+                    status = 503 if problems else 200
+                    body = '\n'.join(problems or ['ok']) + '\n'
+                else:
+                    status, body = 404, ''
+                body = body.encode()
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return MetricsRequestHandler
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+# Start the metrics endpoint unless METRICS_PORT is 0. A port that is already taken only
+# costs the endpoint, not the bot.
+def start_metrics_server():
+    if not METRICS_PORT:
+        return None
+    try:
+        return MetricsServer().start()
+    except OSError as e:
+        log.warning(f"Metrics endpoint not started on {METRICS_LISTEN}:{METRICS_PORT}: {e}")
+        return None
+
+# telebot's CUSTOM_REQUEST_SENDER for the asyncio engine: perform the request on `loop`'s shared
+# httpx client. Transport errors are raised as their requests counterparts, which the outbox
+# retries like any other network error.
+def async_request_sender(loop, client):
+    import httpx
+
+    def send_request(method, url, params=None, files=None, timeout=None, proxies=None):
+        connect_timeout, read_timeout = timeout
+        request = client.request(method.upper(), url, params=params, files=files,
+                                 timeout=httpx.Timeout(read_timeout, connect=connect_timeout))
+        try:
+            response = asyncio.run_coroutine_threadsafe(request, loop).result()
+        except httpx.TimeoutException as e:
+            raise requests.exceptions.Timeout(str(e) or type(e).__name__) from e
+        except httpx.TransportError as e:
+            raise requests.exceptions.ConnectionError(str(e) or type(e).__name__) from e
+        response.reason = response.reason_phrase  # read by telebot's ApiHTTPException
+        return response
+    return send_request
+
+# Asyncio engine (BOT_ENGINE=asyncio): python-telegram-bot's Application long-polls over its
+# httpx pool and runs up to ASYNC_MAX_UPDATES updates at a time, through the same router as
+# the telebot engine. Each update is a task on the event loop. The updates of one chat still
+# run one after the other, in arrival order.
+# - Hot handlers (/start, the forms, status taps) are marked @nonblocking and run on the loop
+#   itself; their writes are awaited, so thousands can be waiting on the database at once.
+# - Every other handler runs on a pool of UPDATE_WORKERS threads.
+# Outbound API calls made by the outbox are sent through one pooled httpx.AsyncClient on the
+# event loop instead of a requests session per sender thread.
+def run_async_bot():
+    from telegram import Update
+    from telegram.ext import ApplicationBuilder, TypeHandler
+    import httpx
+
+    state = {}
+    # chat id -> Future resolved once that chat's latest update has been handled
+    chat_tails = {}
+
+    async def post_init(application):
+        loop = state['loop'] = asyncio.get_running_loop()
+        loop.set_default_executor(concurrent.futures.ThreadPoolExecutor(UPDATE_WORKERS, thread_name_prefix='handler'))
+        state['client'] = httpx.AsyncClient(limits=httpx.Limits(max_connections=ASYNC_HTTP_POOL_SIZE))
+        telebot.apihelper.CUSTOM_REQUEST_SENDER = async_request_sender(loop, state['client'])
+        await loop.run_in_executor(None, bot_identity.refresh)
+        await loop.run_in_executor(None, resume_broadcasts)
+        health.intake = 'asyncio'
+
+    async def post_shutdown(application):
+        health.draining = True
+        state['deadline'] = time.monotonic() + SHUTDOWN_DEADLINE
+        # The outbox still needs the loop to send what it has queued
+        await state['loop'].run_in_executor(None, drain_pipeline, state['deadline'])
+        telebot.apihelper.CUSTOM_REQUEST_SENDER = None
+        await state['client'].aclose()
+
+    async def handle_update(update, context):
+        update = telebot.types.Update.de_json(update.to_dict())
+        chat_id = UpdateWorkers.chat_id(update)
+        previous = chat_tails.get(chat_id)
+        done = chat_tails[chat_id] = state['loop'].create_future()
+        try:
+            if previous is not None:
+                await previous
+            await dispatch(update)
+        finally:
+            done.set_result(None)
+            if chat_tails.get(chat_id) is done:
+                del chat_tails[chat_id]
+
+    async def dispatch(update):
+        if not update_ledger.begin(update.update_id):
+            return
+        try:
+            handler, arg = router.resolve(update)
+            if handler is None:
+                return
+            if getattr(handler, 'nonblocking', False):
+                await router.run_async(handler, arg)
+            else:
+                # to_thread carries the context over, so update_ledger.current() works there
+                await asyncio.to_thread(router.run, handler, arg)
+        except Exception as e:
+            log.exception(f"Error handling update {update.update_id}: {e}")
+        finally:
+            update_ledger.done(update.update_id)
+
+    builder = (ApplicationBuilder()
+               .token(BOT_TOKEN)
+               .concurrent_updates(ASYNC_MAX_UPDATES)
+               .connection_pool_size(ASYNC_HTTP_POOL_SIZE)
+               .post_init(post_init)
+               .post_shutdown(post_shutdown))
+    if TELEGRAM_API_URL:
+        builder = builder.base_url(TELEGRAM_API_URL + '/bot').base_file_url(TELEGRAM_API_URL + '/file/bot')
+    application = builder.build()
+    application.add_handler(TypeHandler(Update, handle_update))
+    try:
+        application.run_polling(timeout=POLL_TIMEOUT, allowed_updates=['message', 'callback_query'])
+    finally:
+        close_database(state.get('deadline', time.monotonic() + SHUTDOWN_DEADLINE))
+
+# Liveness and readiness, served as /healthz and /readyz. Each check returns a list of
+# problems, empty when healthy. Live: the pipeline threads are running and the polling loop is
+# not stuck. Ready: also started, not shutting down, and (when polling) not backing off after
+# failed polls.
+# While draining, liveness stays up so the process is not killed before it has finished.
+class Health:
+    def __init__(self, stall=HEALTH_STALL_SECONDS):
+        self.stall = stall
+        self.intake = None  # 'polling', 'webhook' or 'asyncio' once updates are being taken in
+        self.draining = False
+        self.last_poll = None  # monotonic time of the last getUpdates attempt
+        self.poll_failures = 0  # failed polls since the last successful one
+
+    def liveness(self):
+        if self.draining:
+            return []
+        problems = []
+        if not db_writer.alive():
+            problems.append('database writer stopped')
+        if not outbox.alive():
+            problems.append('outbox stopped')
+        if not update_workers.alive():
+            problems.append('update worker stopped')
+        if self.intake == 'polling' and self._stale(self.last_poll):
+            problems.append('polling loop stalled')
+        return problems
+
+    def readiness(self):
+        problems = self.liveness()
+        if self.draining:
+            problems.append('shutting down')
+        elif self.intake is None:
+            problems.append('starting')
+        elif self.intake == 'polling' and self.poll_failures:
+            problems.append(f'polling failing ({self.poll_failures} attempts)')
+        return problems
+
+    def _stale(self, at):
+        return at is None or time.monotonic() - at > self.stall
+
+health = Health()
+
+# Long-poll getUpdates until `stop` is set and hand the updates to update_workers. A failed
+# poll (network error, Telegram 5xx, 409 while another instance polls) is retried after a
+# jittered exponential backoff, reset by the next successful poll. A 409 because a webhook is
+# registered never clears by itself, so the webhook is deleted before retrying. An
+# unauthorized token raises, since no retry will fix it.
+def poll_updates(stop, backoff_initial=POLL_BACKOFF_INITIAL, backoff_max=POLL_BACKOFF_MAX):
+    failures = 0
+    while not stop.is_set():
+        health.last_poll = time.monotonic()
+        try:
+            updates = bot.get_updates(offset=bot.last_update_id + 1, timeout=POLL_TIMEOUT + 10,
+                                      long_polling_timeout=POLL_TIMEOUT,
+                                      allowed_updates=['message', 'callback_query'])
+        except Exception as e:
+            reason = str(e)
+            if isinstance(e, telebot.apihelper.ApiTelegramException):
+                if e.error_code in (401, 404):
+                    raise
+                if e.error_code == 409 and 'webhook' in e.description.lower():
+                    reason = 'a webhook is registered'
+                    log.warning("getUpdates refused while a webhook is registered, deleting the webhook")
+                    remove_webhook()
+                elif e.error_code == 409:
+                    reason = 'another instance is polling with this token'
+            failures += 1
+            health.poll_failures = failures
+            ceiling = min(backoff_max, backoff_initial * 2 ** (failures - 1))
+            delay = random.uniform(ceiling / 2, ceiling)
+            metrics.inc('bot_poll_failures_total')
+            log.warning(f"Polling failed ({reason}), retrying in {delay:.1f}s",
+                        extra={'fields': {'failures': failures}})
+            stop.wait(delay)
+            continue
+        failures = health.poll_failures = 0
+        bot.process_new_updates(updates)
+
+# Long polling intake. Telegram refuses getUpdates while a webhook is registered, and a
+# webhook-mode run leaves its webhook in place, so delete it first.
+def start_polling(stop):
+    health.intake = 'polling'
+    remove_webhook()
+    poll_updates(stop)
+
+# deleteWebhook; True once Telegram has no webhook for the bot
+def remove_webhook():
+    try:
+        bot.delete_webhook()
+        return True
+    except Exception as e:
+        log.warning(f"Removing the webhook failed: {e}")
+        return False
+
+# Graceful drain, once intake has stopped: finish queued updates, let broadcasts checkpoint,
+# send what the outbox holds, then commit pending writes and close the database. Every step
+# gets what is left of the shared deadline.
+def drain_pipeline(deadline):
+    update_workers.stop(max(deadline - time.monotonic(), 0))
+    stop_broadcasts(max(deadline - time.monotonic(), 0))
+    outbox.stop(max(deadline - time.monotonic(), 0))
+
+def close_database(deadline):
+    db_writer.stop(max(deadline - time.monotonic(), 0))
+    if db_writer.alive():
+        log.error(f"Shutdown deadline passed with {db_writer.queue.qsize()} write intents not committed")
+    close_connections()
+
+def run_bot(mode=BOT_MODE):
+    webhook = None
+    if mode == 'webhook':
+        webhook = start_webhook()
+    stop = threading.Event()
+
     def handle_shutdown(signum, frame):
-        print(f"Signal {signum} received, shutting down...")
-        bot.stop_polling()
+        log.info(f"Signal {signum} received, shutting down...")
+        health.draining = True
+        stop.set()
+        if webhook is not None:
+            # shutdown() waits for serve_forever() to return, which runs on this thread
+            threading.Thread(target=webhook.server.shutdown, daemon=True).start()
 
     signal.signal(signal.SIGINT, handle_shutdown)
     signal.signal(signal.SIGTERM, handle_shutdown)
 
     try:
-        bot.infinity_polling(timeout=10, long_polling_timeout=5)
-    except requests.exceptions.ReadTimeout:
-        print("Read timeout occurred. Retrying in 15 seconds...")
-        time.sleep(15)
+        try:
+            bot_identity.refresh()
+        except Exception as e:
+            # Looked up again on first use
+            log.warning(f"Fetching the bot's identity failed: {e}")
+        resume_broadcasts()
+        if webhook is not None:
+            health.intake = 'webhook'
+            webhook.serve()
+        else:
+            start_polling(stop)
+    finally:
+        health.draining = True
+        deadline = time.monotonic() + SHUTDOWN_DEADLINE
+        if webhook is not None:
+            webhook.stop()
+        drain_pipeline(deadline)
+        close_database(deadline)
+
+# Bind the webhook endpoint and register it with Telegram. Returns None if either step fails:
+# the bot then falls back to long polling, which deletes the webhook first.
+# The webhook stays registered on shutdown so Telegram holds updates until the next start.
+# Without WEBHOOK_SECRET the endpoint would accept forged updates, so the bot refuses to start.
+def start_webhook():
+    if not WEBHOOK_URL:
+        log.warning("WEBHOOK_URL is not set, falling back to polling")
+        return None
+    if not WEBHOOK_SECRET:
+        raise RuntimeError("WEBHOOK_SECRET must be set to receive updates by webhook")
+    try:
+        webhook = WebhookServer()
+        bot.set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET, max_connections=100,
+                        allowed_updates=['message', 'callback_query'])
+        log.info(f"Receiving updates on {WEBHOOK_URL}")
+        return webhook
     except Exception as e:
-        print(f"An unexpected error occurred: {e}")
-        time.sleep(15)
+        log.warning(f"Webhook setup failed ({e}), falling back to polling")
+        return None
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='FRD airdrop bot')
+    commands = parser.add_subparsers(dest='command')
+    run = commands.add_parser('run', help='run the bot (default)')
+    run.add_argument('--engine', choices=['telebot', 'asyncio'], default=BOT_ENGINE)
+    run.add_argument('--mode', choices=['polling', 'webhook'], default=BOT_MODE,
+                     help='update intake for the telebot engine')
+    commands.add_parser('explain-queries', help='show query plans for every SQL statement and flag table scans')
+    bulk = commands.add_parser('import', help='bulk-load users from a CSV file or another SQLite database')
+    bulk.add_argument('kind', choices=sorted(IMPORTS))
+    bulk.add_argument('source', help='CSV file (.csv or .csv.gz) or SQLite database')
+    bulk.add_argument('--table', help='table to read from a SQLite source (default: the legacy table of KIND)')
+    bulk.add_argument('--on-conflict', choices=['skip', 'overwrite', 'report'], default='skip',
+                      help='for users who already have a value: keep it, replace it, or keep it and list the differences')
+    bulk.add_argument('--batch-size', type=int, default=IMPORT_BATCH_SIZE)
+    args = parser.parse_args(argv)
+
+    if args.command == 'explain-queries':
+        sys.exit(explain_queries())
+    if args.command == 'import':
+        try:
+            sys.exit(import_users(args.kind, args.source, args.on_conflict, args.table, args.batch_size))
+        except (OSError, ValueError) as e:
+            log.error(f"Import failed: {e}")
+            sys.exit(2)
+    metrics_server = start_metrics_server()
+    try:
+        if getattr(args, 'engine', BOT_ENGINE) == 'asyncio':
+            run_async_bot()
+        else:
+            run_bot(getattr(args, 'mode', BOT_MODE))
+    finally:
+        if metrics_server is not None:
+            metrics_server.stop()
 
-run_bot()
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,30 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# bot.py configures itself from the environment and migrates DB_PATH at import time, so point
+# it at a scratch database before the first import
+_scratch = tempfile.mkdtemp(prefix='frd-tests-')
+os.environ['BOT_TOKEN'] = '123:test'
+os.environ['DB_PATH'] = os.path.join(_scratch, 'bot.db')
+os.environ['EXPORT_CACHE_DIR'] = os.path.join(_scratch, 'exports')
+os.environ['METRICS_PORT'] = '0'
+os.environ['LOG_LEVEL'] = 'WARNING'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot as bot_module
+
+
+@pytest.fixture
+def bot():
+    return bot_module
+
+
+# Empty users and the tables derived from it before each test that uses it
+@pytest.fixture
+def clean_db(bot):
+    bot.clear_database()
+    yield bot
+    bot.clear_database()
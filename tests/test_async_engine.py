@@ -0,0 +1,68 @@
+import asyncio
+import concurrent.futures
+import threading
+
+import httpx
+import pytest
+import requests
+
+
+def done(result=None, error=None):
+    future = concurrent.futures.Future()
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+    return future
+
+
+def handler(seen):
+    saved = yield done(True)
+    seen.append(saved)
+    try:
+        yield done(error=RuntimeError('writer failed'))
+    except RuntimeError as e:
+        seen.append(str(e))
+
+
+def test_run_steps_sends_results_and_throws_errors(bot):
+    seen = []
+    bot.run_steps(handler(seen))
+    assert seen == [True, 'writer failed']
+
+
+def test_run_steps_async_awaits_writes(bot):
+    seen = []
+    asyncio.run(bot.run_steps_async(handler(seen)))
+    assert seen == [True, 'writer failed']
+
+
+@pytest.fixture
+def sender(bot):
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    errors = []
+
+    def transport(request):
+        raise errors.pop(0)
+
+    async def make_client():
+        return httpx.AsyncClient(transport=httpx.MockTransport(transport))
+    client = asyncio.run_coroutine_threadsafe(make_client(), loop).result(5)
+    yield bot.async_request_sender(loop, client), errors
+    asyncio.run_coroutine_threadsafe(client.aclose(), loop).result(5)
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join(5)
+
+
+@pytest.mark.parametrize('error, expected', [
+    (httpx.ConnectError('refused'), requests.exceptions.ConnectionError),
+    (httpx.ReadError('reset'), requests.exceptions.ConnectionError),
+    (httpx.ReadTimeout('slow'), requests.exceptions.Timeout),
+])
+def test_transport_errors_are_raised_as_requests_errors(sender, error, expected):
+    send_request, errors = sender
+    errors.append(error)
+    with pytest.raises(expected):
+        send_request('post', 'https://api.telegram.org/bot1:x/sendMessage', timeout=(5, 5))
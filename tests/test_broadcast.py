@@ -0,0 +1,59 @@
+import concurrent.futures
+import threading
+
+import pytest
+
+
+@pytest.fixture
+def sends(clean_db, monkeypatch):
+    bot = clean_db
+    sent = []
+
+    def send_message(chat_id, text, **kwargs):
+        sent.append(chat_id)
+        future = concurrent.futures.Future()
+        future.set_result(None)
+        return future
+    monkeypatch.setattr(bot.outbox, 'send_message', send_message)
+    for chat_id in range(1, 11):
+        bot.db_writer.execute("INSERT INTO users (chat_id, referral_link, count) VALUES (?, ?, 0)",
+                              (chat_id, f'https://t.me/bot?start={chat_id}')).result(5)
+    return bot, sent
+
+
+def run(bot, broadcast_id):
+    bot._broadcast_stops[broadcast_id] = threading.Event()
+    bot.run_broadcast(broadcast_id)
+    bot.db_writer.flush(5)
+    conn, c = bot.get_connection()
+    c.execute("SELECT status, sent, failed FROM broadcasts WHERE id = ?", (broadcast_id,))
+    return c.fetchone()
+
+
+def test_broadcast_reaches_every_recipient_once(sends):
+    bot, sent = sends
+    broadcast_id = bot.db_writer.submit(bot._insert_broadcast, 'hello', 999).result(5)
+    assert run(bot, broadcast_id) == ('done', 10, 0)
+    assert sent == list(range(1, 11)) + [999]
+
+
+# The process died with the checkpoint at 3 while sends to 5 and 6 had already finished
+def test_resume_skips_sends_finished_past_the_checkpoint(sends):
+    bot, sent = sends
+    broadcast_id = bot.db_writer.submit(bot._insert_broadcast, 'hello', 999).result(5)
+    bot.db_writer.execute("UPDATE broadcasts SET last_chat_id = 3, sent = 3 WHERE id = ?", (broadcast_id,)).result(5)
+    for chat_id, ok in ((5, 1), (6, 0)):
+        bot.db_writer.execute("INSERT INTO broadcast_deliveries (broadcast_id, chat_id, sent) VALUES (?, ?, ?)",
+                              (broadcast_id, chat_id, ok)).result(5)
+    assert run(bot, broadcast_id) == ('done', 9, 1)
+    assert sent == [4, 7, 8, 9, 10, 999]
+
+
+def test_finished_broadcasts_forget_their_deliveries(sends):
+    bot, sent = sends
+    first = bot.db_writer.submit(bot._insert_broadcast, 'hello', 999).result(5)
+    run(bot, first)
+    bot.db_writer.submit(bot._insert_broadcast, 'again', 999).result(5)
+    conn, c = bot.get_connection()
+    c.execute("SELECT COUNT(*) FROM broadcast_deliveries WHERE broadcast_id = ?", (first,))
+    assert c.fetchone()[0] == 0
@@ -0,0 +1,51 @@
+import sqlite3
+
+import pytest
+
+
+def insert_user(c, chat_id):
+    c.execute("INSERT INTO users (chat_id, bep20_address) VALUES (?, 'a')", (chat_id,))
+    return chat_id
+
+
+def fail(c):
+    c.execute("INSERT INTO users (chat_id, bep20_address) VALUES (1, 'partial')")
+    raise ValueError('intent failed')
+
+
+def user_ids(bot):
+    conn, c = bot.get_connection()
+    c.execute("SELECT chat_id FROM users ORDER BY chat_id")
+    return [row[0] for row in c.fetchall()]
+
+
+def test_failing_intent_is_rolled_back_alone(clean_db):
+    bot = clean_db
+    futures = [bot.db_writer.submit(insert_user, 2), bot.db_writer.submit(fail), bot.db_writer.submit(insert_user, 3)]
+    assert futures[0].result(5) == 2
+    with pytest.raises(ValueError):
+        futures[1].result(5)
+    assert futures[2].result(5) == 3
+    assert user_ids(bot) == [2, 3]
+
+
+# A batch whose BEGIN fails (the database is locked by another process) must fail every
+# intent in it, not leave the callers waiting forever
+def test_failed_begin_fails_the_whole_batch(clean_db, monkeypatch):
+    bot = clean_db
+    monkeypatch.setattr(bot, 'DB_BUSY_TIMEOUT', 0.05)
+    writer = bot.DatabaseWriter(batch_window=0.5)
+    holder = sqlite3.connect(bot.DB_PATH, isolation_level=None)
+    holder.execute('BEGIN IMMEDIATE')
+    try:
+        futures = [writer.submit(insert_user, chat_id) for chat_id in (10, 11, 12)]
+        for future in futures:
+            with pytest.raises(sqlite3.OperationalError):
+                future.result(5)
+    finally:
+        holder.execute('ROLLBACK')
+        holder.close()
+    # The writer keeps going once the lock is released
+    assert writer.submit(insert_user, 13).result(5) == 13
+    writer.stop(5)
+    assert user_ids(bot) == [13]
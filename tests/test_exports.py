@@ -0,0 +1,87 @@
+import csv
+import io
+import sqlite3
+
+
+def download(bot, kind):
+    with bot.export_snapshots[kind].open() as file:
+        return list(csv.reader(io.StringIO(file.read().decode())))[1:]
+
+
+def count_rebuilds(bot, monkeypatch):
+    rebuilds = []
+    write_export = bot.write_export
+    monkeypatch.setattr(bot, 'write_export', lambda *args: rebuilds.append(args[0]) or write_export(*args))
+    return rebuilds
+
+
+def test_insert_is_appended_without_rebuild(clean_db, monkeypatch):
+    bot = clean_db
+    bot.insert_bep20_address(1, 'a' * 40).result(5)
+    assert download(bot, 'bep20') == [['1', 'a' * 40]]
+    rebuilds = count_rebuilds(bot, monkeypatch)
+    bot.insert_bep20_address(2, 'b' * 40).result(5)
+    bot.db_writer.flush(5)
+    assert download(bot, 'bep20') == [['1', 'a' * 40], ['2', 'b' * 40]]
+    assert rebuilds == []
+
+
+# Another process (a second instance, the import command) writes straight to the database
+def test_write_from_another_process_is_picked_up(clean_db):
+    bot = clean_db
+    bot.insert_email_address(1, 'a@example.com').result(5)
+    assert download(bot, 'email') == [['1', 'a@example.com']]
+    other = sqlite3.connect(bot.DB_PATH)
+    with other:
+        other.execute("UPDATE users SET email_address = 'b@example.com' WHERE chat_id = 1")
+        other.execute("INSERT INTO users (chat_id, email_address) VALUES (2, 'c@example.com')")
+    other.close()
+    assert download(bot, 'email') == [['1', 'b@example.com'], ['2', 'c@example.com']]
+
+
+def test_version_moves_only_when_the_view_changes(clean_db):
+    bot = clean_db
+    bot.insert_twitter_username(1, 'alice').result(5)
+    conn, c = bot.get_connection()
+    versions = {name: bot.export_version(c, name) for name in bot.EXPORT_VERSION_COLUMNS}
+    # Same value again, and a column no export of twitterusernames shows
+    bot.db_writer.execute("UPDATE users SET twitter_username = 'alice' WHERE chat_id = 1").result(5)
+    bot.db_writer.execute("UPDATE users SET bep20_address = NULL WHERE chat_id = 1").result(5)
+    conn, c = bot.get_connection()
+    assert {name: bot.export_version(c, name) for name in versions} == versions
+    bot.db_writer.execute("UPDATE users SET twitter_username = 'bob' WHERE chat_id = 1").result(5)
+    conn, c = bot.get_connection()
+    assert bot.export_version(c, 'twitterusernames') == versions['twitterusernames'] + 1
+    assert bot.export_version(c, 'bep20_addresses') == versions['bep20_addresses']
+
+
+def test_new_referral_is_appended_and_refresh_keeps_version(clean_db, monkeypatch):
+    bot = clean_db
+    bot.db_writer.submit(bot.register_referral, 1, 0, 'alice', 'Alice', 'https://t.me/bot?start=1').result(5)
+    assert download(bot, 'referrals') == [['1', 'https://t.me/bot?start=1', '0', '0', 'alice']]
+    rebuilds = count_rebuilds(bot, monkeypatch)
+    bot.db_writer.submit(bot.register_referral, 2, 0, 'bob', 'Bob', 'https://t.me/bot?start=2').result(5)
+    bot.db_writer.flush(5)
+    assert download(bot, 'referrals')[1:] == [['2', 'https://t.me/bot?start=2', '0', '0', 'bob']]
+    assert rebuilds == []
+    conn, c = bot.get_connection()
+    version = bot.export_version(c, 'referrals')
+    # /start again with the same link
+    assert bot.db_writer.submit(bot.register_referral, 2, 0, 'bob', 'Bob',
+                                'https://t.me/bot?start=2').result(5) == (False, 0)
+    conn, c = bot.get_connection()
+    assert bot.export_version(c, 'referrals') == version
+
+
+def test_open_reader_does_not_see_later_appends(clean_db):
+    bot = clean_db
+    bot.insert_bep20_address(1, 'a' * 40).result(5)
+    with bot.export_snapshots['bep20'].open() as file:
+        first = file.read(10)
+        bot.insert_bep20_address(2, 'b' * 40).result(5)
+        bot.db_writer.flush(5)
+        content = first + file.read()
+        assert list(csv.reader(io.StringIO(content.decode())))[1:] == [['1', 'a' * 40]]
+        # What an upload measures the file by
+        assert file.seek(0, io.SEEK_END) == len(content)
+    assert download(bot, 'bep20') == [['1', 'a' * 40], ['2', 'b' * 40]]
@@ -0,0 +1,76 @@
+import io
+import sqlite3
+
+
+def users(bot, column):
+    conn, c = bot.get_connection()
+    c.execute(f"SELECT chat_id, {column} FROM users WHERE {column} IS NOT NULL ORDER BY chat_id")
+    return c.fetchall()
+
+
+def write_csv(tmp_path, text):
+    path = tmp_path / 'rows.csv'
+    path.write_text(text)
+    return str(path)
+
+
+def test_csv_rows_are_checked(clean_db, tmp_path):
+    bot = clean_db
+    good, bad = '0x' + 'a' * 40, 'not-an-address!'
+    path = write_csv(tmp_path, f"Chat ID,BEP20 Address\n1,{good}\n2,{bad}\nx,{good}\n3,\n4,{good}\n")
+    assert bot.import_users('bep20', path) == 1
+    assert users(bot, 'bep20_address') == [(1, good), (4, good)]
+
+
+def test_conflict_modes(clean_db, tmp_path):
+    bot = clean_db
+    bot.insert_email_address(1, 'old@example.com').result(5)
+    path = write_csv(tmp_path, "1,new@example.com\n2,two@example.com\n")
+    out = io.StringIO()
+    assert bot.import_users('email', path, on_conflict='report', out=out) == 0
+    assert out.getvalue().splitlines() == ['Chat ID,Existing,Imported', '1,old@example.com,new@example.com']
+    assert users(bot, 'email_address') == [(1, 'old@example.com'), (2, 'two@example.com')]
+    assert bot.import_users('email', path, on_conflict='overwrite') == 0
+    assert users(bot, 'email_address') == [(1, 'new@example.com'), (2, 'two@example.com')]
+
+
+# referral_data.db layout: referrals(chat_id, referral_link, count), no upline or username
+def test_sqlite_source_and_rank_rebuild(clean_db, tmp_path):
+    bot = clean_db
+    source = sqlite3.connect(tmp_path / 'referral_data.db')
+    source.execute("CREATE TABLE referrals (chat_id INTEGER PRIMARY KEY, referral_link TEXT, count INTEGER)")
+    source.executemany("INSERT INTO referrals VALUES (?, ?, ?)", [(1, 'link1', 5), (2, 'link2', 0), (3, 'link3', 5)])
+    source.commit()
+    source.close()
+    assert bot.import_users('referrals', str(tmp_path / 'referral_data.db')) == 0
+    assert users(bot, 'count') == [(1, 5), (2, 0), (3, 5)]
+    assert [rank for rank, *_ in bot.leaderboard()] == [1, 1, 3]
+    assert bot.referral_rank(5) == 1 and bot.referral_rank(0) == 3
+
+
+# An import killed between dropping and restoring the users indexes is repaired on the next start
+def test_startup_restores_indexes_dropped_by_an_import(clean_db):
+    bot = clean_db
+    bot.db_writer.submit(bot._defer_users_indexes).result(5)
+    bot.migrate()
+    conn, c = bot.get_connection()
+    c.execute("SELECT name FROM sqlite_master WHERE type IN ('index', 'trigger')")
+    names = {row[0] for row in c.fetchall()}
+    assert set(bot.USERS_DEFERRED_INDEXES + bot.USERS_DEFERRED_TRIGGERS) <= names
+
+
+# Overwriting a member's upline would leave stale paths in the referral graph
+def test_overwrite_keeps_the_credited_upline(clean_db, tmp_path):
+    bot = clean_db
+    path = write_csv(tmp_path, "1,link1,1,,a\n2,link2,0,,b\n3,link3,1,1,c\n4,link4,0,3,d\n")
+    assert bot.import_users('referrals', path) == 0
+    moved = tmp_path / 'moved.csv'
+    moved.write_text("3,link3-new,1,2,c\n5,link5,0,2,e\n")
+    assert bot.import_users('referrals', str(moved), on_conflict='overwrite') == 0
+    assert users(bot, 'upline_id') == [(3, 1), (4, 3), (5, 2)]
+    assert users(bot, 'referral_link')[2] == (3, 'link3-new')
+    conn, c = bot.get_connection()
+    c.execute("SELECT ancestor_id, descendant_id, depth FROM referral_paths ORDER BY 1, 2")
+    assert c.fetchall() == [(1, 3, 1), (1, 4, 2), (2, 5, 1), (3, 4, 1)]
+    c.execute("SELECT ancestor_id, depth, total FROM referral_level_counts WHERE total > 0 ORDER BY 1, 2")
+    assert c.fetchall() == [(1, 1, 1), (1, 2, 1), (2, 1, 1), (3, 1, 1)]
@@ -0,0 +1,47 @@
+import concurrent.futures
+
+import pytest
+import telebot
+
+
+def bad_request(description):
+    return telebot.apihelper.ApiTelegramException(
+        'sendPhoto', None, {'ok': False, 'error_code': 400, 'description': description})
+
+
+@pytest.fixture
+def sends(bot, monkeypatch):
+    calls, errors = [], []
+
+    def send_photo(chat_id, photo, **kwargs):
+        calls.append(photo)
+        future = concurrent.futures.Future()
+        if errors:
+            future.set_exception(errors.pop(0))
+        else:
+            future.set_result(telebot.types.Message.de_json(
+                {'message_id': 1, 'date': 0, 'chat': {'id': chat_id, 'type': 'private'}}))
+        return future
+    monkeypatch.setattr(bot.outbox, 'send_photo', send_photo)
+    cache = bot.MediaCache()
+    cache._file_ids['logo'] = 'cached-id'
+    forgotten = []
+    monkeypatch.setattr(cache, 'forget', forgotten.append)
+    return cache, calls, errors, forgotten
+
+
+def test_refused_file_id_is_forgotten_and_sent_by_url(sends):
+    cache, calls, errors, forgotten = sends
+    errors.append(bad_request('Bad Request: wrong file identifier/HTTP URL specified'))
+    cache.send_photo(1, 'logo').result(5)
+    assert calls == ['cached-id', 'logo']
+    assert forgotten == ['logo']
+
+
+def test_other_bad_request_keeps_file_id(sends):
+    cache, calls, errors, forgotten = sends
+    errors.append(bad_request("Bad Request: can't parse entities: Can't find end of the entity"))
+    with pytest.raises(Exception, match="can't parse entities"):
+        cache.send_photo(1, 'logo').result(5)
+    assert calls == ['cached-id']
+    assert forgotten == []
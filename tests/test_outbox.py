@@ -0,0 +1,141 @@
+import threading
+import time
+
+import pytest
+import telebot
+
+
+class FakeTelegram:
+    def __init__(self):
+        self.sent = []  # (monotonic time, chat_id, text)
+        self.errors = {}  # text -> exceptions to raise, in order
+        self.gate = threading.Event()
+        self.gate.set()
+        self.in_flight = {}
+        self.overlapped = False
+        self.lock = threading.Lock()
+
+    def send_message(self, chat_id, text, **kwargs):
+        with self.lock:
+            self.in_flight[chat_id] = self.in_flight.get(chat_id, 0) + 1
+            self.overlapped |= self.in_flight[chat_id] > 1
+        try:
+            self.gate.wait(5)
+            with self.lock:
+                if self.errors.get(text):
+                    raise self.errors[text].pop(0)
+                self.sent.append((time.monotonic(), chat_id, text))
+            time.sleep(0.001)
+            return text
+        finally:
+            with self.lock:
+                self.in_flight[chat_id] -= 1
+
+    def texts(self):
+        return [text for at, chat_id, text in self.sent]
+
+
+@pytest.fixture
+def telegram(bot, monkeypatch):
+    fake = FakeTelegram()
+    monkeypatch.setattr(bot.bot, 'send_message', fake.send_message)
+    return fake
+
+
+@pytest.fixture
+def make_outbox(bot):
+    outboxes = []
+
+    def make(**kwargs):
+        outbox = bot.Outbox(**kwargs)
+        outboxes.append(outbox)
+        return outbox
+    yield make
+    for outbox in outboxes:
+        outbox.stop(5)
+
+
+def too_many_requests(retry_after):
+    return telebot.apihelper.ApiTelegramException(
+        'sendMessage', None, {'ok': False, 'error_code': 429, 'description': 'Too Many Requests',
+                              'parameters': {'retry_after': retry_after}})
+
+
+def wait_until(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+
+
+def wait_all(futures):
+    return [future.result(5) for future in futures]
+
+
+def test_global_rate_limit(telegram, make_outbox):
+    outbox = make_outbox(workers=8, global_rate=20, chat_rate=1000, chat_burst=1000)
+    started = time.monotonic()
+    wait_all([outbox.send_message(chat_id, str(chat_id)) for chat_id in range(30)])
+    # A full bucket of 20, then 10 more at 20/s
+    assert time.monotonic() - started >= 0.45
+    assert sorted(telegram.texts(), key=int) == [str(chat_id) for chat_id in range(30)]
+
+
+def test_chat_rate_limit_holds_back_only_that_chat(telegram, make_outbox):
+    outbox = make_outbox(workers=8, global_rate=1000, chat_rate=10, chat_burst=2)
+    busy = [outbox.send_message(1, f'busy {i}') for i in range(7)]
+    quiet = outbox.send_message(2, 'quiet')
+    wait_all(busy + [quiet])
+    times = {text: at for at, chat_id, text in telegram.sent}
+    # Two at once, then one every 0.1s
+    assert times['busy 6'] - times['busy 0'] >= 0.45
+    assert times['quiet'] < times['busy 3']
+
+
+def test_interactive_lane_goes_first(bot, telegram, make_outbox):
+    outbox = make_outbox(workers=1, global_rate=1000, chat_rate=1000, chat_burst=1000)
+    telegram.gate.clear()
+    first = outbox.send_message(100, 'first')
+    wait_until(lambda: telegram.in_flight.get(100))
+    bulk = [outbox.send_message(chat_id, f'bulk {chat_id}', lane=bot.LANE_BULK) for chat_id in range(1, 4)]
+    interactive = outbox.send_message(50, 'interactive')
+    telegram.gate.set()
+    wait_all([first, interactive] + bulk)
+    assert telegram.texts() == ['first', 'interactive', 'bulk 1', 'bulk 2', 'bulk 3']
+
+
+def test_chat_messages_keep_their_order(telegram, make_outbox):
+    outbox = make_outbox(workers=8, global_rate=1000, chat_rate=1000, chat_burst=1000)
+    futures = [outbox.send_message(chat_id, f'{chat_id}:{i}') for i in range(20) for chat_id in (1, 2, 3)]
+    wait_all(futures)
+    for chat_id in (1, 2, 3):
+        assert [text for at, chat, text in telegram.sent if chat == chat_id] == [f'{chat_id}:{i}' for i in range(20)]
+    assert not telegram.overlapped
+
+
+def test_429_pauses_the_chat_and_retries(telegram, make_outbox):
+    outbox = make_outbox(workers=4, global_rate=1000, chat_rate=1000, chat_burst=1000)
+    telegram.errors['a'] = [too_many_requests(0.3)]
+    started = time.monotonic()
+    futures = [outbox.send_message(1, 'a'), outbox.send_message(1, 'b'), outbox.send_message(2, 'other')]
+    assert wait_all(futures) == ['a', 'b', 'other']
+    times = {text: at for at, chat_id, text in telegram.sent}
+    assert times['a'] - started >= 0.3
+    assert times['a'] < times['b']
+    # Other chats are not held up by the pause
+    assert times['other'] - started < 0.3
+
+
+def test_cancelled_jobs_are_not_sent(bot, telegram, make_outbox):
+    outbox = make_outbox(workers=1, global_rate=1000, chat_rate=1000, chat_burst=1000, bulk_queue_size=3)
+    telegram.gate.clear()
+    first = outbox.send_message(100, 'first')
+    wait_until(lambda: telegram.in_flight.get(100))
+    bulk = [outbox.send_message(chat_id, f'bulk {chat_id}', lane=bot.LANE_BULK) for chat_id in range(1, 4)]
+    assert bulk[1].cancel()
+    telegram.gate.set()
+    wait_all([first, bulk[0], bulk[2]])
+    assert bulk[1].cancelled()
+    assert telegram.texts() == ['first', 'bulk 1', 'bulk 3']
+    # The withdrawn job gave back its place in the bulk queue
+    wait_until(lambda: outbox._bulk_pending == 0)
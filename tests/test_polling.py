@@ -0,0 +1,60 @@
+import logging
+import threading
+
+import pytest
+import telebot
+
+
+def conflict(description):
+    return telebot.apihelper.ApiTelegramException(
+        'getUpdates', None, {'ok': False, 'error_code': 409, 'description': description})
+
+
+WEBHOOK_ACTIVE = "Conflict: can't use getUpdates method while webhook is active; use deleteWebhook to delete the webhook first"
+OTHER_INSTANCE = "Conflict: terminated by other getUpdates request; make sure that only one bot instance is running"
+
+
+# Telegram as far as long polling is concerned: getUpdates is refused while a webhook is set
+@pytest.fixture
+def telegram(bot, monkeypatch):
+    state = {'webhook': True, 'polls': 0, 'errors': []}
+    stop = threading.Event()
+
+    def get_updates(**kwargs):
+        state['polls'] += 1
+        if state['errors']:
+            raise state['errors'].pop(0)
+        if state['webhook']:
+            raise conflict(WEBHOOK_ACTIVE)
+        stop.set()
+        return []
+
+    def delete_webhook(**kwargs):
+        state['webhook'] = False
+        return True
+    monkeypatch.setattr(bot.bot, 'get_updates', get_updates)
+    monkeypatch.setattr(bot.bot, 'delete_webhook', delete_webhook)
+    monkeypatch.setattr(bot.health, 'intake', None)
+    monkeypatch.setattr(bot.health, 'poll_failures', 0)
+    return state, stop
+
+
+def test_polling_deletes_a_webhook_left_registered(bot, telegram):
+    state, stop = telegram
+    bot.start_polling(stop)
+    assert not state['webhook']
+    assert state['polls'] == 1
+    assert bot.health.intake == 'polling'
+
+
+def test_webhook_conflict_deletes_the_webhook_and_retries(bot, telegram, caplog):
+    state, stop = telegram
+    state['errors'].append(conflict(OTHER_INSTANCE))
+    with caplog.at_level(logging.WARNING, logger=bot.log.name):
+        bot.poll_updates(stop, backoff_initial=0.01, backoff_max=0.01)
+    assert not state['webhook']
+    assert state['polls'] == 3
+    messages = [record.getMessage() for record in caplog.records]
+    assert any('another instance is polling' in message for message in messages)
+    assert any('a webhook is registered' in message for message in messages)
+    assert bot.health.poll_failures == 0
@@ -0,0 +1,55 @@
+import random
+
+
+# Referral paths worked out from users.upline_id alone, independently of the closure table
+EXPECTED_PATHS = '''
+    WITH RECURSIVE paths (ancestor_id, descendant_id, depth) AS (
+        SELECT upline_id, chat_id, 1 FROM users
+        WHERE referral_link IS NOT NULL AND upline_id IN (SELECT chat_id FROM users WHERE referral_link IS NOT NULL)
+        UNION ALL
+        SELECT u.upline_id, p.descendant_id, p.depth + 1 FROM paths p JOIN users u ON u.chat_id = p.ancestor_id
+        WHERE p.depth < ? AND u.upline_id IN (SELECT chat_id FROM users WHERE referral_link IS NOT NULL)
+    )
+    SELECT ancestor_id, descendant_id, depth FROM paths ORDER BY 1, 2, 3'''
+
+
+def graph(bot):
+    conn, c = bot.get_connection()
+    c.execute(EXPECTED_PATHS, (bot.REFERRAL_MAX_DEPTH,))
+    expected = c.fetchall()
+    c.execute("SELECT ancestor_id, descendant_id, depth FROM referral_paths ORDER BY 1, 2, 3")
+    paths = c.fetchall()
+    c.execute("SELECT ancestor_id, depth, COUNT(*) FROM referral_paths GROUP BY 1, 2 ORDER BY 1, 2")
+    expected_totals = c.fetchall()
+    c.execute("SELECT ancestor_id, depth, total FROM referral_level_counts WHERE total > 0 ORDER BY 1, 2")
+    return expected, paths, expected_totals, c.fetchall()
+
+
+def register_tree(bot, users):
+    rng = random.Random(7)
+    # Users 1 and 2 join without a valid upline; the rest are referred by an earlier user
+    for chat_id in range(1, users + 1):
+        upline_id = rng.randint(1, chat_id - 1) if chat_id > 2 else 0
+        bot.db_writer.submit(bot.register_referral, chat_id, upline_id, f'user{chat_id}', None,
+                             f'https://t.me/bot?start={chat_id}').result(5)
+
+
+def test_joins_maintain_the_closure_table(clean_db):
+    bot = clean_db
+    register_tree(bot, 60)
+    expected, paths, expected_totals, totals = graph(bot)
+    assert len(expected) > 60
+    assert max(depth for _, _, depth in expected) == bot.REFERRAL_MAX_DEPTH
+    assert paths == expected
+    assert totals == expected_totals
+
+
+def test_backfill_rebuilds_the_closure_table(clean_db):
+    bot = clean_db
+    register_tree(bot, 60)
+    bot.db_writer.execute("DELETE FROM referral_paths").result(5)
+    bot.db_writer.execute("DELETE FROM referral_level_counts").result(5)
+    bot.backfill_referral_graph(batch_size=7)
+    expected, paths, expected_totals, totals = graph(bot)
+    assert paths == expected
+    assert totals == expected_totals
@@ -0,0 +1,31 @@
+def test_redelivered_update_is_skipped(bot):
+    ledger = bot.UpdateLedger(window=2)
+    assert ledger.begin(101)
+    assert ledger.current() == 101
+    assert not ledger.begin(101)
+    assert ledger.begin(102) and ledger.begin(103)
+    # Only the last `window` ids are remembered
+    assert ledger.begin(101)
+
+
+def test_processed_updates_survive_a_restart(bot):
+    ledger = bot.UpdateLedger()
+    assert ledger.begin(201)
+    ledger.done(201)
+    assert ledger.current() is None
+    bot.db_writer.flush(5)
+    restarted = bot.UpdateLedger()
+    restarted.load()
+    assert not restarted.begin(201)
+    assert restarted.begin(202)
+
+
+def test_referral_is_credited_once_per_update(clean_db):
+    bot = clean_db
+    link = 'https://t.me/bot?start={}'
+    bot.db_writer.submit(bot.register_referral, 1, 0, 'alice', 'Alice', link.format(1)).result(5)
+    for attempt in range(2):
+        bot.db_writer.submit(bot.register_referral, 2, 1, 'bob', 'Bob', link.format(2), 301).result(5)
+    conn, c = bot.get_connection()
+    c.execute("SELECT count FROM users WHERE chat_id = 1")
+    assert c.fetchone()[0] == 1
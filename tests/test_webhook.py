@@ -0,0 +1,66 @@
+import http.client
+import json
+import threading
+
+import pytest
+
+
+@pytest.fixture
+def webhook(bot, monkeypatch):
+    submitted = []
+    monkeypatch.setattr(bot.update_workers, 'submit', lambda update, block=True: submitted.append(update) or True)
+    server = bot.WebhookServer(listen='127.0.0.1', port=0, secret='s3cret')
+    thread = threading.Thread(target=server.serve, daemon=True)
+    thread.start()
+    yield server, submitted
+    server.stop()
+    thread.join()
+
+
+def post(server, body, headers=None):
+    conn = http.client.HTTPConnection(*server.server.server_address, timeout=5)
+    conn.request('POST', '/telegram', body=body, headers=headers or {})
+    status = conn.getresponse().status
+    conn.close()
+    return status
+
+
+def update(update_id=1, user_id=730149343):
+    return {'update_id': update_id,
+            'message': {'message_id': 1, 'date': 0, 'text': '/clear_data',
+                        'chat': {'id': user_id, 'type': 'private'},
+                        'from': {'id': user_id, 'is_bot': False, 'first_name': 'A'}}}
+
+
+def test_refuses_to_start_without_secret(bot):
+    with pytest.raises(ValueError):
+        bot.WebhookServer(listen='127.0.0.1', port=0, secret='')
+
+
+@pytest.mark.parametrize('headers', [{}, {'X-Telegram-Bot-Api-Secret-Token': 'wrong'}])
+def test_rejects_missing_or_wrong_secret(webhook, headers):
+    server, submitted = webhook
+    assert post(server, json.dumps(update()), headers) == 403
+    assert submitted == []
+
+
+def test_accepts_update_with_secret(webhook):
+    server, submitted = webhook
+    assert post(server, json.dumps(update(7)), {'X-Telegram-Bot-Api-Secret-Token': 's3cret'}) == 200
+    assert [u.update_id for u in submitted] == [7]
+
+
+@pytest.mark.parametrize('body, length', [
+    ('[1, 2]', None),
+    ('"text"', None),
+    ('{"message": {}}', None),
+    ('{}', 'abc'),
+    ('{}', '-1'),
+])
+def test_rejects_malformed_requests(webhook, body, length):
+    server, submitted = webhook
+    headers = {'X-Telegram-Bot-Api-Secret-Token': 's3cret'}
+    if length is not None:
+        headers['Content-Length'] = length
+    assert post(server, body, headers) == 400
+    assert submitted == []